@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+进程级常驻后台事件循环
+
+同步代码（例如 Flask 的请求处理线程）通过 run_sync()/submit() 把协程提交到同一个后台事件循环执行，
+避免每次调用都 asyncio.run() 新建、销毁事件循环，使得连接池中的长连接和并发的工具调用得以复用。
+支持两种执行模式：
+- background: 每个工作进程一个后台事件循环线程（默认）
+- per_call: 每次调用都使用 asyncio.run()，与旧的行为一致，便于排查问题
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import logging.config
+import os
+import threading
+from pathlib import Path
+from typing import Any, AsyncGenerator, Coroutine, Generator
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+MODE_BACKGROUND = "background"
+MODE_PER_CALL = "per_call"
+
+
+class BackgroundLoop:
+    """在独立守护线程中运行的事件循环，fork 之后在子进程中自动重建"""
+
+    def __init__(self, name: str = "aio-loop"):
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return (self._loop is not None and self._pid == os.getpid()
+                and self._thread is not None and self._thread.is_alive())
+
+    @property
+    def thread_id(self) -> int | None:
+        """事件循环线程的 ident，未运行时为 None，用于按线程采样调用栈"""
+        return self._thread.ident if self.running else None
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.running:
+                return self._loop
+            # fork 出来的子进程中父进程的线程已不存在，需要重新创建事件循环
+            self._loop = asyncio.new_event_loop()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True)
+            self._thread.start()
+            logger.info(f"background_event_loop_started, pid={self._pid}, thread={self.name}")
+            return self._loop
+
+    def stop(self, timeout: float = 5):
+        with self._lock:
+            if not self.running:
+                return
+            loop = self._loop
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout)
+            if not self._thread.is_alive():
+                loop.close()
+            self._loop = None
+            self._thread = None
+            logger.info(f"background_event_loop_stopped, pid={self._pid}")
+
+    def in_loop_thread(self) -> bool:
+        return self.running and threading.current_thread() is self._thread
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """提交协程到后台事件循环，立即返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def run(self, coro: Coroutine, timeout: float | None = None) -> Any:
+        """提交协程到后台事件循环，并阻塞等待结果"""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("不能在后台事件循环线程中同步等待协程，请直接 await")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+
+default_loop = BackgroundLoop()
+_mode = MODE_BACKGROUND
+
+
+def configure(mode: str | None):
+    """设置执行模式，background 或 per_call"""
+    global _mode
+    mode = mode or MODE_BACKGROUND
+    if mode not in (MODE_BACKGROUND, MODE_PER_CALL):
+        raise ValueError(f"不支持的事件循环模式: {mode}")
+    _mode = mode
+    logger.info(f"event_loop_mode={_mode}")
+
+
+def get_mode() -> str:
+    return _mode
+
+
+def run_sync(coro: Coroutine, timeout: float | None = None) -> Any:
+    """在同步代码中执行协程"""
+    if _mode == MODE_PER_CALL:
+        return asyncio.run(asyncio.wait_for(coro, timeout) if timeout else coro)
+    return default_loop.run(coro, timeout)
+
+
+def submit(coro: Coroutine) -> concurrent.futures.Future:
+    """提交协程到后台事件循环，调用方可以同时提交多个协程，再分别等待结果"""
+    return default_loop.submit(coro)
+
+
+def iterate_sync(agen: AsyncGenerator) -> Generator[Any, None, None]:
+    """在同步代码中逐个消费异步生成器产生的数据"""
+    if _mode == MODE_PER_CALL:
+        # 异步生成器内部创建的 task 必须始终运行在同一个事件循环中，这里为它单独建一个事件循环
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                try:
+                    item = loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.close()
+    else:
+        try:
+            while True:
+                try:
+                    item = default_loop.run(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            default_loop.run(agen.aclose())
+
+
+def shutdown(cleanup: Coroutine | None = None, timeout: float = 5):
+    """进程退出时执行清理协程（例如关闭连接池）并停止后台事件循环"""
+    if cleanup is not None:
+        if default_loop.running:
+            try:
+                default_loop.run(cleanup, timeout)
+            except Exception as e:
+                logger.warning(f"background_event_loop_cleanup_fail: {e}")
+        else:
+            cleanup.close()
+    default_loop.stop(timeout)
+
+
+atexit.register(default_loop.stop)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+"""
+ASGI Web 界面 for MCP 客户端
+与 http_mcp.py 提供相同的接口和 SSE 事件格式，但整个对话过程（LLM 调用、工具调用）都是异步的，
+单个进程可以同时处理大量对话，浏览器断开连接时会取消正在进行的对话。
+启动方式:
+    uvicorn asgi_mcp:app --host 0.0.0.0 --port 19000 --ssl-keyfile ./cert/srv.key --ssl-certfile ./cert/srv.crt
+"""
+
+import asyncio
+import contextlib
+import json
+import logging.config
+
+import anyio
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+import circuit_breaker
+import http_pool
+import metrics
+import tracing
+from client import async_auto_call_mcp_yield, async_fetch_sql_result_page, background_refresh_coros, init_yml_cfg, \
+    mcp_session_pool, tools_cache_status
+
+# 配置日志
+logging.config.fileConfig('logging.conf', encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+# 初始化配置
+cfg = init_yml_cfg()
+
+
+async def index(request: Request):
+    """主页面"""
+    return FileResponse('templates/index.html')
+
+
+async def query_events(question: str, request_id: str):
+    """将对话过程中产生的事件转换为 SSE 格式"""
+    try:
+        async for chunk in async_auto_call_mcp_yield(question, cfg, request_id=request_id):
+            yield f"data: {chunk}\n\n"
+        yield "data: [DONE]\n\n"
+    except asyncio.CancelledError:
+        # 浏览器断开连接，StreamingResponse 会取消当前任务，这里只记录日志
+        logger.info(f"client_disconnected, cancel question: {question}")
+        raise
+    except Exception as e:
+        error_msg = json.dumps({
+            "type": "error",
+            "content": f"处理过程中发生错误: {str(e)}"
+        }, ensure_ascii=False)
+        yield f"data: {error_msg}\n\n"
+        yield "data: [DONE]\n\n"
+
+
+async def process_query(request: Request):
+    """处理用户查询的 API 端点"""
+    try:
+        # 获取用户输入
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            data = None
+        if not data or 'question' not in data:
+            return JSONResponse({'error': '缺少问题参数'}, status_code=400)
+
+        question = data['question']
+        # 请求ID用于在日志和链路追踪中串联本次对话的 LLM 调用、MCP 工具调用和数据后端调用
+        request_id = request.headers.get(tracing.REQUEST_ID_HEADER) or tracing.new_request_id()
+        logger.info(f"收到用户查询: {question}, request_id={request_id}")
+
+        # 检查是否请求流式响应
+        if data.get('stream', False):
+            return StreamingResponse(query_events(question, request_id),
+                                     media_type='text/event-stream',
+                                     headers={
+                                         'Cache-Control': 'no-cache',
+                                         'Connection': 'keep-alive',
+                                         'X-Accel-Buffering': 'no',  # 禁用Nginx缓冲
+                                         tracing.REQUEST_ID_HEADER: request_id
+                                     })
+
+        # 普通响应，消费全部事件，取最终结果
+        answer = None
+        async for chunk in async_auto_call_mcp_yield(question, cfg, request_id=request_id):
+            event = json.loads(chunk)
+            if event["type"] == "final":
+                answer = event["content"]
+            elif event["type"] == "error":
+                raise RuntimeError(event["content"])
+        return JSONResponse({
+            'success': True,
+            'question': question,
+            'answer': answer
+        }, headers={tracing.REQUEST_ID_HEADER: request_id})
+
+    except Exception as e:
+        logger.exception("处理查询时发生错误")
+        return JSONResponse({
+            'success': False,
+            'error': str(e)
+        }, status_code=500)
+
+
+async def sql_result_page(request: Request):
+    """按 next_cursor 获取 SQL 查询结果的后续数据"""
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = None
+    if not data or 'cursor' not in data:
+        return JSONResponse({'error': '缺少cursor参数'}, status_code=400)
+    try:
+        return JSONResponse({'success': True, 'result': await async_fetch_sql_result_page(data['cursor'])})
+    except Exception as e:
+        logger.exception("获取查询结果分页时发生错误")
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=500)
+
+
+async def health_check(request: Request):
+    """健康检查端点，包含各上游服务的熔断器状态"""
+    health, status_code = circuit_breaker.health_status()
+    health['http_pool'] = http_pool.pool_stats()
+    health['mcp_servers'] = tools_cache_status()
+    return JSONResponse(health, status_code=status_code)
+
+
+async def metrics_endpoint(request: Request):
+    """Prometheus 指标，读取其他工作进程的快照文件在线程中执行，不阻塞事件循环"""
+    return Response(await anyio.to_thread.run_sync(metrics.render), media_type=metrics.CONTENT_TYPE)
+
+
+class RequestMetricsMiddleware:
+    """按接口和状态码统计请求数，流式响应在发送响应头时计数"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                # 路由匹配后 scope 中有 route，按路由路径而不是请求路径计数，避免标签值无限增长
+                route = scope.get("route")
+                metrics.HTTP_REQUESTS.inc(endpoint=getattr(route, "path", "other"), status=message["status"])
+            await send(message)
+
+        await self.app(scope, receive, send_with_metrics)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(starlette_app: Starlette):
+    # 定时写入本进程的指标快照，多个工作进程时 /metrics 合并输出
+    metrics.start("asgi_mcp")
+    # 定时刷新 MCP 工具列表、检查各副本的健康状态，用户请求不再等待工具发现
+    background_tasks = [asyncio.create_task(coro) for coro in background_refresh_coros(cfg)]
+    yield
+    for task in background_tasks:
+        task.cancel()
+    # 退出时关闭 MCP 会话池中的长连接
+    await mcp_session_pool.close_all()
+
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/api/query', process_query, methods=['POST']),
+        Route('/api/sql_page', sql_result_page, methods=['POST']),
+        Route('/api/health', health_check),
+        Route('/metrics', metrics_endpoint),
+        Mount('/static', StaticFiles(directory='static'), name='static'),
+    ],
+    middleware=[Middleware(RequestMetricsMiddleware)],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=19002)
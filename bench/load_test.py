@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+完整链路的离线压测: /api/query -> LLM -> MCP server.py -> tool_api_uri
+LLM 和数据后端使用 bench.stub_llm、bench.stub_backend 两个桩服务，不依赖外网，结果可重复。
+按多个并发数依次压测，输出吞吐量、p50/p95/p99 延迟、错误数，以及被测进程（含子进程）的 CPU 使用率和内存峰值。
+准备:
+    1. cfg.yml 中配置 api.llm_api_uri: http://127.0.0.1:19102/v1 和 api.tool_api_uri: http://127.0.0.1:19103，
+       mcp 服务地址指向本机的 server.py
+    2. 启动 server.py 和 Web 服务（asgi_mcp.py 或 http_mcp.py）
+在 project 根目录下执行:
+    python -m bench.load_test --start-stubs --url http://127.0.0.1:19002/api/query --concurrency 1 4 16 64
+    python -m bench.load_test --stream --pids $(pgrep -f server.py) $(pgrep -f asgi_mcp) --output result.json
+    python -m bench.load_test --baseline result.json   # 与之前保存的结果比较，出现性能回退时退出码为 1
+流式请求（--stream）时还会统计首个事件的延迟，以及 final 事件 timing 中 llm、mcp_tool 等阶段的平均耗时。
+CPU 和内存从 /proc 读取，只支持 Linux。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def percentile(values: list[float], p: float) -> float:
+    """线性插值计算百分位数，values 需要已排序"""
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class ProcessMonitor:
+    """定期采样被测进程及其子进程（gunicorn/uvicorn 的 worker）的 CPU 时间和 RSS"""
+
+    def __init__(self, pids: list[int], interval: float = 0.5):
+        self.pids = pids
+        self.interval = interval
+        self.peak_rss = 0
+        self._task = None
+
+    @staticmethod
+    def _read_stat(pid: int) -> tuple[int, int, int] | None:
+        """返回 (ppid, utime + stime, rss)，进程不存在时返回 None"""
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # comm 中可能有空格，从最后一个右括号之后开始解析
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (FileNotFoundError, ProcessLookupError, IndexError):
+            return None
+        return int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21]) * PAGE_SIZE
+
+    def _process_tree(self) -> dict[int, tuple[int, int]]:
+        stats = {}
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                stat = self._read_stat(int(name))
+                if stat:
+                    stats[int(name)] = stat
+        tree, pending = {}, [pid for pid in self.pids if pid in stats]
+        while pending:
+            pid = pending.pop()
+            if pid in tree:
+                continue
+            tree[pid] = stats[pid][1:]
+            pending.extend(child for child, stat in stats.items() if stat[0] == pid)
+        return tree
+
+    def sample(self) -> tuple[int, int]:
+        """返回 (CPU 时间 ticks, RSS 字节) 的合计"""
+        tree = self._process_tree()
+        cpu, rss = sum(v[0] for v in tree.values()), sum(v[1] for v in tree.values())
+        self.peak_rss = max(self.peak_rss, rss)
+        return cpu, rss
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.sample()
+
+    def start(self):
+        self.peak_rss = 0
+        self._cpu_start, _ = self.sample()
+        self._wall_start = time.perf_counter()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> dict:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        cpu_end, _ = self.sample()
+        wall = time.perf_counter() - self._wall_start
+        return {"cpu_percent": round((cpu_end - self._cpu_start) / CLK_TCK / wall * 100, 1) if wall else 0.0,
+                "peak_rss_mb": round(self.peak_rss / 1024 / 1024, 1)}
+
+
+async def send_query(client: httpx.AsyncClient, url: str, question: str, stream: bool) -> dict:
+    """发送一个问题，返回耗时、是否成功，流式请求时还返回首个事件的延迟和 timing"""
+    start = time.perf_counter()
+    result = {"ok": False, "latency": 0.0, "first_event": None, "breakdown_ms": None, "error": None}
+    try:
+        if stream:
+            async with client.stream("POST", url, json={"question": question, "stream": True}) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    if result["first_event"] is None:
+                        result["first_event"] = time.perf_counter() - start
+                    event = json.loads(line[6:])
+                    if event["type"] == "error":
+                        result["error"] = event["content"]
+                    elif event["type"] == "final":
+                        result["ok"] = True
+                        result["breakdown_ms"] = (event.get("timing") or {}).get("breakdown_ms")
+        else:
+            response = await client.post(url, json={"question": question})
+            response.raise_for_status()
+            result["ok"] = bool(response.json().get("success"))
+            if not result["ok"]:
+                result["error"] = response.json().get("error")
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["latency"] = time.perf_counter() - start
+    if result["error"]:
+        result["ok"] = False
+    return result
+
+
+async def run_level(client: httpx.AsyncClient, args, concurrency: int, monitor: ProcessMonitor | None) -> dict:
+    """以固定并发数发送 args.requests 个请求，每个并发槽位完成一个请求后立即发送下一个"""
+    remaining = args.requests
+    results = []
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            results.append(await send_query(client, args.url, args.question, args.stream))
+
+    if monitor:
+        monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    resources = await monitor.stop() if monitor else {}
+
+    latencies = sorted(r["latency"] for r in results if r["ok"])
+    errors = [r["error"] for r in results if not r["ok"]]
+    level = {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(errors),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        **resources,
+    }
+    first_events = sorted(r["first_event"] for r in results if r["ok"] and r["first_event"] is not None)
+    if first_events:
+        level["first_event_p50_ms"] = round(percentile(first_events, 50) * 1000, 1)
+    breakdowns = [r["breakdown_ms"] for r in results if r["breakdown_ms"]]
+    if breakdowns:
+        names = sorted({name for b in breakdowns for name in b})
+        level["breakdown_ms"] = {name: round(sum(b.get(name, 0) for b in breakdowns) / len(breakdowns), 1)
+                                 for name in names}
+    if errors:
+        level["sample_errors"] = sorted(set(errors))[:3]
+    return level
+
+
+def print_header():
+    print(f"{'conc':>5} {'reqs':>6} {'err':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'max ms':>9} {'cpu%':>7} {'rss MB':>8}")
+
+
+def print_level(level: dict):
+    print(f"{level['concurrency']:>5} {level['requests']:>6} {level['errors']:>5} {level['throughput']:>8.2f} "
+          f"{level['p50_ms']:>9.1f} {level['p95_ms']:>9.1f} {level['p99_ms']:>9.1f} {level['max_ms']:>9.1f} "
+          f"{level.get('cpu_percent', '-'):>7} {level.get('peak_rss_mb', '-'):>8}")
+    if "breakdown_ms" in level:
+        breakdown = ", ".join(f"{name}={ms}" for name, ms in level["breakdown_ms"].items())
+        print(f"      first_event_p50={level.get('first_event_p50_ms')}ms, 平均耗时(ms): {breakdown}")
+    for error in level.get("sample_errors", []):
+        print(f"      error: {error}")
+
+
+def compare_with_baseline(levels: list[dict], baseline_file: str, threshold: float) -> bool:
+    """与基线结果按并发数逐项比较，吞吐量下降或 p95 延迟上升超过 threshold（百分比）时视为性能回退"""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    regressed = False
+    print(f"\n与基线 {baseline_file} 比较（阈值 {threshold}%）:")
+    print(f"{'conc':>5} {'req/s':>18} {'p95 ms':>22} {'p99 ms':>22}")
+    for level in levels:
+        base = baseline.get(level["concurrency"])
+        if not base:
+            continue
+        deltas = {key: (level[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+                  for key in ("throughput", "p95_ms", "p99_ms")}
+        worse = deltas["throughput"] < -threshold or deltas["p95_ms"] > threshold or level["errors"] > base["errors"]
+        regressed = regressed or worse
+        print(f"{level['concurrency']:>5} {base['throughput']:>7.2f}->{level['throughput']:<7.2f}{deltas['throughput']:+.0f}% "
+              f"{base['p95_ms']:>8.1f}->{level['p95_ms']:<8.1f}{deltas['p95_ms']:+.0f}% "
+              f"{base['p99_ms']:>8.1f}->{level['p99_ms']:<8.1f}{deltas['p99_ms']:+.0f}%"
+              f"{'  回退' if worse else ''}")
+    return regressed
+
+
+def start_stubs(args) -> list[subprocess.Popen]:
+    """在子进程中启动 LLM 和数据后端桩服务"""
+    commands = [
+        [sys.executable, "-m", "bench.stub_llm", "--port", str(args.llm_port), "--script", args.script,
+         "--latency", str(args.llm_latency)],
+        [sys.executable, "-m", "bench.stub_backend", "--port", str(args.backend_port), "--rows", str(args.rows),
+         "--sql-latency", str(args.sql_latency)],
+    ]
+    processes = [subprocess.Popen(command) for command in commands]
+    for port in (args.llm_port, args.backend_port):
+        for _ in range(50):
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+                break
+            except httpx.TransportError:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError(f"桩服务启动失败, port={port}")
+    return processes
+
+
+async def run(args) -> list[dict]:
+    monitor = ProcessMonitor(args.pids) if args.pids else None
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(verify=False, timeout=args.timeout, limits=limits) as client:
+        # 预热，让 Web 服务建立 MCP 连接、加载工具列表，不计入结果
+        for _ in range(args.warmup):
+            result = await send_query(client, args.url, args.question, args.stream)
+            if not result["ok"]:
+                print(f"预热请求失败: {result['error']}")
+        print_header()
+        levels = []
+        for concurrency in args.concurrency:
+            levels.append(await run_level(client, args, concurrency, monitor))
+            print_level(levels[-1])
+    return levels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load test /api/query with stub LLM and data backend")
+    parser.add_argument("--url", default="http://127.0.0.1:19002/api/query")
+    parser.add_argument("--question", default="去年各城市的销售额是多少")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=100, help="每个并发数下发送的请求数")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--stream", action="store_true", help="使用 SSE 流式接口")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--pids", type=int, nargs="*", default=[], help="统计 CPU 和内存的进程（包含其子进程）")
+    parser.add_argument("--output", help="把结果保存为 JSON 文件，可作为之后的 --baseline")
+    parser.add_argument("--baseline", help="之前保存的结果文件")
+    parser.add_argument("--threshold", type=float, default=10, help="判定为性能回退的变化百分比")
+    stubs = parser.add_argument_group("stubs", "使用 --start-stubs 时桩服务的参数")
+    stubs.add_argument("--start-stubs", action="store_true", help="由本脚本启动 LLM 和数据后端桩服务")
+    stubs.add_argument("--llm-port", type=int, default=19102)
+    stubs.add_argument("--backend-port", type=int, default=19103)
+    stubs.add_argument("--script", default="sql", help="LLM 桩服务的脚本，见 bench.stub_llm.SCRIPTS")
+    stubs.add_argument("--llm-latency", type=float, default=0.3)
+    stubs.add_argument("--sql-latency", type=float, default=0.2)
+    stubs.add_argument("--rows", type=int, default=1000)
+    args = parser.parse_args()
+
+    processes = start_stubs(args) if args.start_stubs else []
+    try:
+        levels = asyncio.run(run(args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"url": args.url, "stream": args.stream, "requests": args.requests,
+                       "created": time.strftime("%Y-%m-%d %H:%M:%S"), "levels": levels},
+                      f, ensure_ascii=False, indent=2)
+    if args.baseline and compare_with_baseline(levels, args.baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+每个请求都会执行的 utils.py、client.py 辅助函数的微基准测试，按不同的输入规模测量单次调用耗时
+    convert_list_to_md_table / convert_list_to_html_table: 100 ~ 10000 行的查询结果
+    extract_json / extract_md_content: 含 <think> 块和代码块的 LLM 回答
+    build_llm_tools: 10 ~ 500 个工具的工具清单
+    extract_tool_calls: 一轮中 1 ~ 50 个工具调用，工具清单中有 100 个工具
+每个用例用 timeit 自动确定调用次数（每轮至少 0.2 秒），重复 --repeat 轮，取最快一轮和中位数的单次耗时。
+在 project 根目录下执行:
+    python -m bench.micro_bench
+    python -m bench.micro_bench --filter md_table html_table --save micro_baseline.json   # 保存基线
+    python -m bench.micro_bench --compare micro_baseline.json   # 与基线比较，出现性能回退时退出码为 1
+基线与机器相关，只在同一台机器上比较；比较使用最快一轮的耗时，受其他进程干扰最小。
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+from bench.result_format_bench import make_rows
+from client import TOOLS_CACHE, build_llm_tools, extract_tool_calls
+from utils import convert_list_to_html_table, convert_list_to_md_table, extract_json, extract_md_content
+
+
+def llm_reply_with_json(row_count: int) -> str:
+    """LLM 回答：思考过程 + 说明文字 + 包含 row_count 行数据的 JSON 代码块"""
+    data = json.dumps({"msg": "", "data": make_rows(row_count, 8)}, ensure_ascii=False)
+    return f"<think>用户需要的是各城市的销售额，需要按城市分组汇总。</think>好的，查询结果如下：\n```json\n{data}\n```\n以上为全部数据。"
+
+
+def llm_reply_with_sql(think_lines: int, with_block: bool = True) -> str:
+    """LLM 回答：think_lines 行思考过程 + SQL 代码块，with_block 为 False 时没有代码块"""
+    think = "\n".join(f"第 {i} 步，分析 orders 表中 city、amount 字段的含义以及它们与用户问题的关系。"
+                      for i in range(think_lines))
+    sql = "```sql\nSELECT city, SUM(amount) AS amount\nFROM orders\nWHERE year = 2024\nGROUP BY city\n```" \
+        if with_block else "SELECT city, SUM(amount) AS amount FROM orders GROUP BY city"
+    return f"<think>\n{think}\n</think>\n根据表结构，生成的SQL如下：\n{sql}\n"
+
+
+def make_tools(tool_count: int) -> list[dict]:
+    """MCP list_tools 返回的工具清单，每个工具的 inputSchema 与 FastMCP 生成的结构一致"""
+    return [{
+        "name": f"server{i % 4}_tool_{i}",
+        "description": f"第 {i} 个工具，获取某个数据源下某个表的结构或执行查询类SQL语句",
+        "inputSchema": {
+            "title": f"tool_{i}Arguments",
+            "type": "object",
+            "properties": {
+                "db_source": {"title": "Db Source", "type": "string"},
+                "table_name": {"title": "Table Name", "type": "string"},
+                "sql": {"title": "Sql", "type": "string"},
+                "result_format": {"default": "rows", "enum": ["rows", "columnar", "csv", "markdown"],
+                                  "title": "Result Format", "type": "string"},
+            },
+            "required": ["db_source", "table_name"],
+        },
+    } for i in range(tool_count)]
+
+
+def llm_tool_call_response(call_count: int, tools: list[dict]) -> dict:
+    """LLM 返回的 chat/completions 响应，一轮中包含 call_count 个工具调用"""
+    return {"choices": [{"index": 0, "finish_reason": "tool_calls", "message": {
+        "role": "assistant", "content": "", "tool_calls": [{
+            "id": f"call_{i}", "type": "function",
+            "function": {"name": tools[i % len(tools)]["name"],
+                         "arguments": json.dumps({"db_source": "sales", "table_name": f"t{i}",
+                                                  "sql": f"SELECT * FROM t{i} WHERE amount > 100"})},
+        } for i in range(call_count)]}}]}
+
+
+def setup_tool_calls(call_count: int) -> tuple:
+    """工具清单中有 100 个工具，直接写入 TOOLS_CACHE，避免 extract_tool_calls 访问 MCP Server"""
+    tools = make_tools(100)
+    TOOLS_CACHE["tool_server_map"] = {tool["name"]: f"server{i % 4}" for i, tool in enumerate(tools)}
+    return (llm_tool_call_response(call_count, tools),)
+
+
+# 用例名称 -> (被测函数, 输入规模, 根据规模生成参数的函数)
+CASES = {
+    "md_table": (convert_list_to_md_table, [100, 1000, 10000], lambda n: (make_rows(n, 8),)),
+    "html_table": (convert_list_to_html_table, [100, 1000, 10000], lambda n: (make_rows(n, 8),)),
+    "extract_json": (extract_json, [10, 100, 1000], lambda n: (llm_reply_with_json(n),)),
+    "extract_md_content": (extract_md_content, [10, 100, 1000], lambda n: (llm_reply_with_sql(n), "sql")),
+    "extract_md_content_miss": (extract_md_content, [10, 100, 1000],
+                                lambda n: (llm_reply_with_sql(n, with_block=False), "sql")),
+    "build_llm_tools": (build_llm_tools, [10, 100, 500], lambda n: (make_tools(n),)),
+    "extract_tool_calls": (extract_tool_calls, [1, 10, 50], setup_tool_calls),
+}
+
+
+def measure(fn, args: tuple, repeat: int) -> dict:
+    timer = timeit.Timer(lambda: fn(*args))
+    number, _ = timer.autorange()
+    per_call = [t / number * 1e6 for t in timer.repeat(repeat, number)]
+    return {"number": number, "best_us": round(min(per_call), 2), "median_us": round(statistics.median(per_call), 2)}
+
+
+def compare_with_baseline(results: dict, baseline_file: str, threshold: float) -> bool:
+    """按用例和规模与基线比较最快一轮的耗时，变慢超过 threshold（百分比）时视为性能回退"""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressed = False
+    print(f"\n与基线 {baseline_file} 比较（阈值 {threshold}%）:")
+    print(f"{'case':<32} {'baseline_us':>12} {'current_us':>12} {'change':>8}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base, current = baseline[key]["best_us"], result["best_us"]
+        change = (current - base) / base * 100 if base else 0.0
+        worse = change > threshold
+        regressed = regressed or worse
+        print(f"{key:<32} {base:>12.2f} {current:>12.2f} {change:>+7.1f}%{'  回退' if worse else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="micro benchmark for utils.py and client.py helpers")
+    parser.add_argument("--filter", nargs="*", default=[], help="只运行名称包含这些字符串的用例")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="把结果保存为 JSON 基线文件")
+    parser.add_argument("--compare", help="之前保存的基线文件")
+    parser.add_argument("--threshold", type=float, default=10, help="判定为性能回退的变慢百分比")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'case':<32} {'calls':>8} {'best_us':>12} {'median_us':>12}")
+    for name, (fn, sizes, make_args) in CASES.items():
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        for size in sizes:
+            key = f"{name}[{size}]"
+            results[key] = measure(fn, make_args(size), args.repeat)
+            print(f"{key:<32} {results[key]['number']:>8} {results[key]['best_us']:>12.2f} "
+                  f"{results[key]['median_us']:>12.2f}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.node(),
+                       "created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results},
+                      f, ensure_ascii=False, indent=2)
+    if args.compare and compare_with_baseline(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
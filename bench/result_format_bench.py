@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+对比 SQL 查询结果在不同编码格式下发送给 LLM 的字节数和 token 数
+原来的方式: 工具返回 SqlExecResult(data=[{...}, ...])，FastMCP 转换为缩进的 JSON 文本，客户端再用 str(tool_result.content) 转为字符串
+现在的方式: 客户端协商 result_format，工具返回对应编码，客户端用 format_tool_result 转为紧凑文本
+在 project 根目录下执行:
+    python -m bench.result_format_bench
+    python -m bench.result_format_bench --rows 10 100 1000 --cols 8
+token 数使用 utils.estimate_tokens 估算，只用于不同格式之间的相对比较
+"""
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+import pydantic_core
+from mcp.types import TextContent
+
+from client import format_tool_result
+from utils import RESULT_FORMATS, convert_list_to_format, estimate_tokens
+
+CITIES = ["北京", "上海", "广州", "深圳", "Hangzhou", "Chengdu"]
+
+
+def make_rows(row_count: int, col_count: int) -> list[dict]:
+    """生成包含整数、浮点数、中英文字符串和空值的测试数据"""
+    random.seed(row_count)
+    rows = []
+    for i in range(row_count):
+        row = {"id": i, "user_name": f"user_{i}", "city": random.choice(CITIES),
+               "amount": round(random.uniform(0, 10000), 2), "remark": None if i % 3 else "备注信息"}
+        for c in range(len(row), col_count):
+            row[f"metric_{c}"] = random.randint(0, 1000)
+        rows.append(row)
+    return rows
+
+
+def legacy_text(rows: list[dict]) -> str:
+    """原来发送给 LLM 的内容：str(tool_result.content)"""
+    content = [TextContent(type="text", text=pydantic_core.to_json({"msg": "", "data": rows},
+                                                                  fallback=str, indent=2).decode())]
+    return str(content)
+
+
+def negotiated_text(rows: list[dict], result_format: str) -> str:
+    """协商格式后发送给 LLM 的内容"""
+    structured = {"msg": "", "data": [], "total_rows": len(rows), "truncated": False, "next_cursor": None,
+                  "result_format": result_format}
+    structured.update(convert_list_to_format(rows, result_format))
+    return format_tool_result(SimpleNamespace(structuredContent=structured, content=[]))
+
+
+def measure(fn, *args) -> tuple[str, float]:
+    start = time.perf_counter()
+    txt = fn(*args)
+    return txt, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tool result format benchmark")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--cols", type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{'rows':>6} {'format':<10} {'bytes':>10} {'tokens':>9} {'saved_bytes':>12} {'saved_tokens':>13} {'encode_ms':>10}")
+    for row_count in args.rows:
+        rows = make_rows(row_count, args.cols)
+        legacy, cost = measure(legacy_text, rows)
+        base_bytes, base_tokens = len(legacy.encode("utf-8")), estimate_tokens(legacy)
+        print(f"{row_count:>6} {'legacy':<10} {base_bytes:>10} {base_tokens:>9} {'-':>12} {'-':>13} {cost:>10.2f}")
+        for result_format in RESULT_FORMATS:
+            txt, cost = measure(negotiated_text, rows, result_format)
+            size, tokens = len(txt.encode("utf-8")), estimate_tokens(txt)
+            print(f"{row_count:>6} {result_format:<10} {size:>10} {tokens:>9} "
+                  f"{1 - size / base_bytes:>12.1%} {1 - tokens / base_tokens:>13.1%} {cost:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+数据后端（tool_api_uri）的桩服务，用于离线压测，接口与 tools/db_query.py 访问的接口一致:
+    GET  /ds/list                      数据源列表
+    GET  /{db_source}/table/list       表清单
+    GET  /{db_source}/{table}/schema   表结构
+    POST /exec/task                    执行 SQL，返回 --rows 行数据
+响应体在启动时生成并序列化，压测时只测量网络、延迟和 MCP server 侧的处理开销。
+在 project 根目录下执行:
+    python -m bench.stub_backend --port 19103 --rows 1000 --latency 0.02 --sql-latency 0.2
+cfg.yml 中配置 api.tool_api_uri: http://127.0.0.1:19103
+"""
+
+import argparse
+import asyncio
+import json
+import random
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+CITIES = ["北京", "上海", "广州", "深圳", "Hangzhou", "Chengdu"]
+TABLES = [
+    {"name": "orders", "desc": "订单表"},
+    {"name": "customers", "desc": "客户表"},
+    {"name": "products", "desc": "商品表"},
+]
+
+
+def make_rows(row_count: int, col_count: int) -> list[dict]:
+    """生成包含整数、浮点数、中英文字符串和空值的测试数据，与 bench.result_format_bench 的数据一致"""
+    random.seed(row_count)
+    rows = []
+    for i in range(row_count):
+        row = {"id": i, "user_name": f"user_{i}", "city": random.choice(CITIES),
+               "amount": round(random.uniform(0, 10000), 2), "remark": None if i % 3 else "备注信息"}
+        for c in range(len(row), col_count):
+            row[f"metric_{c}"] = random.randint(0, 1000)
+        rows.append(row)
+    return rows
+
+
+class StubBackend:
+    """按固定数据响应数据后端接口"""
+
+    def __init__(self, rows: int, cols: int, latency: float, sql_latency: float, jitter: float):
+        self.latency = latency  # 元数据接口的延迟（秒）
+        self.sql_latency = sql_latency  # /exec/task 的延迟（秒）
+        self.jitter = jitter
+        self.requests = 0
+        self.rows_body = json.dumps(make_rows(rows, cols), ensure_ascii=False).encode("utf-8")
+
+    async def sleep(self, latency: float):
+        self.requests += 1
+        await asyncio.sleep(max(0.0, latency * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    async def db_source_list(self, request: Request):
+        await self.sleep(self.latency)
+        return JSONResponse([{"name": "sales", "desc": "销售数据库", "dialect": "mysql"}])
+
+    async def table_list(self, request: Request):
+        await self.sleep(self.latency)
+        return JSONResponse(TABLES)
+
+    async def table_schema(self, request: Request):
+        await self.sleep(self.latency)
+        db_source, table_name = request.path_params["db_source"], request.path_params["table"]
+        schema = (f"CREATE TABLE {table_name} (id BIGINT PRIMARY KEY, user_name VARCHAR(64), city VARCHAR(32), "
+                  f"amount DECIMAL(12, 2), remark VARCHAR(255))")
+        return JSONResponse({"db_name": db_source, "table_name": table_name, "schema": schema})
+
+    async def exec_task(self, request: Request):
+        data = await request.json()
+        if not data.get("sql"):
+            return JSONResponse({"error": "缺少 sql 参数"}, status_code=400)
+        await self.sleep(self.sql_latency)
+        return Response(self.rows_body, media_type="application/json")
+
+    async def stats(self, request: Request):
+        return JSONResponse({"requests": self.requests})
+
+
+def create_app(stub: StubBackend) -> Starlette:
+    return Starlette(routes=[
+        Route("/ds/list", stub.db_source_list),
+        Route("/exec/task", stub.exec_task, methods=["POST"]),
+        Route("/stats", stub.stats),
+        Route("/{db_source}/table/list", stub.table_list),
+        Route("/{db_source}/{table}/schema", stub.table_schema),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stub data backend for db_query tools")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=19103)
+    parser.add_argument("--rows", type=int, default=1000, help="/exec/task 返回的行数")
+    parser.add_argument("--cols", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="元数据接口的延迟（秒）")
+    parser.add_argument("--sql-latency", type=float, default=0.2, help="/exec/task 的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延迟的随机波动比例")
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(create_app(StubBackend(args.rows, args.cols, args.latency, args.sql_latency, args.jitter)),
+                host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
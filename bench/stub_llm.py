@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+OpenAI 兼容的 LLM 桩服务，用于离线压测 /api/query -> LLM -> MCP server.py -> tool_api_uri 的完整链路
+按脚本依次返回工具调用，最后一轮返回最终回答；支持非流式和流式（SSE）调用，延迟可配置。
+当前轮次由请求中最后一条 user 消息之后的 assistant 消息数决定，不保存任何会话状态，可以承受任意并发。
+脚本中的工具名称是 MCP 工具名（例如 execute_sql_query），按请求 tools 中的 server{N}_{工具名} 匹配。
+在 project 根目录下执行:
+    python -m bench.stub_llm --port 19102 --latency 0.3 --jitter 0.2 --script sql
+    python -m bench.stub_llm --script-file my_script.json   # 自定义脚本，格式同 SCRIPTS 中的一项
+cfg.yml 中配置 api.llm_api_uri: http://127.0.0.1:19102/v1
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# 每一项是一轮 LLM 返回：tool_calls 为本轮的工具调用（同一轮多个调用由客户端并发执行），content 为最终回答
+SCRIPTS = {
+    # 不调用工具，直接回答，只测量 Web 接口和 LLM 调用本身
+    "direct": [
+        {"content": "这是一个不需要查询数据的问题的回答。"},
+    ],
+    # 典型的问数流程：数据源 -> 表清单 -> 表结构 -> 执行 SQL -> 回答
+    "sql": [
+        {"tool_calls": [{"name": "list_available_db_source", "arguments": {}}]},
+        {"tool_calls": [{"name": "list_available_tables", "arguments": {"db_source": "sales"}}]},
+        {"tool_calls": [{"name": "get_table_schema", "arguments": {"db_source": "sales", "table_name": "orders"}}]},
+        {"tool_calls": [{"name": "execute_sql_query",
+                         "arguments": {"sql": "SELECT city, SUM(amount) AS amount FROM orders GROUP BY city"}}]},
+        {"content": "去年各城市的销售额已经统计完成，北京最高，上海次之。"},
+    ],
+    # 同一轮中并发调用多个工具
+    "parallel": [
+        {"tool_calls": [{"name": "get_table_schema", "arguments": {"db_source": "sales", "table_name": f"t{i}"}}
+                        for i in range(4)]},
+        {"tool_calls": [{"name": "execute_sql_query", "arguments": {"sql": f"SELECT * FROM t{i}"}}
+                        for i in range(4)]},
+        {"content": "4 个表的数据已经汇总完成。"},
+    ],
+}
+
+
+class StubLLM:
+    """按脚本生成 chat/completions 响应"""
+
+    def __init__(self, script: list[dict], latency: float, jitter: float, chunk_delay: float):
+        self.script = script
+        self.latency = latency  # 每次调用的基础延迟（秒），流式调用时为首个分片之前的延迟
+        self.jitter = jitter  # 延迟的随机波动比例，0.2 表示 ±20%
+        self.chunk_delay = chunk_delay  # 流式调用时分片之间的间隔（秒）
+        self.requests = 0
+
+    def delay(self) -> float:
+        return max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def next_turn(self, messages: list[dict]) -> tuple[int, dict]:
+        last_user = max((i for i, message in enumerate(messages) if message.get("role") == "user"), default=-1)
+        step = sum(1 for message in messages[last_user + 1:] if message.get("role") == "assistant")
+        return step, self.script[min(step, len(self.script) - 1)]
+
+    @staticmethod
+    def resolve_tool_calls(step: int, turn: dict, tools: list[dict]) -> list[dict] | None:
+        """把脚本中的工具名换成请求 tools 中的唯一名称，找不到时返回 None"""
+        names = [tool["function"]["name"] for tool in tools or []]
+        tool_calls = []
+        for i, call in enumerate(turn["tool_calls"]):
+            name = next((n for n in names if n == call["name"] or n.endswith(f"_{call['name']}")), None)
+            if name is None:
+                return None
+            tool_calls.append({
+                "id": f"call_{step}_{i}",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(call["arguments"], ensure_ascii=False)},
+            })
+        return tool_calls
+
+    def build_message(self, data: dict) -> tuple[dict, str]:
+        step, turn = self.next_turn(data.get("messages") or [])
+        if "tool_calls" in turn:
+            tool_calls = self.resolve_tool_calls(step, turn, data.get("tools"))
+            if tool_calls:
+                return {"role": "assistant", "content": "", "function_call": None, "tool_calls": tool_calls}, "tool_calls"
+            missing = [call["name"] for call in turn["tool_calls"]]
+            return {"role": "assistant", "content": f"没有可用的工具 {missing}"}, "stop"
+        return {"role": "assistant", "content": turn["content"]}, "stop"
+
+    async def chat_completions(self, request: Request):
+        data = await request.json()
+        self.requests += 1
+        message, finish_reason = self.build_message(data)
+        if data.get("stream"):
+            return StreamingResponse(self.stream(data, message, finish_reason), media_type="text/event-stream")
+        await asyncio.sleep(self.delay())
+        return JSONResponse({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": data.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": finish_reason, "message": message}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    async def stream(self, data: dict, message: dict, finish_reason: str):
+        await asyncio.sleep(self.delay())
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk", "model": data.get("model", "stub")}
+
+        def chunk(delta: dict, finish: str | None = None) -> str:
+            return "data: " + json.dumps({**base, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]},
+                                         ensure_ascii=False) + "\n\n"
+
+        content = message.get("content") or ""
+        # 文本按每 8 个字符一个分片返回，模拟逐 token 生成
+        for i in range(0, len(content), 8):
+            yield chunk({"content": content[i:i + 8]} if i else {"role": "assistant", "content": content[i:i + 8]})
+            await asyncio.sleep(self.chunk_delay)
+        for index, tool_call in enumerate(message.get("tool_calls") or []):
+            arguments = tool_call["function"]["arguments"]
+            half = len(arguments) // 2
+            # 与真实 LLM 一样，id、name 只在第一个分片中出现，arguments 分段返回
+            yield chunk({"tool_calls": [{"index": index, "id": tool_call["id"], "type": "function",
+                                         "function": {"name": tool_call["function"]["name"], "arguments": arguments[:half]}}]})
+            await asyncio.sleep(self.chunk_delay)
+            yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[half:]}}]})
+        yield chunk({}, finish_reason)
+        yield "data: [DONE]\n\n"
+
+    async def stats(self, request: Request):
+        return JSONResponse({"requests": self.requests})
+
+
+def create_app(stub: StubLLM) -> Starlette:
+    return Starlette(routes=[
+        Route("/v1/chat/completions", stub.chat_completions, methods=["POST"]),
+        Route("/chat/completions", stub.chat_completions, methods=["POST"]),
+        Route("/stats", stub.stats),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stub OpenAI-compatible LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=19102)
+    parser.add_argument("--script", choices=sorted(SCRIPTS), default="sql")
+    parser.add_argument("--script-file", help="JSON 文件，内容为与 SCRIPTS 中的一项格式相同的列表，优先于 --script")
+    parser.add_argument("--latency", type=float, default=0.3, help="每次调用的基础延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延迟的随机波动比例")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="流式调用时分片之间的间隔（秒）")
+    args = parser.parse_args()
+
+    script = SCRIPTS[args.script]
+    if args.script_file:
+        with open(args.script_file, encoding="utf-8") as f:
+            script = json.load(f)
+    import uvicorn
+    uvicorn.run(create_app(StubLLM(script, args.latency, args.jitter, args.chunk_delay)),
+                host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 /bin/bash -c 'source ../llm_py_env/bin/activate'
 # for start application in docker container
 MODULE="${MODULE_NAME:-http_mcp}"
+# WEB_MODE=asgi 时使用 uvicorn 运行全异步的 asgi_mcp，否则使用 gunicorn 多线程运行 Flask 应用
+WEB_MODE="${WEB_MODE:-wsgi}"
 MCP_SERVER='server.py'
 
 echo "start ${MCP_SERVER} ..."
@@ -14,4 +16,10 @@ fi
 echo "Server started successfully with PID: $!"
 echo "start module: ${MODULE}"
 echo "current dir `pwd`"
-/opt/llm_py_env/bin/gunicorn --certfile ./cert/srv.crt --keyfile ./cert/srv.key --timeout 240 -w 1 --threads 8 -b 0.0.0.0:19000 ${MODULE}:app
+if [ "${WEB_MODE}" = "asgi" ]; then
+    echo "start asgi_mcp with uvicorn"
+    /opt/llm_py_env/bin/uvicorn --ssl-certfile ./cert/srv.crt --ssl-keyfile ./cert/srv.key --timeout-keep-alive 240 \
+        --host 0.0.0.0 --port 19000 asgi_mcp:app
+else
+    /opt/llm_py_env/bin/gunicorn --certfile ./cert/srv.crt --keyfile ./cert/srv.key --timeout 240 -w 1 --threads 8 -b 0.0.0.0:19000 ${MODULE}:app
+fi
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+上游服务熔断器
+
+每个上游（LLM API、tool_api_uri 数据后端、每个 MCP Server）一个熔断器：
+- closed: 正常放行，连续失败 failure_threshold 次后进入 open
+- open: 直接抛出 CircuitOpenError 快速失败，不占用线程等待超时，recovery_timeout 秒后进入 half_open
+- half_open: 最多放行 half_open_max_calls 个探测请求，成功则恢复 closed，失败则重新 open
+
+配置读取自 cfg.yml 的 circuit_breaker 段，未配置时使用默认值:
+    circuit_breaker:
+        failure_threshold: 5
+        recovery_timeout: 30
+        half_open_max_calls: 1
+        health_fail_when_open: false
+"""
+
+import contextlib
+import logging.config
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+from urllib.parse import urlparse
+
+import metrics
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+DEFAULT_BREAKER_CFG = {
+    "failure_threshold": 5,
+    "recovery_timeout": 30,
+    "half_open_max_calls": 1,
+    "health_fail_when_open": False,
+}
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器处于打开状态，请求未发出直接失败"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"上游服务 {name} 不可用（熔断中），{retry_in:.0f} 秒后重试")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """单个上游服务的熔断器"""
+
+    def __init__(self, name: str,
+            failure_threshold: int = 5,
+            recovery_timeout: float = 30,
+            half_open_max_calls: int = 1,
+            is_failure: Callable[[BaseException], bool] | None = None):
+        self.name = name
+        self.failure_threshold = failure_threshold  # 连续失败多少次后熔断
+        self.recovery_timeout = recovery_timeout  # 熔断多少秒后进入半开状态，放行探测请求
+        self.half_open_max_calls = half_open_max_calls  # 半开状态下同时放行的探测请求数
+        self.is_failure = is_failure  # 判断异常是否说明上游不健康，为空时所有异常都算失败
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self.total_rejected = 0
+        self.total_opened = 0
+        self.last_error = ""
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"circuit_breaker_state_change {self.name}: {self.state} -> {state}, last_error={self.last_error}")
+            self.state = state
+
+    def before_call(self):
+        """请求前调用，熔断中时抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == STATE_OPEN:
+                retry_in = self.opened_at + self.recovery_timeout - time.monotonic()
+                if retry_in > 0:
+                    self.total_rejected += 1
+                    raise CircuitOpenError(self.name, retry_in)
+                self._set_state(STATE_HALF_OPEN)
+                self.half_open_calls = 0
+            if self.state == STATE_HALF_OPEN:
+                if self.half_open_calls >= self.half_open_max_calls:
+                    self.total_rejected += 1
+                    raise CircuitOpenError(self.name, self.recovery_timeout)
+                self.half_open_calls += 1
+
+    def allows_request(self) -> bool:
+        """不改变状态，判断现在发出的请求是否会被放行，用于负载均衡时跳过熔断中的副本"""
+        with self._lock:
+            if self.state == STATE_OPEN:
+                return self.opened_at + self.recovery_timeout <= time.monotonic()
+            if self.state == STATE_HALF_OPEN:
+                return self.half_open_calls < self.half_open_max_calls
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state == STATE_HALF_OPEN:
+                self.half_open_calls = max(0, self.half_open_calls - 1)
+            self._set_state(STATE_CLOSED)
+
+    def release_probe(self):
+        with self._lock:
+            if self.state == STATE_HALF_OPEN:
+                self.half_open_calls = max(0, self.half_open_calls - 1)
+
+    def record_failure(self, e: BaseException):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_error = str(e)[:200]
+            if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.half_open_calls = 0
+                self.total_opened += 1
+                self._set_state(STATE_OPEN)
+
+    @contextlib.contextmanager
+    def track(self):
+        """
+        包裹一次对上游的请求，根据结果更新熔断器状态
+        不说明上游不健康的异常（例如 4xx）按成功处理，同步、异步代码中都可以使用
+        """
+        try:
+            self.before_call()
+        except CircuitOpenError:
+            metrics.UPSTREAM_REQUESTS.inc(upstream=self.name, result="rejected")
+            raise
+        try:
+            yield
+        except Exception as e:
+            if self.is_failure is None or self.is_failure(e):
+                self.record_failure(e)
+                metrics.UPSTREAM_REQUESTS.inc(upstream=self.name, result="failure")
+            else:
+                self.record_success()
+                metrics.UPSTREAM_REQUESTS.inc(upstream=self.name, result="error")
+            raise
+        except BaseException:
+            # 请求被取消，不能说明上游的状态，只归还半开状态下的探测名额
+            self.release_probe()
+            metrics.UPSTREAM_REQUESTS.inc(upstream=self.name, result="cancelled")
+            raise
+        self.record_success()
+        metrics.UPSTREAM_REQUESTS.inc(upstream=self.name, result="success")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "total_opened": self.total_opened,
+                "total_rejected": self.total_rejected,
+                "last_error": self.last_error,
+            }
+
+
+_lock = threading.Lock()
+_breakers: dict[str, CircuitBreaker] = {}
+_breaker_cfg: dict | None = None
+
+
+def get_breaker_cfg() -> dict:
+    """读取 cfg.yml 中的 circuit_breaker 配置，与默认值合并"""
+    global _breaker_cfg
+    if _breaker_cfg is None:
+        breaker_cfg = dict(DEFAULT_BREAKER_CFG)
+        if os.path.exists(cfg_file_path):
+            breaker_cfg.update(init_yml_cfg().get("circuit_breaker") or {})
+        _breaker_cfg = breaker_cfg
+    return _breaker_cfg
+
+
+def get_breaker(name: str, is_failure: Callable[[BaseException], bool] | None = None) -> CircuitBreaker:
+    """按上游名称获取熔断器，不存在时创建"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker_cfg = get_breaker_cfg()
+                breaker = CircuitBreaker(name,
+                                         failure_threshold=breaker_cfg["failure_threshold"],
+                                         recovery_timeout=breaker_cfg["recovery_timeout"],
+                                         half_open_max_calls=breaker_cfg["half_open_max_calls"],
+                                         is_failure=is_failure)
+                _breakers[name] = breaker
+    return breaker
+
+
+def upstream_name(uri: str) -> str:
+    """HTTP 上游按 scheme://host:port 区分"""
+    parsed = urlparse(uri)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def breaker_states() -> dict:
+    """所有熔断器的状态，用于健康检查接口"""
+    return {name: breaker.snapshot() for name, breaker in list(_breakers.items())}
+
+
+def health_status() -> tuple[dict, int]:
+    """
+    健康检查接口的返回内容和 HTTP 状态码
+    有熔断器处于 open 状态时 status 为 degraded；配置 health_fail_when_open 时同时返回 503，便于负载均衡摘除节点
+    """
+    states = breaker_states()
+    degraded = any(state["state"] == STATE_OPEN for state in states.values())
+    status_code = 503 if degraded and get_breaker_cfg()["health_fail_when_open"] else 200
+    return {"status": "degraded" if degraded else "healthy", "circuit_breakers": states}, status_code
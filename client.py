@@ -11,20 +11,31 @@ import asyncio
 from datetime import datetime, timedelta
 import json
 import logging.config
-from typing import Any, Generator
+import os
+import time
+from typing import Any, AsyncGenerator, Coroutine, Generator
 from urllib.parse import urlparse
 
 import httpx
-from mcp import ClientSession
-from mcp.client.streamable_http import streamablehttp_client
-from sys_init import init_yml_cfg
-from utils import post_with_retry, build_curl_cmd
+from aio_loop import MODE_PER_CALL, get_mode, iterate_sync, run_sync, submit
+from circuit_breaker import CircuitBreaker, CircuitOpenError, get_breaker
+from context_budget import get_context_budget
+from tool_index import DEFAULT_TOOL_TOP_K, select_tools
+from ttl_cache import SingleFlight
+from mcp_pool import MCPSessionPool, is_connection_error, is_request_not_sent
+from retry_policy import RetryPolicy, get_default_policy
+from server_registry import LogicalServer, ServerRegistry, get_registry_cfg
+from sys_init import cfg_file_path, init_yml_cfg
+from log_utils import Payload
+import metrics
+import tracing
+from utils import async_post_stream, async_post_with_retry, post_with_retry, build_curl_cmd
 
 # 配置日志
 logging.config.fileConfig('logging.conf', encoding="utf-8")
 logger = logging.getLogger(__name__)
 
-# 给出多个可用的 MCP 服务器地址
+# 给出多个可用的 MCP 服务器地址，cfg.yml 中配置了 mcp_registry.servers 时以配置为准，见 server_registry.py
 MCP_SERVER_ADDR_LIST = [
     "https://localhost:19001/mcp",
 ]
@@ -36,9 +47,55 @@ TOOLS_CACHE = {
     "last_updated": None
 }
 
-# 缓存有效期（分钟）
+# 每个逻辑 MCP Server 的工具缓存 {server_name: {"tools": [...], "last_updated": datetime, "last_error": str}}
+# 同一逻辑服务器的多个副本提供相同的工具，只获取一次；TOOLS_CACHE 是按服务器顺序合并后的结果，
+# tool_server_map 中的值为逻辑服务器名称，调用时再由负载均衡选择副本
+SERVER_TOOLS_CACHE: dict[str, dict] = {}
+
+# 缓存有效期（分钟），每个服务器单独计算
 CACHE_EXPIRY_MINUTES = 30
 
+# 工具发现的并发去重
+discovery_flight = SingleFlight("tool_discovery")
+
+# 定时后台刷新工具列表的周期（秒，默认值，可在 cfg.yml 的 client.tools_refresh_interval 中配置）
+TOOLS_REFRESH_INTERVAL_SECONDS = 300
+
+# 同一服务器两次强制刷新（LLM 返回了未知的工具名称）之间的最小间隔（秒）
+FORCE_REFRESH_MIN_INTERVAL_SECONDS = 30
+
+# 后台刷新任务的引用，避免任务在完成前被垃圾回收
+_refresh_tasks: set[asyncio.Task] = set()
+_refresher_futures: list = []
+_refresher_pid: int | None = None
+
+# 同一轮对话中并发执行的工具调用数量上限（默认值，可在 cfg.yml 的 client.tool_fanout 中配置）
+DEFAULT_TOOL_FANOUT = 4
+
+# 表格类工具结果的编码格式（默认值，可在 cfg.yml 的 client.tool_result_format 中配置），可选值见 utils.RESULT_FORMATS
+# 工具的 inputSchema 中声明了 result_format 参数时才会传入
+DEFAULT_TOOL_RESULT_FORMAT = "csv"
+
+
+# MCP 会话池的默认配置，可在 cfg.yml 的 client 段中覆盖
+# 会话池按工作进程、按 MCP Server 地址限制同时使用的会话数；Web 服务同时处理多个对话，每个对话最多并发 tool_fanout 个工具调用，
+# 默认值按每个工作进程约 8 个并发对话 × tool_fanout 4 估算，超出时排队等待 acquire_timeout 秒
+DEFAULT_SESSION_POOL_CFG = {
+    "pool_max_size": 32,
+    "pool_max_idle_seconds": 60,
+    "pool_max_lifetime_seconds": 1800,
+    "acquire_timeout": 60,
+}
+
+
+def get_session_pool_cfg() -> dict:
+    """读取 cfg.yml client 段中会话池相关的配置，与默认值合并"""
+    pool_cfg = dict(DEFAULT_SESSION_POOL_CFG)
+    if os.path.exists(cfg_file_path):
+        client_cfg = init_yml_cfg().get("client") or {}
+        pool_cfg.update({key: client_cfg[key] for key in DEFAULT_SESSION_POOL_CFG if key in client_cfg})
+    return pool_cfg
+
 
 # 配置选项
 class MCPClientConfig:
@@ -48,11 +105,23 @@ class MCPClientConfig:
             verify_https: bool = True,
             http_timeout: int = 30,
             sse_timeout: int = 300,
-            max_retries: int = 3):
+            max_retries: int = 3,
+            pool_max_size: int = 32,
+            pool_max_idle_seconds: int = 60,
+            pool_max_lifetime_seconds: int = 1800,
+            acquire_timeout: int = 60,
+            keepalive_expiry: int = 60,
+            discovery_timeout: int = 10):
         self.verify_https = verify_https  # 是否验证 HTTPS 证书
         self.http_timeout = http_timeout  # HTTP 超时时间（秒）
         self.sse_timeout = sse_timeout  # SSE 超时时间（秒）
         self.max_retries = max_retries  # 最大重试次数
+        self.pool_max_size = pool_max_size  # 每个 MCP 服务器最多保持的会话数
+        self.pool_max_idle_seconds = pool_max_idle_seconds  # 会话空闲超过该时间，复用前先 ping 检查
+        self.pool_max_lifetime_seconds = pool_max_lifetime_seconds  # 会话最长存活时间（秒）
+        self.acquire_timeout = acquire_timeout  # 会话都在使用中时，等待可用会话的最长时间（秒）
+        self.keepalive_expiry = keepalive_expiry  # HTTP keep-alive 连接空闲保持时间（秒）
+        self.discovery_timeout = discovery_timeout  # 从单个服务器获取工具列表的超时时间（秒）
 
 # 使用配置创建客户端工厂
 def create_http_client_factory(config: MCPClientConfig):
@@ -71,6 +140,8 @@ def create_http_client_factory(config: MCPClientConfig):
 
         return httpx.AsyncClient(
             verify=verify,
+            limits=httpx.Limits(max_keepalive_connections=config.pool_max_size,
+                                keepalive_expiry=config.keepalive_expiry),
             **kwargs
         )
 
@@ -80,9 +151,33 @@ client_config = MCPClientConfig(
     verify_https=False,  # 开发环境禁用 SSL 验证
     http_timeout=30,
     sse_timeout=300,
-    max_retries=3
+    max_retries=3,
+    **get_session_pool_cfg()
 )
 
+# MCP 会话池，所有工具发现和工具调用共用
+mcp_session_pool = MCPSessionPool(
+    create_http_client_factory(client_config),
+    max_size=client_config.pool_max_size,
+    max_idle_seconds=client_config.pool_max_idle_seconds,
+    max_lifetime_seconds=client_config.pool_max_lifetime_seconds,
+    acquire_timeout=client_config.acquire_timeout,
+    http_timeout=client_config.http_timeout,
+    sse_timeout=client_config.sse_timeout,
+)
+
+_server_registry: ServerRegistry | None = None
+
+
+def get_server_registry() -> ServerRegistry:
+    """MCP Server 注册表，首次使用时从 cfg.yml 的 mcp_registry 段加载"""
+    global _server_registry
+    if _server_registry is None:
+        _server_registry = ServerRegistry.from_cfg(get_registry_cfg(), MCP_SERVER_ADDR_LIST, breaker_for=get_mcp_breaker)
+        logger.info(f"mcp_server_registry_loaded {[(server.name, len(server.replicas)) for server in _server_registry.servers]}")
+    return _server_registry
+
+
 def get_tool_unique_name(server_index: int, tool_name: str) -> str:
     """为工具生成唯一名称，避免不同服务器的同名工具冲突"""
     return f"server{server_index}_{tool_name}"
@@ -93,76 +188,322 @@ def get_tool_call_name(unique_name: str) -> str:
     return unique_name.split('_', 1)[1]
 
 
-async def async_get_available_tools(force_refresh: bool = False) -> list:
+def is_server_tools_fresh(entry: dict | None, current_time: datetime, max_age_minutes: float = CACHE_EXPIRY_MINUTES) -> bool:
+    return bool(entry and entry["last_updated"] and not entry["invalidated"]
+                and (current_time - entry["last_updated"]) < timedelta(minutes=max_age_minutes))
+
+
+def new_server_tools_entry() -> dict:
+    return {"tools": [], "last_updated": None, "last_error": None, "last_attempt": None, "invalidated": False,
+            "refreshing": False}
+
+
+async def async_fetch_server_tools(index: int, server: LogicalServer) -> dict:
     """
-    从所有MCP Server获取可用的工具列表，支持缓存
+    获取单个逻辑 MCP Server 的工具列表，更新该服务器的缓存条目
+    由负载均衡选择一个副本获取，失败时换一个副本再试一次
+    都失败时保留该服务器上一次成功获取的工具列表（last-good snapshot），只记录错误
     """
-    global TOOLS_CACHE
+    entry = SERVER_TOOLS_CACHE.setdefault(server.name, new_server_tools_entry())
+    entry["last_attempt"] = time.monotonic()
+    entry["refreshing"] = True
+    try:
+        return await _async_fetch_server_tools(index, server, entry)
+    finally:
+        entry["refreshing"] = False
 
-    # 检查缓存是否有效
-    current_time = datetime.now()  # 使用正确的datetime.now()
-    if (not force_refresh and TOOLS_CACHE["last_updated"] and
-            (current_time - TOOLS_CACHE["last_updated"]) < timedelta(minutes=CACHE_EXPIRY_MINUTES)):
-        logger.info(f"使用缓存的工具列表，总共{len(TOOLS_CACHE["tools"])}个tool, 最后更新于 {TOOLS_CACHE['last_updated']}")
-        return TOOLS_CACHE["tools"]
 
+async def _async_fetch_server_tools(index: int, server: LogicalServer, entry: dict) -> dict:
+    registry = get_server_registry()
+    tried = set()
+    for _ in range(min(2, len(server.replicas))):
+        replica = registry.pick(server, tried)
+        tried.add(replica.addr)
+        try:
+            with get_mcp_breaker(replica.addr).track(), replica.track():
+                tools_resp = await asyncio.wait_for(mcp_session_pool.list_tools(replica.addr),
+                                                    client_config.discovery_timeout)
+        except CircuitOpenError as e:
+            logger.warning(f"跳过服务器 {replica.addr}: {e}")
+            entry["last_error"] = str(e)
+            continue
+        except Exception as e:
+            logger.exception(f"连接服务器 {replica.addr} 失败，保留上次获取的 {len(entry['tools'])} 个工具")
+            while isinstance(e, BaseExceptionGroup) and e.exceptions:
+                e = e.exceptions[0]
+            entry["last_error"] = f"{replica.addr} {type(e).__name__}: {e}"
+            continue
+        logger.info(f"从服务器 {index}[{server.name}@{replica.addr}] 获取到 {len(tools_resp.tools)} 个工具")
+        entry["tools"] = [{
+            "name": get_tool_unique_name(index, tool.name),
+            "title": tool.title,
+            "description": tool.description,
+            "inputSchema": tool.inputSchema,
+            "outputSchema": tool.outputSchema,
+            "annotations": tool.annotations,
+            "meta": tool.meta,
+            "server": server.name
+        } for tool in tools_resp.tools]
+        entry["last_updated"] = datetime.now()
+        entry["last_error"] = None
+        entry["invalidated"] = False
+        break
+    return entry
+
+
+def rebuild_tools_cache():
+    """按服务器顺序合并各服务器的缓存条目，生成 TOOLS_CACHE"""
     all_tools = []
     tool_server_map = {}
+    for server in get_server_registry().servers:
+        entry = SERVER_TOOLS_CACHE.get(server.name)
+        if not entry:
+            continue
+        for tool in entry["tools"]:
+            all_tools.append(tool)
+            tool_server_map[tool["name"]] = server.name
+    TOOLS_CACHE["tools"] = all_tools
+    TOOLS_CACHE["tool_server_map"] = tool_server_map
+    TOOLS_CACHE["last_updated"] = datetime.now()
+
+
+async def async_refresh_servers(servers: list[tuple[int, LogicalServer]]):
+    """并发刷新指定服务器的工具列表，同一服务器同时只有一个刷新请求，其余请求等待并共享结果"""
+    if not servers:
+        return
+    await asyncio.gather(*(discovery_flight.ado(server.name, lambda i=index, srv=server: async_fetch_server_tools(i, srv))
+                           for index, server in servers))
+    rebuild_tools_cache()
+    failed = [name for name, entry in SERVER_TOOLS_CACHE.items() if entry["last_error"]]
+    logger.info(f"总共获取到 {len(TOOLS_CACHE['tools'])} 个工具，已缓存，刷新 {len(servers)} 个服务器，失败的服务器 {failed}")
 
-    for index, server_addr in enumerate(MCP_SERVER_ADDR_LIST):
+
+def schedule_tools_refresh(servers: list[tuple[int, LogicalServer]]):
+    """在当前事件循环中后台刷新工具列表，不阻塞调用方"""
+    if not servers:
+        return
+    task = asyncio.get_running_loop().create_task(async_refresh_servers(servers))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+def can_force_refresh(entry: dict | None, now: float) -> bool:
+    """强制刷新限流：同一服务器在 FORCE_REFRESH_MIN_INTERVAL_SECONDS 内只强制刷新一次"""
+    return not entry or entry["last_attempt"] is None or now - entry["last_attempt"] >= FORCE_REFRESH_MIN_INTERVAL_SECONDS
+
+
+async def async_get_available_tools(force_refresh: bool = False) -> list:
+    """
+    从所有MCP Server获取可用的工具列表，支持缓存
+    每个服务器单独缓存、单独过期，一个服务器不可用不会阻塞其他服务器，也不会清空其他服务器的工具
+    - 从未获取过的服务器（进程刚启动）在当前请求中并发获取，带各自的超时时间
+    - 已过期的服务器继续使用旧的工具列表，同时在后台刷新（stale-while-revalidate）
+    - force_refresh 用于 LLM 返回了未知工具名称的场景，同一服务器在限流间隔内只会被强制刷新一次
+    """
+    current_time = datetime.now()
+    now = time.monotonic()
+    inline, background = [], []
+    for index, server in enumerate(get_server_registry().servers):
+        entry = SERVER_TOOLS_CACHE.get(server.name)
+        if not entry or entry["last_attempt"] is None or (entry["last_updated"] is None and entry["refreshing"]):
+            # 从未获取成功、且后台正在获取（例如进程启动时的首次刷新）时，等待并共享这次获取的结果
+            inline.append((index, server))
+        elif force_refresh:
+            if can_force_refresh(entry, now):
+                inline.append((index, server))
+            else:
+                logger.info(f"force_refresh_rate_limited {server.name}, last attempt {now - entry['last_attempt']:.1f}s ago")
+        elif not is_server_tools_fresh(entry, current_time) and can_force_refresh(entry, now):
+            background.append((index, server))
+
+    if get_mode() == MODE_PER_CALL:
+        # per_call 模式下事件循环随请求结束而关闭，后台任务会被取消，只能在请求中刷新
+        inline += background
+        background = []
+    await async_refresh_servers(inline)
+    if background:
+        logger.info(f"使用过期的工具列表，后台刷新 {[server.name for _, server in background]}")
+        schedule_tools_refresh(background)
+    if not inline:
+        logger.info(f"使用缓存的工具列表，总共{len(TOOLS_CACHE['tools'])}个tool, 最后更新于 {TOOLS_CACHE['last_updated']}")
+    return TOOLS_CACHE["tools"]
+
+
+def on_tools_list_changed(server_addr: str):
+    """
+    MCP Server 发送 notifications/tools/list_changed 时由会话池回调，
+    在后台立即刷新该服务器的工具列表，不受强制刷新的限流限制
+    """
+    registry = get_server_registry()
+    server = registry.server_of(server_addr)
+    if server is None:
+        return
+    entry = SERVER_TOOLS_CACHE.setdefault(server.name, new_server_tools_entry())
+    entry["invalidated"] = True
+    logger.info(f"tools_list_changed from {server.name}@{server_addr}, refresh in background")
+    schedule_tools_refresh([(registry.index_of(server.name), server)])
+
+
+mcp_session_pool.on_tools_list_changed = on_tools_list_changed
+
+
+async def async_tools_refresher(interval: float = TOOLS_REFRESH_INTERVAL_SECONDS):
+    """
+    定时在后台刷新工具列表，启动时先获取一次
+    在缓存过期前 interval 秒提前刷新（refresh-ahead），获取失败的服务器每个周期重试一次，
+    使用户请求基本不会遇到过期或缺失的工具列表
+    """
+    logger.info(f"tools_refresher_started, interval={interval}s")
+    while True:
+        current_time = datetime.now()
+        max_age_minutes = max(0.0, CACHE_EXPIRY_MINUTES - interval / 60)
+        due = [(index, server) for index, server in enumerate(get_server_registry().servers)
+               if not is_server_tools_fresh(SERVER_TOOLS_CACHE.get(server.name), current_time, max_age_minutes)]
         try:
-            async with streamablehttp_client(url=server_addr, timeout=30, httpx_client_factory=create_http_client_factory(client_config)) as (read, write, _):
-                async with ClientSession(read, write) as session:
-                    await session.initialize()
-                    tools_resp = await session.list_tools()
-                    logger.info(f"从服务器 {index}[{server_addr}] 获取到 {len(tools_resp.tools)} 个工具")
-                    for tool in tools_resp.tools:
-                        unique_name = get_tool_unique_name(index, tool.name)
-                        tool_server_map[unique_name] = server_addr
-                        all_tools.append({
-                            "name": unique_name,
-                            "title": tool.title,
-                            "description": tool.description,
-                            "inputSchema": tool.inputSchema,
-                            "outputSchema": tool.outputSchema,
-                            "annotations": tool.annotations,
-                            "meta": tool.meta,
-                            "server": server_addr
-                        })
-        except Exception as e:
-            logger.exception(f"连接服务器 {server_addr} 失败")
-            continue
+            await async_refresh_servers(due)
+        except Exception:
+            logger.exception("tools_refresher_error")
+        await asyncio.sleep(interval)
+
+
+def get_tools_refresh_interval(cfg: dict) -> float:
+    """读取 cfg.yml 中 client.tools_refresh_interval，为 0 时不启动定时刷新"""
+    return float((cfg.get("client") or {}).get("tools_refresh_interval", TOOLS_REFRESH_INTERVAL_SECONDS))
+
+
+def background_refresh_coros(cfg: dict) -> list[Coroutine]:
+    """需要在后台常驻运行的协程：定时刷新工具列表、副本健康检查"""
+    coros = []
+    interval = get_tools_refresh_interval(cfg)
+    if interval > 0:
+        coros.append(async_tools_refresher(interval))
+    registry = get_server_registry()
+    if registry.health_check_interval > 0 and any(len(server.replicas) > 1 for server in registry.servers):
+        coros.append(registry.health_checker())
+    return coros
+
+
+def start_background_refresh(cfg: dict):
+    """在后台事件循环中启动定时刷新和健康检查（供 http_mcp 等同步应用使用），每个进程只启动一次"""
+    global _refresher_futures, _refresher_pid
+    if get_mode() == MODE_PER_CALL:
+        return
+    if _refresher_pid == os.getpid() and any(not future.done() for future in _refresher_futures):
+        return
+    _refresher_futures = [submit(coro) for coro in background_refresh_coros(cfg)]
+    _refresher_pid = os.getpid()
+
+
+def tools_cache_status() -> dict:
+    """各逻辑 MCP Server 工具缓存和副本的状态，用于健康检查接口"""
+    replicas = get_server_registry().status()
+    return {server_name: {
+        "tools": len(entry["tools"]),
+        "last_updated": entry["last_updated"].isoformat() if entry["last_updated"] else None,
+        "last_error": entry["last_error"],
+        "replicas": replicas.get(server_name, {}),
+    } for server_name, entry in list(SERVER_TOOLS_CACHE.items())}
+
+
+_mcp_retry_policy: RetryPolicy | None = None
+
+# SQL 查询结果的游标只存在于执行查询的 MCP Server 副本中，逻辑服务器有多个副本时，
+# 客户端在工具结果的 next_cursor 前加上副本标记（<副本标记>~<游标>），获取后续数据时路由回该副本
+CURSOR_REPLICA_SEP = "~"
+
+
+def tag_cursors(value: Any, tag: str):
+    """给工具结果（structuredContent）中的 next_cursor 加上副本标记，批量工具的结果列表中的游标也会处理"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "next_cursor" and isinstance(item, str) and item:
+                value[key] = f"{tag}{CURSOR_REPLICA_SEP}{item}"
+            else:
+                tag_cursors(item, tag)
+    elif isinstance(value, list):
+        for item in value:
+            tag_cursors(item, tag)
+
+
+def split_cursor(cursor: str) -> tuple[str | None, str]:
+    """拆分带副本标记的游标，返回 (副本标记, MCP Server 发出的原始游标)，没有标记时副本标记为 None"""
+    tag, sep, raw_cursor = cursor.partition(CURSOR_REPLICA_SEP)
+    return (tag, raw_cursor) if sep else (None, cursor)
+
+
+def is_mcp_server_failure(e: BaseException) -> bool:
+    """熔断器使用的失败判断：连接失败或超时说明 MCP Server 不健康，工具本身返回的错误不计入"""
+    return is_connection_error(e) or isinstance(e, (httpx.TimeoutException, TimeoutError))
+
+
+def get_mcp_breaker(server_addr: str) -> CircuitBreaker:
+    """每个 MCP Server 一个熔断器"""
+    return get_breaker(f"mcp {server_addr}", is_failure=is_mcp_server_failure)
+
+
+def is_mcp_call_retryable(e: BaseException) -> bool:
+    """
+    工具调用不一定是幂等的，只在确定请求没有发送到 MCP Server 时重试（连接失败、会话流已关闭），
+    读超时、读取响应时连接断开（ReadError、RemoteProtocolError、CONNECTION_CLOSED）时服务端可能已经执行了工具，不重试
+    """
+    return is_request_not_sent(e)
 
-    # 更新缓存
-    if all_tools:
-        TOOLS_CACHE["tools"] = all_tools
-        TOOLS_CACHE["tool_server_map"] = tool_server_map
-        TOOLS_CACHE["last_updated"] = current_time
-        logger.info(f"总共获取到 {len(all_tools)} 个工具，已缓存， {TOOLS_CACHE}")
-    else:
-        logger.info(f"未获取到任何工具，缓存未更新")
-    return all_tools
+
+def get_mcp_retry_policy() -> RetryPolicy:
+    """MCP 工具调用的重试策略，退避、预算、deadline 与 HTTP 调用共用配置"""
+    global _mcp_retry_policy
+    if _mcp_retry_policy is None:
+        _mcp_retry_policy = get_default_policy().copy(retryable_exceptions=(), classifier=is_mcp_call_retryable,
+                                                      deadline=client_config.sse_timeout)
+    return _mcp_retry_policy
 
 
 async def async_call_mcp_tool(server_addr: str, call_tool_name: str, params: dict = None) -> Any:
     """
     异步调用 MCP工具，根据工具唯一名称找到对应的服务器
-    :param server_addr Server addr of the tool
+    :param server_addr 逻辑服务器名称（tool_server_map 中的值）或 MCP Server 地址，
+        每次尝试由负载均衡选择一个副本，重试时优先换一个副本；
+        params 中的 cursor 带有副本标记时（见 tag_cursors）固定发往发出该游标的副本
     :param call_tool_name: 工具调用名称（包含服务器哈希）
     :param params: 工具参数（字典格式）
     :return: 工具执行返回结果
     """
-    logger.info(f"call_mcp_tool: {call_tool_name}@{server_addr}, params: {params}")
-    try:
-        async with streamablehttp_client(url=server_addr, timeout=30, httpx_client_factory=create_http_client_factory(client_config)) as (read, write, _):
-            async with ClientSession(read, write) as session:
-                await session.initialize()
-                result = await session.call_tool(call_tool_name, params or {})
-                logger.info(f"call_mcp_tool_success: {call_tool_name}@{server_addr} -> {result}")
-                return result
-    except Exception as e:
-        logger.exception(f"call_mcp_tool_exception_for_tool {call_tool_name}@{server_addr}")
-        raise RuntimeError(f"call_mcp_tool_exception: {str(e)}") from e
+    logger.info("call_mcp_tool: %s@%s, params: %s", call_tool_name, server_addr, Payload(params))
+    registry = get_server_registry()
+    server = registry.get(server_addr)
+    tried = set()
+    pinned = None
+    if params and isinstance(params.get("cursor"), str):
+        # 带副本标记的游标只能由发出它的副本处理，去掉标记后固定发往该副本，重试也不换副本
+        tag, raw_cursor = split_cursor(params["cursor"])
+        if tag is not None:
+            params = {**params, "cursor": raw_cursor}
+            pinned = server.get_replica_by_tag(tag)
+            if pinned is None:
+                logger.warning(f"cursor_replica_not_found {tag}@{server_addr}, pick any replica")
+
+    async def attempt(remaining: float | None) -> Any:
+        replica = pinned or registry.pick(server, tried)
+        tried.add(replica.addr)
+        if tool_span:
+            tool_span.set_attribute("replica", replica.addr)
+            tool_span.set_attribute("attempts", len(tried))
+        with get_mcp_breaker(replica.addr).track(), replica.track():
+            # request_id、traceparent 随 _meta 传给 MCP Server，服务端的 span 与本次调用串成一条链路
+            result = await mcp_session_pool.call_tool(replica.addr, call_tool_name, params,
+                                                      meta=tracing.propagation_meta(tool_span))
+        if len(server.replicas) > 1 and result.structuredContent is not None:
+            tag_cursors(result.structuredContent, replica.tag)
+        return result
+
+    with tracing.span("mcp_tool", tracing.KIND_CLIENT, tool=call_tool_name, server=server_addr) as tool_span:
+        try:
+            result = await get_mcp_retry_policy().acall(attempt, name=f"call_mcp_tool {call_tool_name}@{server_addr}")
+            logger.info("call_mcp_tool_success: %s@%s -> %s", call_tool_name, server_addr, Payload(result))
+            return result
+        except Exception as e:
+            logger.exception(f"call_mcp_tool_exception_for_tool {call_tool_name}@{server_addr}")
+            raise RuntimeError(f"call_mcp_tool_exception: {str(e)}") from e
 
 
 async def async_get_tool_server_addr(unique_tool_name):
@@ -176,18 +517,158 @@ async def async_get_tool_server_addr(unique_tool_name):
     return server_addr
 
 
+async def async_fetch_sql_result_page(cursor: str) -> dict:
+    """
+    供前端按需获取 SQL 查询结果的后续数据，调用提供 fetch_sql_result_page 工具的 MCP Server
+    :return: SqlExecResult 对应的字典，包含 msg、data、total_rows、truncated、next_cursor
+    """
+    await async_get_available_tools()
+    for unique_name, server_addr in TOOLS_CACHE["tool_server_map"].items():
+        if get_tool_call_name(unique_name) == "fetch_sql_result_page":
+            result = await async_call_mcp_tool(server_addr, "fetch_sql_result_page", {"cursor": cursor})
+            if result.structuredContent is not None:
+                return result.structuredContent
+            return json.loads(result.content[0].text)
+    raise ValueError("没有可用的 MCP Server 提供 fetch_sql_result_page 工具")
+
+
+def fetch_sql_result_page(cursor: str) -> dict:
+    """同步获取 SQL 查询结果的后续数据"""
+    return run_sync(async_fetch_sql_result_page(cursor))
+
+
 def call_mcp_tool(server_addr:str, call_tool_name: str, params: dict) -> Any:
     """
     将异步调用转换为同步调用， 同步调用MCP工具，便于在同步代码中使用
+    会话池绑定在后台事件循环上，因此协程统一通过 aio_loop 提交到该循环执行
+    """
+    return run_sync(async_call_mcp_tool(server_addr, call_tool_name, params))
+
+
+def get_tool_fanout(cfg: dict, tool_fanout: int | None = None) -> int:
+    """获取单个请求中工具调用的并发上限，调用方传入的值优先于配置"""
+    if tool_fanout is None:
+        tool_fanout = cfg.get('client', {}).get('tool_fanout', DEFAULT_TOOL_FANOUT)
+    return max(1, int(tool_fanout))
+
+
+def get_tool_result_format(cfg: dict) -> str:
+    """获取希望工具返回的表格编码格式"""
+    return cfg.get('client', {}).get('tool_result_format', DEFAULT_TOOL_RESULT_FORMAT)
+
+
+def negotiate_result_format(unique_tool_name: str, arguments: dict, result_format: str | None) -> dict:
+    """
+    工具的 inputSchema 中有 result_format 参数且支持 result_format 时，如果 LLM 没有指定，则使用客户端希望的格式
+    """
+    if not result_format or "result_format" in arguments:
+        return arguments
+    for tool in TOOLS_CACHE["tools"]:
+        if tool["name"] == unique_tool_name:
+            prop = (tool.get("inputSchema") or {}).get("properties", {}).get("result_format")
+            if prop and result_format in prop.get("enum", [result_format]):
+                return {**arguments, "result_format": result_format}
+            break
+    return arguments
+
+
+def format_structured(structured: dict) -> str:
+    """
+    输出紧凑的 JSON（去掉空字段），csv/markdown 格式的 text 字段原样附在后面，不做 JSON 转义
+    批量工具的 results 列表逐项输出，每项的 text 同样不做转义
     """
-    return asyncio.run(async_call_mcp_tool(server_addr, call_tool_name, params))
+    structured = {k: v for k, v in structured.items() if v is not None and v != [] and v != "" and v != {}}
+    text = structured.pop("text", None)
+    results = structured.get("results")
+    if isinstance(results, list) and all(isinstance(item, dict) for item in results):
+        structured.pop("results")
+        head = json.dumps(structured, ensure_ascii=False, separators=(",", ":"), default=str)
+        items = [f"[{i}] {format_structured(item)}" for i, item in enumerate(results)]
+        return "\n".join(items if head == "{}" else [head, *items])
+    body = json.dumps(structured, ensure_ascii=False, separators=(",", ":"), default=str)
+    return body if text is None else f"{body}\n{text}"
+
+
+def format_tool_result(tool_result) -> str:
+    """将工具结果转换为发送给 LLM 的文本，格式见 format_structured"""
+    structured = tool_result.structuredContent
+    if structured is None:
+        return "\n".join(getattr(item, "text", None) or str(item) for item in tool_result.content)
+    return format_structured(structured)
+
+
+async def async_run_tool_calls(tool_calls: list[dict], tool_fanout: int, result_format: str | None = None,
+                               parent_span: tracing.Span | None = None) -> AsyncGenerator[tuple[str, int, dict], None]:
+    """
+    并发执行LLM在同一轮返回的多个工具调用，最多同时执行 tool_fanout 个
+    result_format 为希望表格类工具返回的编码格式，见 negotiate_result_format
+    parent_span 为本轮对话的 span，每个工具调用记录为它的子 span（mcp_tool）
+    按事件发生的先后产出 (事件类型, 工具调用在 tool_calls 中的序号, 执行信息)，事件类型为 start 或 result
+    任一工具调用失败时抛出异常，并取消其余未完成的调用
+    """
+    semaphore = asyncio.Semaphore(tool_fanout)
+    events = asyncio.Queue()
+
+    async def run_one(index: int, tool_call: dict):
+        # 在工具调用自己的 task 中设置当前 span，async_call_mcp_tool 以它为父 span
+        with tracing.activate(parent_span):
+            await run_tool_call(index, tool_call)
+
+    async def run_tool_call(index: int, tool_call: dict):
+        try:
+            server_addr = await async_get_tool_server_addr(tool_call['name'])
+            tool_call_name = get_tool_call_name(tool_call['name'])
+            tool_run = {"server_addr": server_addr, "tool_call_name": tool_call_name}
+            async with semaphore:
+                await events.put(("start", index, tool_run))
+                arguments = negotiate_result_format(tool_call['name'], tool_call["arguments"], result_format)
+                tool_result = await async_call_mcp_tool(server_addr, tool_call_name, arguments)
+            tool_run["content"] = format_tool_result(tool_result)
+            await events.put(("result", index, tool_run))
+        except Exception as e:
+            await events.put(("error", index, e))
 
-def auto_call_mcp(question: str, cfg: dict) -> str:
+    tasks = [asyncio.create_task(run_one(index, tool_call)) for index, tool_call in enumerate(tool_calls)]
+    try:
+        finished = 0
+        while finished < len(tasks):
+            event, index, payload = await events.get()
+            if event == "error":
+                raise payload
+            if event == "result":
+                finished += 1
+            yield event, index, payload
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def auto_call_mcp(question: str, cfg: dict, tool_fanout: int | None = None, request_id: str | None = None) -> str:
     """
     使用支持工具调用的LLM自动决策并调用MCP工具
+    :param tool_fanout: 同一轮中并发执行的工具调用数量上限，为空时使用配置
+    :param request_id: 请求ID，作为链路追踪的 trace_id 传给 MCP Server，为空时自动生成
     """
+    trace = tracing.start_trace("auto_call_mcp", request_id)
+    metrics.CONVERSATIONS_IN_FLIGHT.inc()
+    try:
+        return _auto_call_mcp(question, cfg, tool_fanout, trace)
+    except BaseException as e:
+        trace.root.record_error(e)
+        raise
+    finally:
+        metrics.CONVERSATIONS_IN_FLIGHT.dec()
+        trace.end()
+
+
+def _auto_call_mcp(question: str, cfg: dict, tool_fanout: int | None, trace: tracing.Trace) -> str:
+    """auto_call_mcp 的对话过程，每轮对话、LLM 调用和工具调用记录为 trace 中的 span"""
+    tool_fanout = get_tool_fanout(cfg, tool_fanout)
+    result_format = get_tool_result_format(cfg)
     # 获取可用的MCP工具
-    tools = asyncio.run(async_get_available_tools())
+    with trace.root.child("tool_discovery"):
+        tools = run_sync(async_get_available_tools())
     if not tools:
         raise ValueError("没有可用的MCP工具")
     # 读取LLM配置
@@ -197,8 +678,8 @@ def auto_call_mcp(question: str, cfg: dict) -> str:
     if not all([uri, token, model_name]):
         raise ValueError("读取LLM配置出现错误")
 
-    # 将MCP工具转换为LLM工具格式
-    llm_tools = build_llm_tools(tools)
+    # 对话中已经调用过的工具，每轮都会发送给LLM
+    used_tools = set()
     # 准备初始消息
     messages = [
         {"role": "system", "content": "你是一个智能助手，可以根据用户需求选择合适的工具。"},
@@ -207,14 +688,22 @@ def auto_call_mcp(question: str, cfg: dict) -> str:
     # 设置最大迭代次数，防止无限循环
     max_iterations = 10
     iteration = 0
+    iteration_span = None
     while iteration < max_iterations:
         iteration += 1
         logger.info(f"第 {iteration} 轮对话")
+        if iteration_span:
+            iteration_span.end()
+        iteration_span = trace.root.child("iteration", iteration=iteration)
+        trace.root.set_attribute("iterations", iteration)
         # 调用LLM API
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {token}"
         }
+        # 只发送与问题相关的工具，并压缩较早或过大的工具结果，控制每轮发送给 LLM 的上下文大小
+        llm_tools = select_llm_tools(tools, question, cfg, used_tools)
+        get_context_budget().fit(messages, llm_tools)
         data = {
             "model": model_name,
             "messages": messages,
@@ -224,10 +713,11 @@ def auto_call_mcp(question: str, cfg: dict) -> str:
         # proxies= {"http": "http://a.b.c:8080", "https": "http://a.b.c:8080"}
         proxies = cfg['api'].get('proxy', None)
         try:
-            curl_log = build_curl_cmd(uri, data, headers, proxies)
-            logger.info(curl_log)
-            response_data = post_with_retry(uri, headers, data, proxies)
-            logger.info(f"llm_response_data: {json.dumps(response_data, indent=2, ensure_ascii=False)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(build_curl_cmd(uri, data, headers, proxies))
+            with iteration_span.child("llm", tracing.KIND_CLIENT, model=model_name):
+                response_data = post_with_retry(uri, headers, data, proxies)
+            logger.debug("llm_response_data: %s", Payload(response_data))
             if "error" in response_data:
                 logger.error(f"LLM API 返回错误: {response_data['error']}")
                 return f"LLM API 错误: {response_data['error']['message']}"
@@ -244,6 +734,7 @@ def auto_call_mcp(question: str, cfg: dict) -> str:
                 # 如果是 tool_calls，提取并执行所有工具调用
                 tool_calls = extract_tool_calls(response_data)
                 if tool_calls:
+                    used_tools.update(tool_call["name"] for tool_call in tool_calls)
                     # 将工具调用消息添加到历史
                     tool_call_message = response_data["choices"][0]["message"]
                     logger.info(f"function_call_tag= {tool_call_message['function_call']}")
@@ -251,15 +742,16 @@ def auto_call_mcp(question: str, cfg: dict) -> str:
                         tool_call_message["function_call"] = []
                     messages.append(tool_call_message)
 
-                    # 执行所有工具调用并收集结果
-                    for tool_call in tool_calls:
-                        server_addr = asyncio.run(async_get_tool_server_addr(tool_call['name']))
-                        tool_call_name = get_tool_call_name(tool_call['name'])
-                        tool_result = call_mcp_tool(server_addr, tool_call_name, tool_call["arguments"])
-                        tool_result_content = str(tool_result.content)
+                    # 并发执行所有工具调用，结果按原始 tool_call_id 顺序添加到消息历史
+                    tool_runs = [None] * len(tool_calls)
+                    tool_events = async_run_tool_calls(tool_calls, tool_fanout, result_format, iteration_span)
+                    for event, index, tool_run in iterate_sync(tool_events):
+                        if event == "result":
+                            tool_runs[index] = tool_run
+                    for tool_call, tool_run in zip(tool_calls, tool_runs):
                         messages.append({
                             "role": "tool",
-                            "content": tool_result_content,
+                            "content": tool_run["content"],
                             "tool_call_id": tool_call["id"]
                         })
 
@@ -275,18 +767,89 @@ def auto_call_mcp(question: str, cfg: dict) -> str:
 
         except Exception as e:
             logger.exception(f"call_llm_err")
+            iteration_span.record_error(e)
             raise RuntimeError(f"LLM调用失败: {str(e)}") from e
 
     # 如果达到最大迭代次数仍未得到最终回答
     return "处理超时，未能生成完整回答"
 
-def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
+async def async_stream_llm_response(uri: str, headers: dict, data: dict, proxies: dict | None) -> AsyncGenerator[tuple[str, Any], None]:
     """
-    使用支持工具调用的LLM自动决策并调用MCP工具（流式版本）
-    返回生成器，逐步产生结果
+    以流式方式调用LLM，LLM 每生成一段文本就产出 ("delta", 文本)，
+    结束时将增量的 content、tool_calls 拼装成与非流式接口相同格式的响应，产出 ("response", 响应数据)
     """
-    logger.info(f"question: {question}, cfg {cfg}")
-    mcp_tools = asyncio.run(async_get_available_tools())
+    content_parts = []
+    tool_calls = {}
+    finish_reason = None
+    async for chunk in async_post_stream(uri, headers, data, proxies):
+        if "error" in chunk:
+            yield "response", chunk
+            return
+        if not chunk.get("choices"):
+            continue
+        choice = chunk["choices"][0]
+        delta = choice.get("delta") or {}
+        if delta.get("content"):
+            content_parts.append(delta["content"])
+            yield "delta", delta["content"]
+        # tool_calls 按 index 分片返回，id、name 只在第一个分片中出现，arguments 需要逐段拼接
+        for tool_call_delta in delta.get("tool_calls") or []:
+            tool_call = tool_calls.setdefault(tool_call_delta.get("index", 0), {
+                "id": "",
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if tool_call_delta.get("id"):
+                tool_call["id"] = tool_call_delta["id"]
+            function_delta = tool_call_delta.get("function") or {}
+            tool_call["function"]["name"] += function_delta.get("name") or ""
+            tool_call["function"]["arguments"] += function_delta.get("arguments") or ""
+        if choice.get("finish_reason"):
+            finish_reason = choice["finish_reason"]
+
+    message = {"role": "assistant", "content": "".join(content_parts)}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+    yield "response", {"choices": [{"finish_reason": finish_reason, "message": message}]}
+
+
+async def async_auto_call_mcp_yield(question: str, cfg: dict, tool_fanout: int | None = None,
+                                    llm_stream: bool | None = None,
+                                    request_id: str | None = None) -> AsyncGenerator[str, None]:
+    """
+    使用支持工具调用的LLM自动决策并调用MCP工具（异步流式版本）
+    返回异步生成器，逐步产生结果，LLM 调用和工具调用期间不占用线程，可在 ASGI 服务中直接使用
+    :param tool_fanout: 同一轮中并发执行的工具调用数量上限，为空时使用配置
+    :param llm_stream: 是否以流式方式调用LLM，并将生成的文本以 delta 事件逐段返回，为空时使用配置 api.llm_stream
+    :param request_id: 请求ID，作为链路追踪的 trace_id 传给 MCP Server，为空时自动生成；
+        final 事件中的 timing 为本次请求各阶段的耗时汇总，见 tracing.Trace.summary
+    """
+    trace = tracing.start_trace("auto_call_mcp", request_id, stream=True)
+    metrics.CONVERSATIONS_IN_FLIGHT.inc()
+    try:
+        async for chunk in _async_auto_call_mcp_yield(question, cfg, tool_fanout, llm_stream, trace):
+            yield chunk
+    except BaseException as e:
+        trace.root.record_error(e)
+        raise
+    finally:
+        metrics.CONVERSATIONS_IN_FLIGHT.dec()
+        trace.end()
+
+
+async def _async_auto_call_mcp_yield(question: str, cfg: dict, tool_fanout: int | None, llm_stream: bool | None,
+                                     trace: tracing.Trace) -> AsyncGenerator[str, None]:
+    """
+    async_auto_call_mcp_yield 的对话过程，每轮对话、LLM 调用和工具调用记录为 trace 中的 span
+    生成器会在 yield 处挂起，这里显式使用 Span.child() 而不是依赖 contextvars 中的当前 span
+    """
+    tool_fanout = get_tool_fanout(cfg, tool_fanout)
+    result_format = get_tool_result_format(cfg)
+    if llm_stream is None:
+        llm_stream = cfg['api'].get('llm_stream', False)
+    logger.info("question: %s, cfg %s", question, Payload(cfg))
+    with trace.root.child("tool_discovery"):
+        mcp_tools = await async_get_available_tools()
     if not mcp_tools:
         yield json.dumps({
             "type": "status",
@@ -299,7 +862,7 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
     model_name = cfg["api"]["llm_model_name"]
     if not all([uri, token, model_name]):
         raise ValueError("读取LLM配置出现错误")
-    llm_tools = build_llm_tools(mcp_tools)
+    used_tools = set()
     messages = [
         {"role": "system", "content": "你是一个智能助手，可以根据用户需求选择合适的工具。"},
         {"role": "user", "content": question}
@@ -313,9 +876,14 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
         "iteration": iteration
     }, ensure_ascii=False)
 
+    iteration_span = None
     while iteration < max_iterations:
         iteration += 1
         logger.info(f"第 {iteration} 轮对话")
+        if iteration_span:
+            iteration_span.end()
+        iteration_span = trace.root.child("iteration", iteration=iteration)
+        trace.root.set_attribute("iterations", iteration)
         yield json.dumps({
             "type": "status",
             "content": f"第 {iteration} 轮处理中...",
@@ -326,19 +894,36 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
             "Content-Type": "application/json",
             "Authorization": f"Bearer {token}"
         }
+        # 只发送与问题相关的工具，并压缩较早或过大的工具结果，控制每轮发送给 LLM 的上下文大小
+        llm_tools = select_llm_tools(mcp_tools, question, cfg, used_tools)
+        get_context_budget().fit(messages, llm_tools)
         data = {
             "model": model_name,
             "messages": messages,
             "tools": llm_tools,
-            "stream": False
+            "stream": llm_stream
         }
 
         try:
             proxies = cfg['api'].get('proxy', None)
-            curl_log = build_curl_cmd(uri, data, headers, proxies)
-            logger.info(curl_log)
-            response_data = post_with_retry(uri, headers, data, proxies)
-            logger.info(f"llm_response_data: {json.dumps(response_data, indent=2, ensure_ascii=False)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(build_curl_cmd(uri, data, headers, proxies))
+            with iteration_span.child("llm", tracing.KIND_CLIENT, model=model_name, stream=llm_stream):
+                if llm_stream:
+                    # 流式调用，LLM 生成的文本实时发送给前端
+                    response_data = None
+                    async for event, payload in async_stream_llm_response(uri, headers, data, proxies):
+                        if event == "delta":
+                            yield json.dumps({
+                                "type": "delta",
+                                "content": payload,
+                                "iteration": iteration
+                            }, ensure_ascii=False)
+                        else:
+                            response_data = payload
+                else:
+                    response_data = await async_post_with_retry(uri, headers, data, proxies)
+            logger.debug("llm_response_data: %s", Payload(response_data))
 
             if "error" in response_data:
                 logger.error(f"LLM API 返回错误: {response_data['error']}")
@@ -356,24 +941,29 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
                 final_response = response_data["choices"][0]["message"]["content"]
                 logger.info(f"最终回答: {final_response}")
 
-                # 发送最终结果
+                # 发送最终结果，附带本次请求的耗时汇总
                 yield json.dumps({
                     "type": "final",
                     "content": final_response,
-                    "iteration": iteration
+                    "iteration": iteration,
+                    "request_id": trace.request_id,
+                    "timing": trace.summary()
                 }, ensure_ascii=False)
                 return
 
             elif finish_reason == "tool_calls":
-                step_response = response_data["choices"][0]["message"]["content"]
-                yield json.dumps({
-                    "type": "status",
-                    "content": step_response,
-                    "iteration": iteration
-                }, ensure_ascii=False)
+                if not llm_stream:
+                    # 流式调用时中间步骤的文本已经通过 delta 事件发送过了
+                    step_response = response_data["choices"][0]["message"]["content"]
+                    yield json.dumps({
+                        "type": "status",
+                        "content": step_response,
+                        "iteration": iteration
+                    }, ensure_ascii=False)
                 # 如果是 tool_calls，提取并执行所有工具调用
-                tool_calls = extract_tool_calls(response_data)
+                tool_calls = await async_extract_tool_calls(response_data)
                 if tool_calls:
+                    used_tools.update(tool_call["name"] for tool_call in tool_calls)
                     # 将工具调用消息添加到历史
                     tool_call_message = response_data["choices"][0]["message"]
                     if ("function_call" in tool_call_message and
@@ -392,25 +982,25 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
                         "iteration": iteration
                     }, ensure_ascii=False)
 
-                    # 执行所有工具调用并收集结果
-                    for tool_call in tool_calls:
-                        # 查找工具对应的服务器
-                        server_addr = asyncio.run(async_get_tool_server_addr(tool_call['name']))
-                        # 获取工具调用名称
-                        tool_call_name = get_tool_call_name(tool_call['name'])
-                        # 发送工具执行开始信息
-                        yield json.dumps({
-                            "type": "tool_start",
-                            "content": f"正在执行工具: {tool_call_name}@{server_addr}, {json.dumps(tool_call["arguments"], ensure_ascii=False)}",
-                            "tool": f"{tool_call_name}@{server_addr}",
-                            "iteration": iteration
-                        }, ensure_ascii=False)
-
-                        # 调用MCP工具
-                        tool_result = call_mcp_tool(server_addr, tool_call_name, tool_call["arguments"])
+                    # 并发执行所有工具调用，每个工具开始执行、执行完成时分别发送事件
+                    tool_runs = [None] * len(tool_calls)
+                    async for event, index, tool_run in async_run_tool_calls(tool_calls, tool_fanout, result_format,
+                                                                             iteration_span):
+                        tool_call_name = tool_run["tool_call_name"]
+                        server_addr = tool_run["server_addr"]
+                        if event == "start":
+                            # 发送工具执行开始信息
+                            yield json.dumps({
+                                "type": "tool_start",
+                                "content": f"正在执行工具: {tool_call_name}@{server_addr}, {json.dumps(tool_calls[index]["arguments"], ensure_ascii=False)}",
+                                "tool": f"{tool_call_name}@{server_addr}",
+                                "iteration": iteration
+                            }, ensure_ascii=False)
+                            continue
 
                         # 发送工具执行结果
-                        tool_result_content = str(tool_result.content)
+                        tool_runs[index] = tool_run
+                        tool_result_content = tool_run["content"]
                         yield json.dumps({
                             "type": "tool_result",
                             "content": f"工具 {tool_call_name}@{server_addr} 执行完成",
@@ -420,10 +1010,11 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
                             "iteration": iteration
                         }, ensure_ascii=False)
 
-                        # 添加工具执行结果到消息历史
+                    # 按原始 tool_call_id 顺序添加工具执行结果到消息历史
+                    for tool_call, tool_run in zip(tool_calls, tool_runs):
                         messages.append({
                             "role": "tool",
-                            "content": tool_result_content,
+                            "content": tool_run["content"],
                             "tool_call_id": tool_call["id"]
                         })
 
@@ -444,12 +1035,16 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
                 yield json.dumps({
                     "type": "final",
                     "content": final_response,
-                    "iteration": iteration
+                    "iteration": iteration,
+                    "request_id": trace.request_id,
+                    "timing": trace.summary()
                 }, ensure_ascii=False)
                 return
 
         except Exception as e:
             logger.exception(f"call_llm_err")
+            iteration_span.record_error(e)
+            trace.root.record_error(e)
             yield json.dumps({
                 "type": "error",
                 "content": f"LLM调用失败: {str(e)}"
@@ -463,6 +1058,26 @@ def auto_call_mcp_yield(question: str, cfg: dict) -> Generator[str, None, None]:
     }, ensure_ascii=False)
 
 
+def auto_call_mcp_yield(question: str, cfg: dict, tool_fanout: int | None = None,
+                        llm_stream: bool | None = None, request_id: str | None = None) -> Generator[str, None, None]:
+    """
+    使用支持工具调用的LLM自动决策并调用MCP工具（流式版本）
+    返回生成器，逐步产生结果，实际处理由 async_auto_call_mcp_yield 在后台事件循环中完成
+    :param tool_fanout: 同一轮中并发执行的工具调用数量上限，为空时使用配置
+    :param llm_stream: 是否以流式方式调用LLM，为空时使用配置
+    :param request_id: 请求ID，用于链路追踪，为空时自动生成
+    """
+    yield from iterate_sync(async_auto_call_mcp_yield(question, cfg, tool_fanout, llm_stream, request_id))
+
+
+def select_llm_tools(tools: list, question: str, cfg: dict, used_tools: set[str]) -> list:
+    """根据问题选出最相关的 tool_top_k 个工具，加上已经调用过的工具，转换为LLM工具格式"""
+    client_cfg = cfg.get('client', {})
+    selected = select_tools(tools, question, client_cfg.get('tool_top_k', DEFAULT_TOOL_TOP_K),
+                            used_tools, client_cfg.get('always_include_tools'))
+    return build_llm_tools(selected)
+
+
 def build_llm_tools(tools):
     llm_tools = []
     for tool in tools:
@@ -482,7 +1097,7 @@ def build_llm_tools(tools):
     return llm_tools
 
 
-def extract_tool_calls(content: dict) -> list[dict] | None:
+async def async_extract_tool_calls(content: dict) -> list[dict] | None:
     """
     提取多个工具调用信息
     现在LLM返回的tool应该都是全局唯一名称
@@ -502,7 +1117,7 @@ def extract_tool_calls(content: dict) -> list[dict] | None:
             function = tool_call["function"]
             tool_name = function["name"]
             if tool_name not in TOOLS_CACHE["tool_server_map"]:
-                asyncio.run(async_get_available_tools(force_refresh=True))
+                await async_get_available_tools(force_refresh=True)
                 if tool_name not in TOOLS_CACHE["tool_server_map"]:
                     logger.error(f"无法找到工具 {tool_name}")
                     continue
@@ -518,6 +1133,13 @@ def extract_tool_calls(content: dict) -> list[dict] | None:
         return None
 
 
+def extract_tool_calls(content: dict) -> list[dict] | None:
+    """
+    提取多个工具调用信息，同步版本
+    """
+    return run_sync(async_extract_tool_calls(content))
+
+
 if __name__ == "__main__":
     # 直接运行时的测试代码
     my_cfg = init_yml_cfg()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+对话上下文的 token 预算管理
+
+每一轮调用 LLM 都会发送完整的消息历史，工具结果不加控制时请求体会随轮次快速增长。
+每次调用 /chat/completions 之前，由 ContextBudget.fit 对消息历史中的工具结果进行压缩：
+- 最近 keep_recent_turns 轮的工具结果原样保留，但单条不超过 max_tool_result_tokens
+- 更早的工具结果压缩为 compact_tool_result_tokens 以内的首尾片段，并注明省略了多少内容
+- 仍然超过 max_tokens 时，从最早的工具结果开始逐步缩小保留的片段，直到总量满足预算
+只压缩 role 为 tool 的消息内容，不删除消息，保证 tool_calls 与 tool 消息的对应关系不变。
+配置读取自 cfg.yml 的 context 段，未配置时使用默认值:
+    context:
+        max_tokens: 24000
+        keep_recent_turns: 1
+        max_tool_result_tokens: 4000
+        compact_tool_result_tokens: 256
+"""
+
+import json
+import logging.config
+import os
+from pathlib import Path
+
+from sys_init import cfg_file_path, init_yml_cfg
+from utils import estimate_tokens
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT_CFG = {
+    "max_tokens": 24000,
+    "keep_recent_turns": 1,
+    "max_tool_result_tokens": 4000,
+    "compact_tool_result_tokens": 256,
+}
+
+# 每条消息的格式开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 压缩时保留的最小片段
+MIN_COMPACT_TOKENS = 32
+
+
+def message_tokens(message: dict) -> int:
+    """估算单条消息的 token 数"""
+    tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        tokens += estimate_tokens(json.dumps(tool_call, ensure_ascii=False))
+    return tokens
+
+
+def compact_text(txt: str, max_tokens: int) -> str:
+    """
+    超过 max_tokens 时只保留开头和结尾的片段（按行对齐），中间注明省略的内容
+    开头保留约 3/4，通常包含表头、元数据（总行数、游标等），结尾保留约 1/4
+    """
+    tokens = estimate_tokens(txt)
+    if tokens <= max_tokens:
+        return txt
+    marker = f"\n...[已省略部分内容，原始结果约 {tokens} tokens，如需完整数据请缩小查询范围或分页获取]...\n"
+    chars_per_token = len(txt) / tokens
+    max_chars = max(0, int((max_tokens - estimate_tokens(marker)) * chars_per_token))
+    head_chars = max_chars * 3 // 4
+    tail_chars = max_chars - head_chars
+    head = txt[:head_chars]
+    newline = head.rfind("\n")
+    if newline > head_chars // 2:
+        head = head[:newline]
+    tail = txt[len(txt) - tail_chars:] if tail_chars else ""
+    newline = tail.find("\n")
+    if 0 <= newline < tail_chars // 2:
+        tail = tail[newline + 1:]
+    return f"{head}{marker}{tail}"
+
+
+class ContextBudget:
+    """消息历史的 token 预算"""
+
+    def __init__(self,
+            max_tokens: int = 24000,
+            keep_recent_turns: int = 1,
+            max_tool_result_tokens: int = 4000,
+            compact_tool_result_tokens: int = 256):
+        self.max_tokens = max_tokens  # 发送给 LLM 的消息和工具定义的 token 总量上限
+        self.keep_recent_turns = keep_recent_turns  # 最近几轮的工具结果原样保留
+        self.max_tool_result_tokens = max_tool_result_tokens  # 单条工具结果的 token 上限
+        self.compact_tool_result_tokens = compact_tool_result_tokens  # 较早的工具结果压缩后的 token 上限
+
+    def recent_start(self, messages: list[dict]) -> int:
+        """最近 keep_recent_turns 轮工具调用的起始位置，在其之后的工具结果属于最近的结果"""
+        if self.keep_recent_turns <= 0:
+            return len(messages)
+        turns = [i for i, message in enumerate(messages)
+                 if message.get("role") == "assistant" and message.get("tool_calls")]
+        if len(turns) < self.keep_recent_turns:
+            return 0
+        return turns[-self.keep_recent_turns]
+
+    def _compact(self, message: dict, limit: int) -> int:
+        """压缩单条工具消息，返回减少的 token 数"""
+        before = message_tokens(message)
+        message["content"] = compact_text(message.get("content") or "", limit)
+        return before - message_tokens(message)
+
+    def fit(self, messages: list[dict], tools: list | None = None) -> list[dict]:
+        """
+        压缩消息历史中的工具结果，使消息和工具定义的总量不超过 max_tokens，直接修改并返回 messages
+        """
+        tools_tokens = estimate_tokens(json.dumps(tools, ensure_ascii=False)) if tools else 0
+        before = tools_tokens + sum(message_tokens(message) for message in messages)
+        recent_start = self.recent_start(messages)
+        tool_indexes = [i for i, message in enumerate(messages) if message.get("role") == "tool"]
+        total = before
+        for i in tool_indexes:
+            limit = self.max_tool_result_tokens if i > recent_start else self.compact_tool_result_tokens
+            total -= self._compact(messages[i], limit)
+        # 仍然超出预算时，从最早的工具结果开始逐步缩小保留的片段
+        limit = self.compact_tool_result_tokens
+        while total > self.max_tokens and tool_indexes and limit >= MIN_COMPACT_TOKENS:
+            for i in tool_indexes:
+                total -= self._compact(messages[i], limit)
+                if total <= self.max_tokens:
+                    break
+            limit //= 2
+        if total != before:
+            logger.info(f"context_compacted tokens {before} -> {total}, max_tokens={self.max_tokens}")
+        if total > self.max_tokens:
+            logger.warning(f"context_over_budget tokens={total}, max_tokens={self.max_tokens}")
+        return messages
+
+
+_default_budget: ContextBudget | None = None
+
+
+def get_context_cfg() -> dict:
+    """读取 cfg.yml 中的 context 配置，与默认值合并"""
+    context_cfg = dict(DEFAULT_CONTEXT_CFG)
+    if os.path.exists(cfg_file_path):
+        context_cfg.update(init_yml_cfg().get("context") or {})
+    return context_cfg
+
+
+def get_context_budget() -> ContextBudget:
+    """两个对话循环共用的上下文预算"""
+    global _default_budget
+    if _default_budget is None:
+        _default_budget = ContextBudget(**get_context_cfg())
+    return _default_budget
@@ -5,12 +5,22 @@
 Flask Web 界面 for MCP 客户端
 """
 
+import atexit
 import logging.config
 import json
 import os
+import threading
 
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context
-from client import auto_call_mcp, auto_call_mcp_yield, init_yml_cfg
+from flask import Flask, g, render_template, request, jsonify, Response, stream_with_context
+
+import aio_loop
+import circuit_breaker
+import http_pool
+import metrics
+import profiling
+import tracing
+from client import auto_call_mcp, auto_call_mcp_yield, fetch_sql_result_page, init_yml_cfg, mcp_session_pool, \
+    start_background_refresh, tools_cache_status
 
 # 配置日志
 logging.config.fileConfig('logging.conf', encoding="utf-8")
@@ -26,6 +36,51 @@ os.system(
 # 初始化配置
 cfg = init_yml_cfg()
 
+# 每个工作进程使用一个后台事件循环，Flask 请求线程把协程提交到该循环执行
+aio_loop.configure(cfg.get('client', {}).get('loop_mode'))
+atexit.register(lambda: aio_loop.shutdown(mcp_session_pool.close_all()))
+# 在后台事件循环中定时刷新 MCP 工具列表、检查各副本的健康状态，用户请求不再等待工具发现
+start_background_refresh(cfg)
+# 定时写入本进程的指标快照，多个工作进程时 /metrics 合并输出
+metrics.start("http_mcp")
+
+
+@app.before_request
+def start_request():
+    """确定请求ID；请求头中带有 X-Profile 且配置中启用了 profiling 时，开始剖析本次请求"""
+    # 请求ID用于在日志和链路追踪中串联本次对话的 LLM 调用、MCP 工具调用和数据后端调用
+    g.request_id = request.headers.get(tracing.REQUEST_ID_HEADER) or tracing.new_request_id()
+    # 同步接口把协程提交到后台事件循环执行，采样时同时采样请求线程和事件循环线程
+    g.profile = profiling.start_request_profile(request.headers.get(profiling.header_name()), g.request_id,
+                                                [threading.get_ident(), aio_loop.default_loop.thread_id])
+
+
+@app.teardown_request
+def stop_profile(exc):
+    """请求结束或处理过程中出现异常时结束剖析，流式响应在 add_profile_header 中推迟到响应发送完毕"""
+    profile = g.pop('profile', None)
+    if profile:
+        profile.stop()
+
+
+@app.after_request
+def count_request(response):
+    """按接口和状态码统计请求数"""
+    if request.url_rule is not None:
+        metrics.HTTP_REQUESTS.inc(endpoint=request.url_rule.rule, status=response.status_code)
+    return response
+
+
+@app.after_request
+def add_profile_header(response):
+    """返回剖析结果的文件名，文件位于 profiling.output_dir"""
+    if g.get('profile'):
+        response.headers['X-Profile-File'] = g.profile.file_name
+        if response.is_streamed:
+            # 流式响应的生成器在请求上下文结束后才逐个发送事件，等响应关闭时再结束剖析
+            response.call_on_close(g.pop('profile').stop)
+    return response
+
 
 @app.route('/')
 def index():
@@ -43,7 +98,8 @@ def process_query():
             return jsonify({'error': '缺少问题参数'}), 400
 
         question = data['question']
-        logger.info(f"收到用户查询: {question}")
+        request_id = g.request_id
+        logger.info(f"收到用户查询: {question}, request_id={request_id}")
 
         # 检查是否请求流式响应
         stream = data.get('stream', False)
@@ -52,7 +108,7 @@ def process_query():
             # 流式响应
             def generate():
                 try:
-                    for chunk in auto_call_mcp_yield(question, cfg):
+                    for chunk in auto_call_mcp_yield(question, cfg, request_id=request_id):
                         yield f"data: {chunk}\n\n"
                     yield "data: [DONE]\n\n"
                 except Exception as e:
@@ -68,16 +124,17 @@ def process_query():
                             headers={
                                 'Cache-Control': 'no-cache',
                                 'Connection': 'keep-alive',
-                                'X-Accel-Buffering': 'no'  # 禁用Nginx缓冲
+                                'X-Accel-Buffering': 'no',  # 禁用Nginx缓冲
+                                tracing.REQUEST_ID_HEADER: request_id
                             })
         else:
             # 普通响应
-            result = auto_call_mcp(question, cfg)
+            result = auto_call_mcp(question, cfg, request_id=request_id)
             return jsonify({
                 'success': True,
                 'question': question,
                 'answer': result
-            })
+            }), 200, {tracing.REQUEST_ID_HEADER: request_id}
 
     except Exception as e:
         logger.exception("处理查询时发生错误")
@@ -87,10 +144,32 @@ def process_query():
         }), 500
 
 
+@app.route('/api/sql_page', methods=['POST'])
+def sql_result_page():
+    """按 next_cursor 获取 SQL 查询结果的后续数据"""
+    data = request.get_json(silent=True)
+    if not data or 'cursor' not in data:
+        return jsonify({'error': '缺少cursor参数'}), 400
+    try:
+        return jsonify({'success': True, 'result': fetch_sql_result_page(data['cursor'])})
+    except Exception as e:
+        logger.exception("获取查询结果分页时发生错误")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/api/health')
 def health_check():
-    """健康检查端点"""
-    return jsonify({'status': 'healthy'})
+    """健康检查端点，包含各上游服务的熔断器状态"""
+    health, status_code = circuit_breaker.health_status()
+    health['http_pool'] = http_pool.pool_stats()
+    health['mcp_servers'] = tools_cache_status()
+    return jsonify(health), status_code
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 指标"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+进程级共享的 HTTP 连接池
+
+LLM 调用（client.py）和数据工具（tools/db_query.py）的后端调用都经过 utils 中的 *_with_retry 方法，
+这里为它们提供共享的 requests.Session（同步）和 httpx.AsyncClient（异步），复用 TCP/TLS 连接。
+配置读取自 cfg.yml 的 http 段，未配置时使用默认值:
+    http:
+        pool_connections: 10     # 同步连接池最多缓存多少个 host 的连接池
+        pool_maxsize: 20         # 每个 host 最多保持的连接数
+        connect_timeout: 5       # 建立连接超时（秒）
+        read_timeout: 30         # 读取响应超时（秒）
+        keepalive_expiry: 60     # 异步客户端空闲连接的保持时间（秒）
+"""
+
+import asyncio
+import logging.config
+import os
+import threading
+import weakref
+from pathlib import Path
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+DEFAULT_HTTP_CFG = {
+    "pool_connections": 10,
+    "pool_maxsize": 20,
+    "connect_timeout": 5,
+    "read_timeout": 30,
+    "keepalive_expiry": 60,
+}
+
+_lock = threading.Lock()
+_http_cfg: dict | None = None
+_session: requests.Session | None = None
+_session_pid: int | None = None
+# 每个事件循环共享的 httpx.AsyncClient，按代理地址区分
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_sync_stats = {"requests": 0, "new_connections": 0}
+_async_stats = {"requests": 0, "new_connections": 0}
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _sync_stats["new_connections"] += 1
+        super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _sync_stats["new_connections"] += 1
+        super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """统计请求数和真正建立的 TCP 连接数，用于观察连接复用情况"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        _sync_stats["requests"] += 1
+        return super().send(request, **kwargs)
+
+
+def get_http_cfg() -> dict:
+    """读取 cfg.yml 中的 http 配置，与默认值合并"""
+    global _http_cfg
+    if _http_cfg is None:
+        http_cfg = dict(DEFAULT_HTTP_CFG)
+        if os.path.exists(cfg_file_path):
+            http_cfg.update(init_yml_cfg().get("http") or {})
+        _http_cfg = http_cfg
+    return _http_cfg
+
+
+def get_timeout(remaining: float | None = None) -> tuple[float, float]:
+    """
+    requests 使用的 (连接超时, 读取超时)
+    :param remaining: 距离重试 deadline 剩余的秒数，读取超时不超过该值
+    """
+    http_cfg = get_http_cfg()
+    read_timeout = http_cfg["read_timeout"]
+    if remaining is not None:
+        read_timeout = max(0.1, min(read_timeout, remaining))
+    return http_cfg["connect_timeout"], read_timeout
+
+
+def get_async_timeout(remaining: float | None = None) -> httpx.Timeout:
+    """httpx 使用的超时配置，含义同 get_timeout"""
+    connect_timeout, read_timeout = get_timeout(remaining)
+    return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+
+def get_session() -> requests.Session:
+    """获取进程内共享的 requests.Session，fork 之后在子进程中重新创建"""
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            http_cfg = get_http_cfg()
+            session = requests.Session()
+            adapter = CountingHTTPAdapter(pool_connections=http_cfg["pool_connections"],
+                                          pool_maxsize=http_cfg["pool_maxsize"])
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+            _session_pid = os.getpid()
+            logger.info(f"http_session_created, pid={_session_pid}, cfg={http_cfg}")
+    return _session
+
+
+async def _trace(event_name: str, info: dict):
+    # httpx 的 trace 扩展，新建 TCP 连接时会触发 connection.connect_tcp 事件
+    if event_name == "connection.connect_tcp.complete":
+        _async_stats["new_connections"] += 1
+
+
+def get_async_client(uri: str, proxies: dict | None) -> httpx.AsyncClient:
+    """
+    获取当前事件循环中共享的异步 HTTP 客户端，复用连接
+    proxies 与 requests 的格式一致，例如 {"http": "http://a.b.c:8080", "https": "http://a.b.c:8080"}
+    """
+    proxy = proxies.get(urlparse(uri).scheme) if proxies else None
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(proxy)
+    if client is None or client.is_closed:
+        http_cfg = get_http_cfg()
+        client = httpx.AsyncClient(
+            verify=False,
+            proxy=proxy,
+            timeout=httpx.Timeout(http_cfg["read_timeout"], connect=http_cfg["connect_timeout"]),
+            limits=httpx.Limits(max_connections=http_cfg["pool_connections"] * http_cfg["pool_maxsize"],
+                                max_keepalive_connections=http_cfg["pool_maxsize"],
+                                keepalive_expiry=http_cfg["keepalive_expiry"]),
+        )
+        clients[proxy] = client
+    return client
+
+
+def async_request_extensions() -> dict:
+    """异步请求需要携带的扩展信息，用于统计连接复用情况"""
+    _async_stats["requests"] += 1
+    return {"trace": _trace}
+
+
+def pool_stats() -> dict:
+    """连接池统计，reused = 请求数 - 新建连接数"""
+    return {
+        "sync": {
+            "requests": _sync_stats["requests"],
+            "new_connections": _sync_stats["new_connections"],
+            "reused": max(0, _sync_stats["requests"] - _sync_stats["new_connections"]),
+        },
+        "async": {
+            "requests": _async_stats["requests"],
+            "new_connections": _async_stats["new_connections"],
+            "reused": max(0, _async_stats["requests"] - _async_stats["new_connections"]),
+        },
+    }
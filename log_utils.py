@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+热点路径上的日志工具
+
+1. Payload: 延迟序列化的日志参数
+   logger.debug("llm_response_data: %s", Payload(response_data))
+   只有日志级别开启、真正输出时才序列化，边序列化边去掉密钥等敏感信息，达到 max_chars 个字符后停止序列化并截断。
+   logging.conf 中各 logger 默认为 INFO，DEBUG 级别的请求体、响应体完全不会被序列化，需要时把对应 logger 调整为 DEBUG。
+2. QueueFileHandler: 基于队列的文件日志 handler
+   请求线程只把日志记录放入内存队列，由后台线程写入 ConcurrentRotatingFileHandler，
+   写文件、跨进程文件锁不会阻塞请求线程。在 logging.conf 中使用，参数与 ConcurrentRotatingFileHandler 相同:
+       [handler_fileHandler]
+       class=log_utils.QueueFileHandler
+       args=('app.log', 'a', 1024*1024*10, 5, 'utf-8', False)
+截断长度可以在 cfg.yml 的 log 段配置（由 sys_init 读取配置后调用 configure）:
+    log:
+        payload_max_chars: 2000
+"""
+
+import atexit
+import json
+import logging.handlers
+import os
+import queue
+import re
+import threading
+from typing import Any, Iterator
+
+DEFAULT_PAYLOAD_MAX_CHARS = 2000
+REDACTED = "***"
+
+# 值需要隐藏的字段名，例如 llm_api_key、Authorization、password、access_token，不包括 max_tokens 这类统计字段
+_SECRET_KEY_PATTERN = re.compile(r"(^|[_\-])(api[_\-]?key|key|secret|password|passwd|token|authorization|cookie)$",
+                                 re.IGNORECASE)
+# 文本中出现的密钥，例如 Bearer sk-xxxx、curl 命令中的 -H "Authorization: ..."
+_SECRET_TEXT_PATTERNS = [
+    (re.compile(r"(Bearer\s+)[^\s\"',]+", re.IGNORECASE), r"\1" + REDACTED),
+    (re.compile(r"\b(sk-[A-Za-z0-9]{2})[A-Za-z0-9_\-]{6,}"), r"\1" + REDACTED),
+    (re.compile(r"((?:api[_\-]?key|password|secret)[\"']?\s*[:=]\s*[\"']?)[^\s\"',}]+", re.IGNORECASE),
+     r"\1" + REDACTED),
+]
+
+# 截断前多保留给脱敏的字符数，避免密钥正好跨过截断位置时因不完整而未被识别
+_REDACT_MARGIN = 256
+
+_payload_max_chars = DEFAULT_PAYLOAD_MAX_CHARS
+
+
+def configure(log_cfg: dict | None):
+    """设置日志参数，log_cfg 为 cfg.yml 中的 log 段"""
+    global _payload_max_chars
+    _payload_max_chars = int((log_cfg or {}).get("payload_max_chars", DEFAULT_PAYLOAD_MAX_CHARS))
+
+
+def is_secret_key(key: Any) -> bool:
+    return isinstance(key, str) and bool(_SECRET_KEY_PATTERN.search(key))
+
+
+def redact_text(txt: str) -> str:
+    for pattern, replacement in _SECRET_TEXT_PATTERNS:
+        txt = pattern.sub(replacement, txt)
+    return txt
+
+
+def redact(obj: Any) -> Any:
+    """返回隐藏了敏感字段的副本，不修改原对象"""
+    if isinstance(obj, dict):
+        return {k: REDACTED if is_secret_key(k) and v else redact(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [redact(item) for item in obj]
+    if isinstance(obj, str):
+        return redact_text(obj)
+    return obj
+
+
+def iter_redacted_json(obj: Any, max_str_chars: int | None = None) -> Iterator[str]:
+    """
+    逐段生成隐藏了敏感字段的 JSON 文本，与 json.dumps(redact(obj), ensure_ascii=False, default=str) 的结果相同，
+    调用方拿到足够的字符后即可停止，不必序列化、脱敏整个对象
+    :param max_str_chars: 每个字符串最多处理的字符数，超出部分不参与脱敏和输出
+    """
+    if isinstance(obj, dict):
+        yield "{"
+        for i, (k, v) in enumerate(obj.items()):
+            if i:
+                yield ", "
+            yield json.dumps(k if isinstance(k, str) else str(k), ensure_ascii=False)
+            yield ": "
+            if is_secret_key(k) and v:
+                yield json.dumps(REDACTED)
+            else:
+                yield from iter_redacted_json(v, max_str_chars)
+        yield "}"
+    elif isinstance(obj, (list, tuple)):
+        yield "["
+        for i, item in enumerate(obj):
+            if i:
+                yield ", "
+            yield from iter_redacted_json(item, max_str_chars)
+        yield "]"
+    elif isinstance(obj, str):
+        yield json.dumps(redact_text(obj[:max_str_chars]), ensure_ascii=False)
+    else:
+        yield json.dumps(obj, ensure_ascii=False, default=str)
+
+
+class Payload:
+    """延迟序列化的日志参数，输出时隐藏敏感信息并截断"""
+
+    __slots__ = ("obj", "max_chars")
+
+    def __init__(self, obj: Any, max_chars: int | None = None):
+        self.obj = obj
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        max_chars = _payload_max_chars if self.max_chars is None else self.max_chars
+        obj = self.obj
+        if max_chars <= 0:
+            if isinstance(obj, (dict, list, tuple)):
+                return "".join(iter_redacted_json(obj))
+            return redact_text(str(obj))
+        if isinstance(obj, (dict, list, tuple)):
+            parts, size = [], 0
+            for part in iter_redacted_json(obj, max_chars + _REDACT_MARGIN):
+                parts.append(part)
+                size += len(part)
+                if size > max_chars:
+                    # 剩余部分不再序列化，无法得知总长度
+                    return f"{''.join(parts)[:max_chars]}...[truncated]"
+            return "".join(parts)
+        txt = str(obj)
+        if len(txt) <= max_chars:
+            return redact_text(txt)
+        return f"{redact_text(txt[:max_chars + _REDACT_MARGIN])[:max_chars]}...[truncated {len(txt) - max_chars} chars]"
+
+    __repr__ = __str__
+
+
+class _FileWriter:
+    """同一个日志文件的队列、ConcurrentRotatingFileHandler 和后台写文件线程，每个进程中每个文件只有一个"""
+
+    def __init__(self, *args, **kwargs):
+        from concurrent_log_handler import ConcurrentRotatingFileHandler
+        self.file_handler = ConcurrentRotatingFileHandler(*args, **kwargs)
+        self.queue: queue.SimpleQueue | None = None
+        self.listener: logging.handlers.QueueListener | None = None
+        self.start()
+
+    def start(self):
+        # fork 时队列的内部锁可能处于父进程后台线程等待的状态，子进程中使用新的队列，父进程队列中未写完的日志由父进程写入
+        self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler, respect_handler_level=False)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            # stop 会先写完队列中剩余的日志
+            self.listener.stop()
+            self.listener = None
+        self.file_handler.close()
+
+
+# 日志文件的绝对路径 -> _FileWriter。各模块都会执行 logging.config.fileConfig，
+# 每次都会新建 QueueFileHandler，这里保证同一个文件只创建一次写文件线程
+_file_writers: dict[str, _FileWriter] = {}
+_file_writers_lock = threading.Lock()
+
+
+def _restart_file_writers():
+    """fork 出来的子进程中没有父进程的后台线程，重新启动；fork 时锁可能被其他线程持有，重新创建"""
+    global _file_writers_lock
+    _file_writers_lock = threading.Lock()
+    for writer in _file_writers.values():
+        writer.start()
+
+
+def _stop_file_writers():
+    with _file_writers_lock:
+        writers = list(_file_writers.values())
+        _file_writers.clear()
+    for writer in writers:
+        writer.stop()
+
+
+os.register_at_fork(after_in_child=_restart_file_writers)
+# 在 logging 模块的 atexit 之后注册，因此先于它执行，退出前写完队列中的日志
+atexit.register(_stop_file_writers)
+
+
+class QueueFileHandler(logging.handlers.QueueHandler):
+    """
+    队列 + 后台线程写文件的日志 handler，参数与 ConcurrentRotatingFileHandler 相同
+    格式化在调用线程中完成（QueueHandler.prepare），后台线程只负责写文件；同一个文件的多个 handler 共用一个后台线程，
+    fork 出来的子进程中重新启动后台线程，进程退出时写完剩余的日志
+    """
+
+    def __init__(self, *args, **kwargs):
+        filename = args[0] if args else kwargs["filename"]
+        path = os.path.abspath(os.fspath(filename))
+        with _file_writers_lock:
+            writer = _file_writers.get(path)
+            if writer is None:
+                writer = _file_writers[path] = _FileWriter(*args, **kwargs)
+        super().__init__(writer.queue)
+        self.writer = writer
+        self.file_handler = writer.file_handler
+
+    def enqueue(self, record: logging.LogRecord):
+        # fork 后 writer 换了新的队列，总是放入 writer 当前的队列
+        self.writer.queue.put_nowait(record)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+MCP 客户端会话池
+
+每个 MCP Server 地址维护一组长连接的 ClientSession，避免每次工具调用都重新建立
+streamablehttp_client、httpx.AsyncClient、TLS 握手以及 initialize() 往返。
+- 每个服务器的会话数量有上限（max_size），超过上限的调用排队等待
+- 空闲超过 max_idle_seconds 的会话在借出前先 ping 一次，失败则剔除重建
+- 存活超过 max_lifetime_seconds 的会话归还时关闭
+- 调用过程中出现连接类错误时剔除该会话；只有能确定请求尚未发送到服务端时（写入已关闭的会话流、无法建立连接）
+  才透明地重连重试一次，其他情况（读超时、读取响应时连接断开等，服务端可能已经执行了工具）交给调用方的重试策略决定
+- 服务器推送 notifications/tools/list_changed 时回调 on_tools_list_changed(server_addr)
+"""
+
+import asyncio
+import logging.config
+import time
+from collections import deque
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Callable
+
+import anyio
+import httpx
+from mcp import ClientSession
+from mcp.client.streamable_http import streamablehttp_client
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, ServerNotification, ToolListChangedNotification
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+# 视为连接已损坏、需要剔除会话并重连的异常
+CONNECTION_ERRORS = (
+    httpx.TransportError,
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+    ConnectionError,
+)
+
+
+# 能确定请求尚未发送到服务端的异常：向已关闭的会话流写入请求、无法建立到服务端的连接
+NOT_SENT_ERRORS = (
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+)
+
+
+class SessionBrokenError(ConnectionError):
+    """会话的传输层出错，正在进行的请求不会再收到响应，__cause__ 为传输层的原始异常"""
+
+
+def is_connection_error(e: BaseException) -> bool:
+    """判断异常是否是连接层面的错误（而不是服务端返回的业务错误）"""
+    if isinstance(e, BaseExceptionGroup):
+        return any(is_connection_error(sub) for sub in e.exceptions)
+    if isinstance(e, CONNECTION_ERRORS):
+        return True
+    if isinstance(e, McpError) and e.error.code == CONNECTION_CLOSED:
+        return True
+    return False
+
+
+def is_request_not_sent(e: BaseException) -> bool:
+    """判断请求是否确定没有发送到服务端，只有这种情况下重试非幂等的工具调用才不会重复执行"""
+    if isinstance(e, BaseExceptionGroup):
+        return all(is_request_not_sent(sub) for sub in e.exceptions)
+    if isinstance(e, SessionBrokenError):
+        return isinstance(e.__cause__, NOT_SENT_ERRORS)
+    return isinstance(e, NOT_SENT_ERRORS)
+
+
+class PooledSession:
+    """
+    池中的一个会话。
+    streamablehttp_client 和 ClientSession 内部使用 anyio task group，必须在同一个 task 中进入和退出，
+    因此每个会话由一个独立的 owner task 持有，关闭时通知该 task 退出上下文。
+    """
+
+    def __init__(self, server_addr: str, on_notification: Callable[[str, Any], None] | None = None):
+        self.server_addr = server_addr
+        self.on_notification = on_notification
+        self.session: ClientSession | None = None
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.healthy = True
+        self._task: asyncio.Task | None = None
+        self._closing: asyncio.Event | None = None
+        self._broken: asyncio.Event | None = None
+        self.transport_error: Exception | None = None
+
+    @property
+    def alive(self) -> bool:
+        return self.healthy and self._task is not None and not self._task.done()
+
+    async def open(self, http_client_factory: Callable, timeout: float, sse_timeout: float):
+        ready = asyncio.get_running_loop().create_future()
+        self._closing = asyncio.Event()
+        self._broken = asyncio.Event()
+        self._task = asyncio.create_task(self._run(http_client_factory, timeout, sse_timeout, ready))
+        await ready
+
+    async def _run(self, http_client_factory: Callable, timeout: float, sse_timeout: float, ready: asyncio.Future):
+        try:
+            async with streamablehttp_client(url=self.server_addr, timeout=timeout, sse_read_timeout=sse_timeout,
+                                             httpx_client_factory=http_client_factory) as (read, write, _):
+                async with ClientSession(read, write, message_handler=self._on_message) as session:
+                    await session.initialize()
+                    self.session = session
+                    ready.set_result(None)
+                    await self._closing.wait()
+        except BaseException as e:
+            self.healthy = False
+            if not ready.done():
+                ready.set_exception(e if isinstance(e, Exception) else RuntimeError(str(e)))
+            elif not isinstance(e, asyncio.CancelledError):
+                logger.warning(f"mcp_session_closed_with_error {self.server_addr}: {e}")
+                self.transport_error = e if isinstance(e, Exception) else None
+        finally:
+            self.healthy = False
+            self.session = None
+
+    async def _on_message(self, message: Any):
+        # 传输层把 HTTP 错误以 Exception 的形式塞进读取流，收到后标记会话不可用
+        if isinstance(message, Exception):
+            logger.warning(f"mcp_session_transport_error {self.server_addr}: {message}")
+            self.healthy = False
+            self.transport_error = message
+            self._broken.set()
+        elif isinstance(message, ServerNotification) and self.on_notification:
+            self.on_notification(self.server_addr, message.root)
+
+    async def run(self, coro) -> Any:
+        """
+        执行一次会话上的请求
+        传输层出错（例如副本宕机、连接被拒绝）或会话的 owner task 退出时，请求本身要等到读取超时才会失败，
+        这里立即以 SessionBrokenError 结束，由会话池重连重试或交给负载均衡换一个副本
+        """
+        request = asyncio.ensure_future(coro)
+        broken = asyncio.ensure_future(self._broken.wait())
+        try:
+            await asyncio.wait((request, broken, self._task), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            broken.cancel()
+            if not request.done():
+                request.cancel()
+        if request.done() and not request.cancelled():
+            return request.result()
+        self.healthy = False
+        raise SessionBrokenError(f"{self.server_addr}: {self.transport_error or 'session closed'}") from self.transport_error
+
+    async def close(self):
+        self.healthy = False
+        if self._closing:
+            self._closing.set()
+        if self._task and not self._task.done():
+            try:
+                await asyncio.wait_for(self._task, timeout=5)
+            except (asyncio.TimeoutError, Exception):
+                self._task.cancel()
+
+
+class _ServerPool:
+    """单个服务器地址的会话池状态"""
+
+    def __init__(self, max_size: int):
+        self.idle: deque[PooledSession] = deque()
+        self.slots = asyncio.Semaphore(max_size)
+        self.in_use = 0
+        self.created = 0
+        self.evicted = 0
+        self.reused = 0
+
+
+class MCPSessionPool:
+    """按 MCP Server 地址分组的长连接会话池"""
+
+    def __init__(self,
+            http_client_factory: Callable,
+            max_size: int = 32,
+            max_idle_seconds: float = 60,
+            max_lifetime_seconds: float = 1800,
+            acquire_timeout: float = 60,
+            http_timeout: float = 30,
+            sse_timeout: float = 300,
+            ping_timeout: float = 5):
+        self.http_client_factory = http_client_factory
+        self.max_size = max_size  # 每个服务器最多保持的会话数
+        self.max_idle_seconds = max_idle_seconds  # 空闲超过该时间的会话借出前先做健康检查
+        self.max_lifetime_seconds = max_lifetime_seconds  # 会话最长存活时间
+        self.acquire_timeout = acquire_timeout  # 等待可用会话的最长时间
+        self.http_timeout = http_timeout
+        self.sse_timeout = sse_timeout
+        self.ping_timeout = ping_timeout
+        self._servers: dict[str, _ServerPool] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        # 服务器的工具列表发生变化时的回调，参数为服务器地址
+        self.on_tools_list_changed: Callable[[str], Any] | None = None
+
+    def _server_pool(self, server_addr: str) -> _ServerPool:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 会话绑定在创建它的事件循环上，换了事件循环之后旧会话不可再用
+            if self._loop is not None:
+                logger.info("mcp_session_pool_rebind_event_loop, drop all pooled sessions")
+            self._servers = {}
+            self._loop = loop
+        pool = self._servers.get(server_addr)
+        if pool is None:
+            pool = _ServerPool(self.max_size)
+            self._servers[server_addr] = pool
+        return pool
+
+    def _on_notification(self, server_addr: str, notification: Any):
+        if isinstance(notification, ToolListChangedNotification) and self.on_tools_list_changed:
+            try:
+                self.on_tools_list_changed(server_addr)
+            except Exception:
+                logger.exception(f"on_tools_list_changed_error {server_addr}")
+
+    async def _is_usable(self, pooled: PooledSession) -> bool:
+        if not pooled.alive:
+            return False
+        now = time.monotonic()
+        if now - pooled.created_at > self.max_lifetime_seconds:
+            return False
+        if now - pooled.last_used > self.max_idle_seconds:
+            try:
+                await asyncio.wait_for(pooled.session.send_ping(), timeout=self.ping_timeout)
+            except Exception as e:
+                logger.info(f"mcp_session_ping_fail {pooled.server_addr}: {e}")
+                return False
+        return True
+
+    async def acquire(self, server_addr: str) -> PooledSession:
+        """借出一个可用会话，必要时新建"""
+        pool = self._server_pool(server_addr)
+        try:
+            await asyncio.wait_for(pool.slots.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"等待 MCP 会话超时 {server_addr}, 当前会话数上限 {self.max_size}")
+        try:
+            while pool.idle:
+                pooled = pool.idle.pop()
+                if await self._is_usable(pooled):
+                    pool.reused += 1
+                    pool.in_use += 1
+                    return pooled
+                pool.evicted += 1
+                await pooled.close()
+            pooled = PooledSession(server_addr, self._on_notification)
+            await pooled.open(self.http_client_factory, self.http_timeout, self.sse_timeout)
+            pool.created += 1
+            pool.in_use += 1
+            logger.info(f"mcp_session_created {server_addr}, created={pool.created}")
+            return pooled
+        except BaseException:
+            pool.slots.release()
+            raise
+
+    async def release(self, pooled: PooledSession, discard: bool = False):
+        """归还会话，discard=True 或会话已不可用时直接关闭"""
+        pool = self._server_pool(pooled.server_addr)
+        pool.in_use -= 1
+        pooled.last_used = time.monotonic()
+        try:
+            expired = pooled.last_used - pooled.created_at > self.max_lifetime_seconds
+            if discard or expired or not pooled.alive:
+                pool.evicted += 1
+                await pooled.close()
+            else:
+                pool.idle.append(pooled)
+        finally:
+            pool.slots.release()
+
+    async def _run_with_session(self, server_addr: str, action: Callable, idempotent: bool):
+        """
+        借出会话执行请求，会话损坏时剔除
+        idempotent=False 时只在请求确定没有发送出去时重连重试，避免工具在服务端被执行两次
+        """
+        for attempt in range(2):
+            pooled = await self.acquire(server_addr)
+            try:
+                result = await pooled.run(action(pooled.session))
+            except BaseException as e:
+                await self.release(pooled, discard=True)
+                retryable = is_connection_error(e) if idempotent else is_request_not_sent(e)
+                if attempt == 0 and retryable:
+                    logger.warning(f"mcp_session_broken {server_addr}: {e}, reconnect and retry")
+                    continue
+                raise
+            await self.release(pooled)
+            return result
+
+    async def call_tool(self, server_addr: str, tool_name: str, params: dict | None = None,
+                        timeout: float | None = None, meta: dict | None = None) -> Any:
+        """
+        使用池中会话调用工具，只在请求确定没有发送出去时透明重连，其他失败由调用方的重试策略决定是否重试
+        :param meta: 放入 tools/call 请求 _meta 的附加信息，例如 tracing.propagation_meta() 返回的 request_id、traceparent
+        """
+        read_timeout = timedelta(seconds=timeout or self.sse_timeout)
+        return await self._run_with_session(
+            server_addr, lambda session: session.call_tool(tool_name, params or {}, read_timeout_seconds=read_timeout,
+                                                           meta=meta),
+            idempotent=False)
+
+    async def list_tools(self, server_addr: str) -> Any:
+        """使用池中会话获取工具列表"""
+        return await self._run_with_session(
+            server_addr, lambda session: asyncio.wait_for(session.list_tools(), timeout=self.http_timeout),
+            idempotent=True)
+
+    async def close_all(self):
+        """关闭所有空闲会话"""
+        for pool in self._servers.values():
+            while pool.idle:
+                await pool.idle.pop().close()
+
+    def stats(self) -> dict:
+        return {
+            addr: {
+                "idle": len(pool.idle),
+                "in_use": pool.in_use,
+                "created": pool.created,
+                "reused": pool.reused,
+                "evicted": pool.evicted,
+            }
+            for addr, pool in self._servers.items()
+        }
+
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+Prometheus 文本格式的运行指标，http_mcp.py、asgi_mcp.py、server.py 通过 /metrics 接口输出
+
+指标在各模块的热点路径上直接累加（一次加锁的字典更新），LLM、工具调用、数据后端的耗时由 tracing 的 span 结束时记录。
+多进程（gunicorn、uvicorn --workers）时需要配置 multiprocess_dir，每个工作进程定时把自己的指标写入该目录下的快照文件
+（<应用名>_<pid>.json），任意一个进程收到 /metrics 请求时合并同一应用所有存活进程的快照后输出：
+counter、histogram 和 in-flight 类的 gauge 都按进程求和。已退出进程的快照文件会被删除，其计数随之消失，
+Prometheus 的 rate()/increase() 会把这种下降当作计数器重置处理。
+配置读取自 cfg.yml 的 metrics 段:
+    metrics:
+        multiprocess_dir: ""              # 多个工作进程共享的快照目录，例如 ./metrics_data，为空（默认）时只输出当前进程的指标
+        flush_interval: 5                 # 快照写入周期（秒）
+"""
+
+import atexit
+import bisect
+import contextlib
+import glob
+import json
+import logging.config
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable
+
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_METRICS_CFG = {
+    "multiprocess_dir": "",
+    "flush_interval": 5,
+}
+
+# 耗时类直方图的桶（秒），覆盖本地缓存命中到长时间运行的 LLM 调用
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REGISTRY: dict[str, "Metric"] = {}
+_collectors: list[Callable[[], None]] = []
+
+
+def get_metrics_cfg() -> dict:
+    """读取 cfg.yml 中的 metrics 配置，与默认值合并"""
+    metrics_cfg = dict(DEFAULT_METRICS_CFG)
+    if os.path.exists(cfg_file_path):
+        metrics_cfg.update(init_yml_cfg().get("metrics") or {})
+    return metrics_cfg
+
+
+class Metric:
+    """一个指标族，按标签值分别计数"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        # 热点路径上只取值组成 key，转为字符串、转义留到输出时再做
+        return tuple(map(labels.get, self.labelnames))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(key), value.copy() if isinstance(value, list) else value]
+                      for key, value in self._values.items()]
+        return {"type": self.type_name, "help": self.documentation, "labelnames": list(self.labelnames),
+                "values": values}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        """由 collector 使用，从模块已有的累计统计（例如 ttl_cache 的命中数）同步计数"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    """可增可减的当前值，例如进行中的对话数"""
+
+    type_name = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """分桶计数的分布，每组标签的值为 [各桶计数..., +Inf 桶计数, sum]"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # 只累加第一个满足 value <= le 的桶，输出时再求累计值
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+
+# ---- 客户端（http_mcp.py、asgi_mcp.py）----
+HTTP_REQUESTS = Counter("mcp_http_requests_total", "Web 接口收到的请求数", ("endpoint", "status"))
+CONVERSATIONS_IN_FLIGHT = Gauge("mcp_conversations_in_flight", "正在进行中的对话数")
+CONVERSATION_SECONDS = Histogram("mcp_conversation_seconds", "一次提问从开始到结束的耗时", ("status",))
+CONVERSATION_ITERATIONS = Histogram("mcp_conversation_iterations", "一次提问与 LLM 交互的轮数", (),
+                                    buckets=(1, 2, 3, 4, 5, 6, 7, 8, 9, 10))
+LLM_SECONDS = Histogram("mcp_llm_request_seconds", "调用 LLM 的耗时（流式调用为接收完全部内容的耗时）",
+                        ("status",))
+TOOL_CALL_SECONDS = Histogram("mcp_tool_call_seconds", "客户端调用 MCP 工具的耗时，包括重试和更换副本",
+                              ("tool", "status"))
+TOOL_DISCOVERY_SECONDS = Histogram("mcp_tool_discovery_seconds", "对话开始前获取 MCP 工具列表的耗时")
+
+# ---- MCP Server（server.py）----
+SERVER_TOOLS_IN_FLIGHT = Gauge("mcp_server_tools_in_flight", "正在执行的工具调用数")
+SERVER_TOOL_SECONDS = Histogram("mcp_server_tool_seconds", "MCP Server 执行工具的耗时", ("tool", "status"))
+BACKEND_SECONDS = Histogram("mcp_backend_request_seconds", "工具访问数据后端（tool_api_uri）的耗时，包括重试",
+                            ("status",))
+
+# ---- 公共 ----
+UPSTREAM_REQUESTS = Counter(
+    "mcp_upstream_requests_total",
+    "对上游（LLM、数据后端、MCP Server 副本）的单次请求数，"
+    "result: success, failure（计入熔断的失败）, error（不计入熔断的失败，例如 4xx）, rejected（熔断中拒绝）, cancelled",
+    ("upstream", "result"))
+RETRIES = Counter("mcp_retries_total", "失败后进行的重试次数", ("operation",))
+RETRY_GIVE_UPS = Counter("mcp_retry_give_ups_total", "不再重试的次数，reason: non_retryable, max_attempts, deadline, budget",
+                         ("operation", "reason"))
+TIMEOUTS = Counter("mcp_timeouts_total", "请求超时次数（每次尝试分别计数）", ("operation",))
+CACHE_LOOKUPS = Counter("mcp_cache_lookups_total", "工具结果缓存的查找次数，result: hit, stale_hit, miss，"
+                                                   "命中率为 hit 与 stale_hit 之和除以总数", ("cache", "result"))
+
+# span 名称与耗时直方图的对应关系，以及从 span 属性中取值的标签
+_SPAN_HISTOGRAMS = {
+    "auto_call_mcp": (CONVERSATION_SECONDS, ()),
+    "llm": (LLM_SECONDS, ()),
+    "mcp_tool": (TOOL_CALL_SECONDS, ("tool",)),
+    "tool_discovery": (TOOL_DISCOVERY_SECONDS, None),
+    "tool": (SERVER_TOOL_SECONDS, ("tool",)),
+    "backend": (BACKEND_SECONDS, ()),
+}
+
+
+def observe_span(name: str, seconds: float, status: str, attributes: dict):
+    """span 结束时由 tracing 调用，记录到对应的耗时直方图"""
+    histogram_labels = _SPAN_HISTOGRAMS.get(name)
+    if histogram_labels is None:
+        return
+    histogram, label_keys = histogram_labels
+    if label_keys is None:
+        histogram.observe(seconds)
+    else:
+        histogram.observe(seconds, status=status, **{key: attributes.get(key, "") for key in label_keys})
+    if name == "auto_call_mcp" and "iterations" in attributes:
+        CONVERSATION_ITERATIONS.observe(attributes["iterations"])
+
+
+def register_collector(collector: Callable[[], None]):
+    """注册在输出指标或写快照前执行的回调，用于把模块已有的统计同步到指标中"""
+    _collectors.append(collector)
+
+
+def collect_cache_stats():
+    import ttl_cache
+    for cache_name, stats in ttl_cache.cache_stats().items():
+        for result, key in (("hit", "hits"), ("stale_hit", "stale_hits"), ("miss", "misses")):
+            if key in stats:
+                CACHE_LOOKUPS.set_total(stats[key], cache=cache_name, result=result)
+
+
+register_collector(collect_cache_stats)
+
+
+def snapshot() -> dict:
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception:
+            logger.exception("metrics_collector_error")
+    return {name: metric.snapshot() for name, metric in list(REGISTRY.items())}
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict:
+    """合并多个进程的快照，相同指标、相同标签的值相加"""
+    merged: dict[str, dict] = {}
+    for item in snapshots:
+        for name, metric in item.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for labelvalues, value in metric["values"]:
+                key = tuple(labelvalues)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value.copy() if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target["values"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target["values"][key] = current + value
+    return merged
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labelnames: Iterable[str], labelvalues: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value) -> str:
+    return ("" if value is None else str(value)).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_text(merged: dict) -> str:
+    """按 Prometheus 文本格式输出合并后的指标"""
+    lines = []
+    for name, metric in merged.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+        for labelvalues, value in sorted(metric["values"].items(), key=lambda item: tuple(map(str, item[0]))):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{format_labels(labelnames, labelvalues)} {format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric["buckets"]) + [math.inf], value[:-1]):
+                cumulative += count
+                le = f'le="{format_value(float(bound))}"'
+                lines.append(f"{name}_bucket{format_labels(labelnames, labelvalues, le)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labelnames, labelvalues)} {format_value(value[-1])}")
+            lines.append(f"{name}_count{format_labels(labelnames, labelvalues)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class _Exporter:
+    """当前进程的快照写入器"""
+
+    def __init__(self, app_name: str, multiprocess_dir: str, flush_interval: float):
+        self.app_name = app_name
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        os.makedirs(multiprocess_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="metrics_flush", daemon=True)
+        self._thread.start()
+
+    @property
+    def file_path(self) -> str:
+        return os.path.join(self.multiprocess_dir, f"{self.app_name}_{self.pid}.json")
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"metrics_flush_fail {self.file_path}: {e}")
+
+    def flush(self) -> dict:
+        data = snapshot()
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.file_path)
+        return data
+
+    def read_all(self) -> list[dict]:
+        """读取同一应用所有存活进程的快照，当前进程使用最新的值，已退出进程的快照文件删除"""
+        snapshots = [self.flush()]
+        for path in glob.glob(os.path.join(self.multiprocess_dir, f"{self.app_name}_*.json")):
+            try:
+                pid = int(Path(path).stem.rsplit("_", 1)[1])
+            except ValueError:
+                continue
+            if pid == self.pid:
+                continue
+            if not is_process_alive(pid):
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, json.JSONDecodeError) as e:
+                # 快照正在被替换时可能读到不完整的内容，本次跳过
+                logger.debug(f"metrics_snapshot_read_fail {path}: {e}")
+        return snapshots
+
+    def remove(self):
+        with contextlib.suppress(OSError):
+            os.remove(self.file_path)
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_exporter: _Exporter | None = None
+_app_name: str | None = None
+
+
+def start(app_name: str):
+    """
+    在工作进程中启动指标快照的定时写入，应用启动时调用一次
+    :param app_name: 应用名称，同一应用的多个工作进程的指标合并输出，不同应用（例如 http_mcp 和 mcp_server）互不影响
+    """
+    global _exporter, _app_name
+    _app_name = app_name
+    if _exporter is not None and _exporter.pid == os.getpid():
+        return
+    metrics_cfg = get_metrics_cfg()
+    if not metrics_cfg["multiprocess_dir"]:
+        return
+    _exporter = _Exporter(app_name, metrics_cfg["multiprocess_dir"], metrics_cfg["flush_interval"])
+    atexit.register(_exporter.remove)
+    logger.info(f"metrics_exporter_started {_exporter.file_path}")
+
+
+def _after_fork_in_child():
+    # fork 出来的工作进程继承了父进程的计数，清零后由子进程重新计数，并启动自己的快照写入线程
+    global _exporter
+    for metric in list(REGISTRY.values()):
+        metric.reset()
+    if _exporter is not None:
+        _exporter = None
+        start(_app_name)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def render() -> str:
+    """/metrics 接口的输出内容"""
+    if _exporter is not None and _exporter.pid == os.getpid():
+        return render_text(merge_snapshots(_exporter.read_all()))
+    return render_text(merge_snapshots([snapshot()]))
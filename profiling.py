@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+按请求开启的性能剖析，用于在生产环境中抓取个别请求的热点
+
+请求头 X-Profile（名称可配置）的值为 1 或 sample、cprofile 时，对该请求做一次剖析，结果写入 output_dir，文件名为请求ID:
+- sample: 按 interval 采样请求线程和后台事件循环线程（aio_loop）的调用栈，开销小；
+  输出 <request_id>.folded（每行一个折叠的调用栈及其采样次数，可用 flamegraph.pl、speedscope 生成火焰图）
+- cprofile: 使用 cProfile 确定性地统计函数调用次数和耗时，开销较大（Python 3.12 起会统计进程内所有线程）；
+  输出 <request_id>.prof，可用 python -m pstats、snakeviz 查看
+同一进程中同时只剖析一个请求，其他带请求头的请求照常处理、不做剖析。日志中输出耗时最多的 top 个函数。
+配置读取自 cfg.yml 的 profiling 段:
+    profiling:
+        enabled: false         # 为 false 时忽略请求头
+        header: X-Profile
+        mode: sample           # 请求头的值不是 sample、cprofile 时使用的方式
+        output_dir: ./profiles
+        interval: 0.005        # sample 方式的采样间隔（秒）
+        top: 20
+"""
+
+import abc
+import collections
+import cProfile
+import io
+import logging.config
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+MODE_SAMPLE = "sample"
+MODE_CPROFILE = "cprofile"
+
+DEFAULT_PROFILING_CFG = {
+    "enabled": False,
+    "header": "X-Profile",
+    "mode": MODE_SAMPLE,
+    "output_dir": "./profiles",
+    "interval": 0.005,
+    "top": 20,
+}
+
+# 请求ID可能来自客户端的请求头，写文件前去掉路径分隔符等字符
+_UNSAFE_FILE_CHARS = re.compile(r"[^0-9A-Za-z_.-]")
+
+# 同一进程中同时只剖析一个请求：cProfile 在 Python 3.12 起只能有一个处于启用状态，采样也会拖慢其他请求
+_active_lock = threading.Lock()
+_profiling_cfg: dict | None = None
+
+
+def get_profiling_cfg() -> dict:
+    """读取 cfg.yml 中的 profiling 配置，与默认值合并，只读取一次"""
+    global _profiling_cfg
+    if _profiling_cfg is None:
+        profiling_cfg = dict(DEFAULT_PROFILING_CFG)
+        if os.path.exists(cfg_file_path):
+            profiling_cfg.update(init_yml_cfg().get("profiling") or {})
+        _profiling_cfg = profiling_cfg
+    return _profiling_cfg
+
+
+def header_name() -> str:
+    return get_profiling_cfg()["header"]
+
+
+class RequestProfile(abc.ABC):
+    """一次请求的剖析，子类实现 start 和 _finish，stop 可以重复调用，只有第一次生效"""
+
+    suffix = ""
+
+    def __init__(self, request_id: str, profiling_cfg: dict):
+        self.request_id = request_id
+        self.cfg = profiling_cfg
+        self.file_name = f"{_UNSAFE_FILE_CHARS.sub('_', request_id)[:64].lstrip('.')}{self.suffix}"
+        self._start = time.perf_counter()
+        self._stopped = False
+
+    @abc.abstractmethod
+    def start(self):
+        """开始剖析"""
+
+    @abc.abstractmethod
+    def _finish(self, path: str) -> str:
+        """停止剖析，把结果写入 path，返回日志中输出的热点摘要"""
+
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        try:
+            os.makedirs(self.cfg["output_dir"], exist_ok=True)
+            path = os.path.join(self.cfg["output_dir"], self.file_name)
+            report = self._finish(path)
+            logger.info(f"request_profile_saved {path}, request_id={self.request_id}, "
+                        f"elapsed_ms={(time.perf_counter() - self._start) * 1000:.1f}\n{report}")
+        except Exception as e:
+            logger.exception(f"request_profile_failed, request_id={self.request_id}: {e}")
+        finally:
+            _active_lock.release()
+
+
+class CProfileRequestProfile(RequestProfile):
+    """cProfile 确定性剖析"""
+
+    suffix = ".prof"
+
+    def start(self):
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def _finish(self, path: str) -> str:
+        self._profiler.disable()
+        self._profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(self._profiler, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.cfg["top"])
+        return out.getvalue()
+
+
+class SamplingRequestProfile(RequestProfile):
+    """在独立线程中定时采样指定线程的调用栈"""
+
+    suffix = ".folded"
+
+    def __init__(self, request_id: str, profiling_cfg: dict, thread_ids: list[int]):
+        super().__init__(request_id, profiling_cfg)
+        self.thread_ids = [tid for tid in thread_ids if tid]
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop_event.wait(self.cfg["interval"]):
+            frames = sys._current_frames()
+            for tid in self.thread_ids:
+                frame = frames.get(tid)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                # 以线程名作为根节点，火焰图中按线程分开
+                stack.append(thread_names.get(tid, str(tid)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def _finish(self, path: str) -> str:
+        self._stop_event.set()
+        self._thread.join()
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        # 自身耗时（栈顶）和累计耗时（出现在栈中），同一个栈中重复出现的函数只计一次
+        own, total = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        lines = [f"samples={self.samples}, interval={self.cfg['interval']}s, threads={len(self.thread_ids)}",
+                 f"{'own':>7} {'total':>7}  function"]
+        for name, count in own.most_common(self.cfg["top"]):
+            lines.append(f"{count:>7} {total[name]:>7}  {name}")
+        return "\n".join(lines)
+
+
+def start_request_profile(header_value: str | None, request_id: str,
+                          thread_ids: list[int] | None = None) -> RequestProfile | None:
+    """
+    根据请求头的值开始剖析，未启用、请求头为空或已有请求在剖析时返回 None
+    :param thread_ids: sample 方式采样的线程，默认为当前线程
+    """
+    profiling_cfg = get_profiling_cfg()
+    if not header_value or not profiling_cfg["enabled"] or header_value.strip().lower() in ("0", "false", "off"):
+        return None
+    if not _active_lock.acquire(blocking=False):
+        logger.info(f"request_profile_skipped, another request is being profiled, request_id={request_id}")
+        return None
+    mode = header_value.strip().lower()
+    if mode not in (MODE_SAMPLE, MODE_CPROFILE):
+        mode = profiling_cfg["mode"]
+    try:
+        if mode == MODE_CPROFILE:
+            profile = CProfileRequestProfile(request_id, profiling_cfg)
+        else:
+            profile = SamplingRequestProfile(request_id, profiling_cfg, thread_ids or [threading.get_ident()])
+        profile.start()
+    except Exception as e:
+        _active_lock.release()
+        logger.exception(f"request_profile_start_failed, request_id={request_id}: {e}")
+        return None
+    logger.info(f"request_profile_started mode={mode}, request_id={request_id}")
+    return profile
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+SQL 查询结果分页
+
+数据后端 /exec/task 一次返回全部结果，这里把完整结果暂存在 MCP Server 的游标存储中，
+工具只返回行数和字节数都有上限的第一页，以及总行数和继续获取的游标（next_cursor），
+LLM 或前端按需调用 fetch_sql_result_page 获取后续数据，避免大结果集整体进入 LLM 上下文。
+配置读取自 cfg.yml 的 sql_result 段，未配置时使用默认值:
+    sql_result:
+        page_rows: 100                # 每页最多返回的行数
+        page_bytes: 65536             # 每页最多返回的字节数（按 JSON 估算），至少返回一行
+        cursor_ttl: 600               # 游标的有效期（秒）
+        cursor_max_size: 256          # 最多保留多少个游标
+        cursor_max_bytes: 268435456   # 所有游标暂存结果的总字节数上限
+server.py 配置了 mcp_server.shared_dir 时（多个工作进程必须配置），完整结果同时写入共享目录，
+fetch_sql_result_page 落到任意一个工作进程上都能读取到，见 SharedCursorStore
+"""
+
+import contextlib
+import json
+import logging.config
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from sys_init import cfg_file_path, init_yml_cfg
+from ttl_cache import CACHES, TTLCache
+from utils import convert_list_to_format
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_CFG = {
+    "page_rows": 100,
+    "page_bytes": 64 * 1024,
+    "cursor_ttl": 600,
+    "cursor_max_size": 256,
+    "cursor_max_bytes": 256 * 1024 * 1024,
+}
+
+# 共享目录中清理过期、超量游标文件的最小间隔（秒）
+SHARED_CLEANUP_INTERVAL = 30
+
+_CURSOR_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+_lock = threading.Lock()
+_page_cfg: dict | None = None
+_cursor_store: "TTLCache | SharedCursorStore | None" = None
+_shared_dir: str | None = None
+
+
+class CursorExpiredError(ValueError):
+    """游标不存在或已过期"""
+
+
+def get_page_cfg() -> dict:
+    """读取 cfg.yml 中的 sql_result 配置，与默认值合并"""
+    global _page_cfg
+    if _page_cfg is None:
+        page_cfg = dict(DEFAULT_PAGE_CFG)
+        if os.path.exists(cfg_file_path):
+            page_cfg.update(init_yml_cfg().get("sql_result") or {})
+        _page_cfg = page_cfg
+    return _page_cfg
+
+
+class SharedCursorStore:
+    """
+    多个工作进程共享的游标存储，每个游标的完整结果是共享目录下的一个 JSON 文件，按文件修改时间判断是否过期
+    写入或读取过的结果同时保存在进程内的 TTLCache 中，在同一个工作进程中连续翻页时不必重复读取文件
+    """
+
+    def __init__(self, directory: str, local: TTLCache, ttl: float, max_size: int, max_bytes: int):
+        self.directory = directory
+        self.local = local
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._last_cleanup = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, cursor_id: str) -> str:
+        return os.path.join(self.directory, f"{cursor_id}.json")
+
+    def set(self, cursor_id: str, rows: list[dict], size: int) -> bool:
+        if size > self.max_bytes:
+            return False
+        path = self._path(cursor_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, default=str)
+        # 先写临时文件再改名，其他工作进程不会读到写了一半的文件
+        os.replace(tmp_path, path)
+        self.local.set(cursor_id, rows, size)
+        self._cleanup()
+        return True
+
+    def get(self, cursor_id: str) -> tuple[bool, list[dict] | None, bool]:
+        hit, rows, stale = self.local.get(cursor_id)
+        if hit:
+            return hit, rows, stale
+        # 游标来自 LLM 或前端，只接受本模块生成的格式，避免拼出共享目录之外的路径
+        if not _CURSOR_ID_PATTERN.match(cursor_id):
+            return False, None, False
+        path = self._path(cursor_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return False, None, False
+            with open(path, encoding="utf-8") as f:
+                rows = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False, None, False
+        self.local.set(cursor_id, rows, os.path.getsize(path))
+        return True, rows, False
+
+    def invalidate(self, key: str | None = None) -> int:
+        return self.local.invalidate(key)
+
+    def _cleanup(self):
+        """删除过期的游标文件，文件数或总字节数超过上限时删除最早写入的文件，各工作进程都可能执行，删除失败时忽略"""
+        now = time.time()
+        if now - self._last_cleanup < SHARED_CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total_bytes = sum(size for _, size, _ in files)
+        removed = 0
+        for i, (mtime, size, path) in enumerate(files):
+            if now - mtime <= self.ttl and len(files) - i <= self.max_size and total_bytes <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+                removed += 1
+            total_bytes -= size
+        if removed:
+            logger.info(f"shared_cursor_cleanup {self.directory}, removed={removed}, remain={len(files) - removed}")
+
+
+def use_shared_dir(directory: str):
+    """多个工作进程时由 server.py 在创建应用时调用，游标的完整结果写入共享目录"""
+    global _shared_dir, _cursor_store
+    with _lock:
+        _shared_dir = directory
+        _cursor_store = None
+    logger.info(f"sql_cursor_shared_dir {directory}")
+
+
+def get_cursor_store() -> "TTLCache | SharedCursorStore":
+    """游标存储，超过总字节数上限时淘汰最久未使用的游标，命中统计可以通过 /cache 查看"""
+    global _cursor_store
+    if _cursor_store is None:
+        with _lock:
+            if _cursor_store is None:
+                page_cfg = get_page_cfg()
+                local = TTLCache("sql_cursor", max_size=page_cfg["cursor_max_size"],
+                                 ttl=page_cfg["cursor_ttl"], max_bytes=page_cfg["cursor_max_bytes"],
+                                 max_item_bytes=page_cfg["cursor_max_bytes"])
+                CACHES["sql_cursor"] = local
+                _cursor_store = local
+                if _shared_dir:
+                    _cursor_store = SharedCursorStore(_shared_dir, local, page_cfg["cursor_ttl"],
+                                                      page_cfg["cursor_max_size"], page_cfg["cursor_max_bytes"])
+    return _cursor_store
+
+
+def row_size(row: dict) -> int:
+    return len(json.dumps(row, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+def take_page(rows: list[dict], offset: int) -> tuple[list[dict], int, int]:
+    """
+    从 offset 开始取一页数据，行数不超过 page_rows，字节数不超过 page_bytes（至少一行）
+    :return: (本页数据, 下一页的 offset, 本页字节数)
+    """
+    page_cfg = get_page_cfg()
+    page, page_bytes = [], 0
+    end = offset
+    while end < len(rows) and len(page) < page_cfg["page_rows"]:
+        size = row_size(rows[end])
+        if page and page_bytes + size > page_cfg["page_bytes"]:
+            break
+        page.append(rows[end])
+        page_bytes += size
+        end += 1
+    return page, end, page_bytes
+
+
+def page_msg(total_rows: int, offset: int, end: int, next_cursor: str | None) -> str:
+    if end >= total_rows and offset == 0:
+        return ""
+    msg = f"共 {total_rows} 行，本次返回第 {offset + 1}-{end} 行"
+    if next_cursor:
+        msg += "，使用 fetch_sql_result_page(cursor=next_cursor) 获取后续数据，也可以修改SQL增加过滤条件、聚合或 LIMIT"
+    elif end < total_rows:
+        msg += "，结果过大无法暂存，请修改SQL增加过滤条件、聚合或 LIMIT"
+    return msg
+
+
+def build_page_result(page: list[dict], result_format: str, **fields) -> dict:
+    """按 result_format 编码本页数据，非 rows 格式时 data 为空列表"""
+    result = {"data": [], "result_format": result_format}
+    result.update(convert_list_to_format(page, result_format))
+    result.update(fields)
+    return result
+
+
+def paginate(rows: list[dict], result_format: str = "rows") -> dict:
+    """
+    返回第一页数据，数据超过一页时暂存完整结果并生成游标
+    :param result_format: 本页数据的编码格式，见 utils.RESULT_FORMATS
+    :return: SqlExecResult 的字段
+    """
+    page, end, page_bytes = take_page(rows, 0)
+    next_cursor = None
+    if end < len(rows):
+        cursor_id = uuid.uuid4().hex
+        # 按第一页的平均行大小估算完整结果的字节数，避免把全部结果再序列化一遍
+        estimated_bytes = page_bytes * len(rows) // max(1, len(page))
+        if get_cursor_store().set(cursor_id, rows, estimated_bytes):
+            next_cursor = f"{cursor_id}:{end}"
+        logger.info(f"sql_result_paginated total_rows={len(rows)}, first_page_rows={len(page)}, cursor={next_cursor}")
+    return build_page_result(page, result_format,
+                             msg=page_msg(len(rows), 0, end, next_cursor),
+                             total_rows=len(rows),
+                             truncated=end < len(rows),
+                             next_cursor=next_cursor)
+
+
+def fetch_page(cursor: str, result_format: str = "rows") -> dict:
+    """根据游标获取下一页，游标不存在或过期时抛出 CursorExpiredError"""
+    cursor_id, _, offset = cursor.partition(":")
+    hit, rows, _ = get_cursor_store().get(cursor_id)
+    if not hit or not offset.isdigit():
+        raise CursorExpiredError(f"游标 {cursor} 不存在或已过期，请重新执行查询")
+    offset = int(offset)
+    page, end, _ = take_page(rows, offset)
+    next_cursor = f"{cursor_id}:{end}" if end < len(rows) else None
+    return build_page_result(page, result_format,
+                             msg=page_msg(len(rows), offset, end, next_cursor),
+                             total_rows=len(rows),
+                             truncated=end < len(rows),
+                             next_cursor=next_cursor)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+可复用的重试策略
+
+- 退避时间使用 full jitter: random(0, min(max_delay, base_delay * 2 ** attempt))，避免大量线程同步重试
+- 服务端返回 Retry-After 时按其等待
+- 进程级重试预算：每次请求存入 budget_ratio 个令牌，每次重试消耗一个，上游大面积故障时不会把请求量放大数倍
+- deadline 限制所有尝试（含等待）的总耗时
+- 区分可重试和不可重试的错误，例如 400/401/403/404 直接失败
+
+配置读取自 cfg.yml 的 retry 段，未配置时使用默认值:
+    retry:
+        max_attempts: 3
+        base_delay: 0.5
+        max_delay: 10
+        deadline: 90
+        budget_ratio: 0.2
+        budget_min_per_second: 1
+"""
+
+import asyncio
+import email.utils
+import logging.config
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import httpx
+import requests
+
+import metrics
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRY_CFG = {
+    "max_attempts": 3,
+    "base_delay": 0.5,
+    "max_delay": 10,
+    "deadline": 90,
+    "budget_ratio": 0.2,
+    "budget_min_per_second": 1,
+}
+
+# 可以重试的 HTTP 状态码，其余非 2xx 状态码（400、401、403、404、422 等）重试也不会成功
+RETRYABLE_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# 可以重试的异常：超时和连接错误
+RETRYABLE_EXCEPTIONS = (
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    httpx.TimeoutException,
+    httpx.NetworkError,
+    httpx.RemoteProtocolError,
+    ConnectionError,
+    TimeoutError,
+)
+
+# 超时类异常，单独计入 mcp_timeouts_total 指标
+TIMEOUT_EXCEPTIONS = (
+    requests.exceptions.Timeout,
+    httpx.TimeoutException,
+    TimeoutError,
+)
+
+
+class HttpStatusError(RuntimeError):
+    """HTTP 请求返回了非 2xx 状态码"""
+
+    def __init__(self, uri: str, status_code: int, body: str = "", retry_after: float | None = None):
+        super().__init__(f"request API 返回非200状态码: {status_code}, {uri}, {body}")
+        self.uri = uri
+        self.status_code = status_code
+        self.body = body
+        self.retry_after = retry_after
+
+
+class RetryError(RuntimeError):
+    """重试次数、时间或预算用尽后仍然失败"""
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """解析 Retry-After 头，支持秒数和 HTTP 日期两种格式"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryBudget:
+    """
+    进程级重试预算（令牌桶）
+    每次请求存入 ratio 个令牌，每次重试消耗 1 个令牌；另外每秒补充 min_per_second 个令牌，保证低流量时也能重试
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1, max_tokens: float = 100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._last_refill) * self.min_per_second)
+        self._last_refill = now
+
+    def record_request(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+class RetryState:
+    """一次调用（含多次尝试）的重试状态"""
+
+    def __init__(self, policy: "RetryPolicy", name: str):
+        self.policy = policy
+        self.name = name
+        # 指标中的 operation 标签取名称的第一段，例如 POST、GET、call_mcp_tool，避免把 URI 作为标签值
+        self.operation = name.split(" ", 1)[0]
+        self.attempt = 0
+        self.started = time.monotonic()
+        self.last_error: BaseException | None = None
+
+    def remaining(self) -> float | None:
+        """距离 deadline 剩余的秒数，没有 deadline 时返回 None"""
+        if not self.policy.deadline:
+            return None
+        return max(0.0, self.policy.deadline - (time.monotonic() - self.started))
+
+    def next_delay(self, e: BaseException) -> float | None:
+        """
+        记录一次失败，返回下次重试前需要等待的秒数，返回 None 表示不再重试
+        """
+        self.attempt += 1
+        self.last_error = e
+        policy = self.policy
+        if isinstance(e, TIMEOUT_EXCEPTIONS):
+            metrics.TIMEOUTS.inc(operation=self.operation)
+        if not policy.is_retryable(e):
+            logger.warning(f"retry_give_up_non_retryable {self.name}: {e}")
+            metrics.RETRY_GIVE_UPS.inc(operation=self.operation, reason="non_retryable")
+            return None
+        if self.attempt >= policy.max_attempts:
+            logger.warning(f"retry_give_up_max_attempts {self.name}, attempts={self.attempt}: {e}")
+            metrics.RETRY_GIVE_UPS.inc(operation=self.operation, reason="max_attempts")
+            return None
+        delay = policy.retry_after(e)
+        if delay is None:
+            delay = policy.backoff(self.attempt - 1)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            logger.warning(f"retry_give_up_deadline {self.name}, delay={delay:.2f}s, remaining={remaining:.2f}s: {e}")
+            metrics.RETRY_GIVE_UPS.inc(operation=self.operation, reason="deadline")
+            return None
+        if not policy.budget.try_spend():
+            logger.warning(f"retry_give_up_budget_exhausted {self.name}: {e}")
+            metrics.RETRY_GIVE_UPS.inc(operation=self.operation, reason="budget")
+            return None
+        logger.warning(f"retry {self.name}, attempt {self.attempt}/{policy.max_attempts}, sleep {delay:.2f}s: {e}")
+        metrics.RETRIES.inc(operation=self.operation)
+        return delay
+
+    def give_up(self) -> BaseException:
+        """不再重试时抛出的异常，不可重试的错误原样抛出"""
+        e = self.last_error
+        if e is not None and not self.policy.is_retryable(e):
+            return e
+        return RetryError(f"{self.name} 调用失败，已尝试 {self.attempt} 次: {e}")
+
+
+class RetryPolicy:
+    """重试策略"""
+
+    def __init__(self,
+            max_attempts: int = 3,
+            base_delay: float = 0.5,
+            max_delay: float = 10,
+            deadline: float | None = 90,
+            retryable_status: frozenset = RETRYABLE_STATUS,
+            retryable_exceptions: tuple = RETRYABLE_EXCEPTIONS,
+            classifier: Callable[[BaseException], bool] | None = None,
+            budget: RetryBudget | None = None):
+        self.max_attempts = max(1, max_attempts)  # 最多尝试次数（含第一次）
+        self.base_delay = base_delay  # 退避基准时间（秒）
+        self.max_delay = max_delay  # 单次退避的上限（秒）
+        self.deadline = deadline  # 所有尝试的总耗时上限（秒）
+        self.retryable_status = retryable_status
+        self.retryable_exceptions = retryable_exceptions
+        self.classifier = classifier  # 额外的可重试判断，返回 True 表示可以重试
+        self.budget = budget or default_budget
+
+    def copy(self, **overrides) -> "RetryPolicy":
+        attrs = dict(self.__dict__)
+        attrs.update({k: v for k, v in overrides.items() if v is not None})
+        return RetryPolicy(**attrs)
+
+    def is_retryable(self, e: BaseException) -> bool:
+        if isinstance(e, HttpStatusError):
+            return e.status_code in self.retryable_status
+        if isinstance(e, self.retryable_exceptions):
+            return True
+        return bool(self.classifier and self.classifier(e))
+
+    def backoff(self, attempt: int) -> float:
+        """full jitter 退避时间"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def retry_after(self, e: BaseException) -> float | None:
+        return getattr(e, "retry_after", None)
+
+    def start(self, name: str) -> RetryState:
+        self.budget.record_request()
+        return RetryState(self, name)
+
+    def call(self, fn: Callable[[float | None], Any], name: str = "") -> Any:
+        """
+        同步执行 fn，失败时按策略重试
+        :param fn: 执行一次尝试，参数为距离 deadline 剩余的秒数，可用于限制本次请求的超时时间
+        """
+        state = self.start(name)
+        while True:
+            try:
+                return fn(state.remaining())
+            except Exception as e:
+                delay = state.next_delay(e)
+                if delay is None:
+                    raise state.give_up() from e
+            time.sleep(delay)
+
+    async def acall(self, fn: Callable[[float | None], Awaitable[Any]], name: str = "") -> Any:
+        """异步执行 fn，失败时按策略重试，等待期间不阻塞事件循环"""
+        state = self.start(name)
+        while True:
+            try:
+                return await fn(state.remaining())
+            except Exception as e:
+                delay = state.next_delay(e)
+                if delay is None:
+                    raise state.give_up() from e
+            await asyncio.sleep(delay)
+
+
+default_budget = RetryBudget()
+_default_policy: RetryPolicy | None = None
+
+
+def get_retry_cfg() -> dict:
+    """读取 cfg.yml 中的 retry 配置，与默认值合并"""
+    retry_cfg = dict(DEFAULT_RETRY_CFG)
+    if os.path.exists(cfg_file_path):
+        retry_cfg.update(init_yml_cfg().get("retry") or {})
+    return retry_cfg
+
+
+def get_default_policy() -> RetryPolicy:
+    """HTTP 调用默认使用的重试策略"""
+    global _default_policy
+    if _default_policy is None:
+        retry_cfg = get_retry_cfg()
+        default_budget.ratio = retry_cfg["budget_ratio"]
+        default_budget.min_per_second = retry_cfg["budget_min_per_second"]
+        _default_policy = RetryPolicy(
+            max_attempts=retry_cfg["max_attempts"],
+            base_delay=retry_cfg["base_delay"],
+            max_delay=retry_cfg["max_delay"],
+            deadline=retry_cfg["deadline"],
+        )
+    return _default_policy
+
+
+def get_retry_policy(max_attempts: int | None = None) -> RetryPolicy:
+    """获取重试策略，max_attempts 不为空时覆盖默认的最大尝试次数"""
+    policy = get_default_policy()
+    if max_attempts is None or max_attempts == policy.max_attempts:
+        return policy
+    return policy.copy(max_attempts=max_attempts)
@@ -7,14 +7,45 @@ pip install mcp
 pip install mcp[cli]
 
 FastMCP quickstart example.
+
+启动方式:
+    python server.py    # 按 cfg.yml 的 mcp_server.workers 启动一个或多个 uvicorn 工作进程
+    # 也可以使用 gunicorn 管理多个 uvicorn 工作进程
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 --certfile ./cert/srv.crt --keyfile ./cert/srv.key \
+        -b 0.0.0.0:19001 'server:create_app()'
+使用 stateless_http，任意一个工作进程都可以处理任意请求。
+多个工作进程（包括使用 gunicorn 时）必须配置 shared_dir：SQL 查询结果的分页游标写入共享目录，
+fetch_sql_result_page 落到任意工作进程上都能读取；/cache/invalidate 的失效记录也写入共享目录，其他工作进程在下次访问缓存时执行。
+工具结果缓存本身和熔断器状态仍在各个工作进程内部。
+配置读取自 cfg.yml 的 mcp_server 段，未配置时使用默认值:
+    mcp_server:
+        host: 0.0.0.0
+        port: 19001
+        workers: 1                    # uvicorn 工作进程数，建议不超过 CPU 核数
+        tool_threads: 40              # 每个工作进程中执行同步工具的线程数，只对同步（def）工具生效
+        shared_dir: ""                # 多个工作进程共享的目录，workers 大于 1 时必须配置
+        admin_token: ""               # /cache/invalidate 的访问令牌，为空时禁用该接口
+        ssl_keyfile: ./cert/srv.key
+        ssl_certfile: ./cert/srv.crt
 """
+import functools
+import hmac
+import inspect
 import json
 import os
 import logging.config
+
+import anyio
 from mcp.server.fastmcp import FastMCP
 from mcp.types import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 
+import circuit_breaker
+import metrics
+import result_pager
+import tracing
+import ttl_cache
+from sys_init import cfg_file_path, init_yml_cfg
 from tools import db_query
 
 app = FastMCP(port=19001, stateless_http=True, json_response=True, host='0.0.0.0')
@@ -22,11 +53,131 @@ app = FastMCP(port=19001, stateless_http=True, json_response=True, host='0.0.0.0
 logging.config.fileConfig('logging.conf', encoding="utf-8")
 logger = logging.getLogger(__name__)
 
+DEFAULT_SERVER_CFG = {
+    "host": "0.0.0.0",
+    "port": 19001,
+    "workers": 1,
+    "tool_threads": 40,
+    "shared_dir": "",
+    "admin_token": "",
+    "ssl_keyfile": "./cert/srv.key",
+    "ssl_certfile": "./cert/srv.crt",
+}
+
+_tool_limiter: anyio.CapacityLimiter | None = None
+_tools_added = False
+
+
+def get_server_cfg() -> dict:
+    """读取 cfg.yml 中的 mcp_server 配置，与默认值合并"""
+    server_cfg = dict(DEFAULT_SERVER_CFG)
+    if os.path.exists(cfg_file_path):
+        server_cfg.update(init_yml_cfg().get("mcp_server") or {})
+    return server_cfg
+
+
+def get_tool_limiter() -> anyio.CapacityLimiter:
+    """同步工具共用的线程数上限，在工作进程的事件循环中首次调用工具时创建"""
+    global _tool_limiter
+    if _tool_limiter is None:
+        _tool_limiter = anyio.CapacityLimiter(get_server_cfg()["tool_threads"])
+    return _tool_limiter
+
+
+def run_in_tool_thread(func):
+    """
+    FastMCP 在事件循环中直接调用同步工具，工具中阻塞的 requests 调用会使整个进程无法处理其他请求，
+    这里把同步工具包装为异步函数，在线程池中执行（最多 tool_threads 个线程），工具的名称、参数和返回值声明保持不变。
+    tools/db_query.py 中的工具目前都是异步的，不经过这里，只有新增的同步工具才会使用
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=get_tool_limiter())
+
+    return wrapper
+
+
+def get_request_meta() -> dict:
+    """当前 MCP 请求 _meta 中的附加信息，例如客户端传来的 request_id、traceparent"""
+    try:
+        meta = app.get_context().request_context.meta
+    except (LookupError, ValueError):
+        return {}
+    return meta.model_dump() if meta else {}
+
+
+def trace_tool(name: str, func):
+    """
+    以客户端在 _meta 中传来的 traceparent 为父 span 记录一次工具调用（tool span），
+    工具中访问数据后端的 backend span 作为它的子 span，与客户端的 span 使用同一个 trace_id
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        meta = get_request_meta()
+        ttl_cache.sync_invalidations()
+        metrics.SERVER_TOOLS_IN_FLIGHT.inc()
+        try:
+            with tracing.traced("tool", meta.get("request_id"), meta.get("traceparent"), tracing.KIND_SERVER,
+                                tool=name):
+                return await func(*args, **kwargs)
+        finally:
+            metrics.SERVER_TOOLS_IN_FLIGHT.dec()
+
+    return wrapper
+
+
 @app.custom_route("/health", methods=["GET"])
 async def health_check(request: Request):
-    """健康检查端点"""
+    """健康检查端点，包含数据后端（tool_api_uri）的熔断器状态"""
     logger.info(f"trigger_health_check, {request}")
-    return JSONResponse({"status": "ok"})
+    health, status_code = circuit_breaker.health_status()
+    health["status"] = "ok" if health["status"] == "healthy" else health["status"]
+    return JSONResponse(health, status_code=status_code)
+
+@app.custom_route("/metrics", methods=["GET"])
+async def get_metrics(request: Request):
+    """Prometheus 指标，配置了 metrics.multiprocess_dir 时合并所有工作进程的指标，读取快照文件在线程中执行，不阻塞事件循环"""
+    return Response(await anyio.to_thread.run_sync(metrics.render), media_type=metrics.CONTENT_TYPE)
+
+@app.custom_route("/cache", methods=["GET"])
+async def get_cache_stats(request: Request):
+    """工具结果缓存的命中统计"""
+    ttl_cache.sync_invalidations()
+    return JSONResponse({"caches": ttl_cache.cache_stats()})
+
+def is_admin_request(request: Request) -> bool:
+    """
+    校验 Bearer 令牌，未配置 admin_token 时拒绝所有请求：
+    部署在本机反向代理之后时所有请求都来自本机，不能以来源地址判断
+    """
+    admin_token = get_server_cfg()["admin_token"]
+    if not admin_token:
+        return False
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), str(admin_token).encode())
+
+@app.custom_route("/cache/invalidate", methods=["POST"])
+async def invalidate_cache(request: Request):
+    """
+    使工具结果缓存失效，数据源或表结构变更后调用
+    请求体: {"tool": "get_table_schema", "arguments": {"db_source": "a", "table_name": "b"}}，
+    不传 arguments 时清空该工具的缓存，请求体为空时清空全部缓存
+    需要请求头 Authorization: Bearer <admin_token>，未配置 mcp_server.admin_token 时禁用该接口
+    """
+    if not is_admin_request(request):
+        logger.warning(f"invalidate_cache_forbidden, client={request.client}")
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    body = await request.body()
+    try:
+        data = json.loads(body) if body.strip() else {}
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JSONResponse({"error": "请求体不是合法的 JSON"}, status_code=400)
+    if not isinstance(data, dict) or not isinstance(data.get("tool"), (str, type(None))) \
+            or not isinstance(data.get("arguments"), (dict, type(None))):
+        return JSONResponse({"error": "请求体应为 {\"tool\": str, \"arguments\": object}"}, status_code=400)
+    count = ttl_cache.broadcast_invalidate(data.get("tool"), data.get("arguments"))
+    logger.info(f"trigger_invalidate_cache, {data}, count={count}")
+    return JSONResponse({"invalidated": count})
 
 @app.custom_route("/tools", methods=["GET"])
 async def get_tools(request: Request):
@@ -48,10 +199,18 @@ async def get_tools(request: Request):
     return JSONResponse({"tools": serializable_tools})
 
 def add_your_tools():
-    """从MCP注册表中添加工具"""
+    """从MCP注册表中添加工具，每个进程只添加一次"""
+    global _tools_added
+    if _tools_added:
+        return
+    _tools_added = True
     for name, tool_info in db_query.MCP_TOOLS.items():
+        func = tool_info['func']
+        if not inspect.iscoroutinefunction(func):
+            func = run_in_tool_thread(func)
+            logger.info(f"sync MCP tool {name} runs in tool threads")
         app.add_tool(
-            tool_info['func'],
+            trace_tool(name, func),
             name=name,
             title=tool_info['title'],
             description=tool_info['description'],
@@ -59,23 +218,41 @@ def add_your_tools():
         )
         logger.info(f"Added MCP tool: {name}")
 
+def create_app():
+    """ASGI 应用工厂，uvicorn/gunicorn 的每个工作进程调用一次"""
+    shared_dir = get_server_cfg()["shared_dir"]
+    if shared_dir:
+        result_pager.use_shared_dir(os.path.join(shared_dir, "sql_cursors"))
+        ttl_cache.use_shared_dir(os.path.join(shared_dir, "cache_invalidations.log"))
+    add_your_tools()
+    metrics.start("mcp_server")
+    return app.streamable_http_app()
+
 def start_https_server():
-    starlette_app = app.streamable_http_app()
+    server_cfg = get_server_cfg()
     import uvicorn
-    uvicorn.run(
-        starlette_app,
-        host="0.0.0.0",
-        port=19001,
-        ssl_keyfile="./cert/srv.key",
-        ssl_certfile="./cert/srv.crt",
+    options = dict(
+        host=server_cfg["host"],
+        port=server_cfg["port"],
+        ssl_keyfile=server_cfg["ssl_keyfile"],
+        ssl_certfile=server_cfg["ssl_certfile"],
         log_level="info"
     )
+    if server_cfg["workers"] > 1 and not server_cfg["shared_dir"]:
+        # 不共享时 fetch_sql_result_page 会落到没有该游标的工作进程上，缓存失效也只作用于一个工作进程
+        logger.error("mcp_server.workers > 1 requires mcp_server.shared_dir")
+        raise SystemExit("mcp_server.workers > 1 requires mcp_server.shared_dir in cfg.yml")
+    if server_cfg["workers"] > 1:
+        # 多进程模式下 uvicorn 需要以导入字符串的方式加载应用，由每个工作进程各自创建
+        logger.info(f"start mcp server with {server_cfg['workers']} workers")
+        uvicorn.run("server:create_app", factory=True, workers=server_cfg["workers"], **options)
+    else:
+        uvicorn.run(create_app(), **options)
 
 def start_http_server():
     app.run(transport='streamable-http')  # 添加 frontend=False
 
 if __name__ == "__main__":
-    add_your_tools()
     logger.info("start mcp server (backend only)")
     start_https_server()
 
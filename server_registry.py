@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+MCP Server 注册表和副本负载均衡
+
+一个逻辑服务器（例如 db_query）可以部署多个副本（多个 server.py 实例），
+客户端对每个逻辑服务器只获取一次工具列表（工具不会因为副本而重复），工具调用在健康的副本之间分摊：
+- p2c: 随机取两个副本，选择进行中请求数较少的一个（power of two choices，默认）
+- least_outstanding: 选择进行中请求数最少的副本
+副本是否健康由两部分决定：定时请求副本的 /health 接口（server.py 中的 health_check），
+以及客户端对该副本的熔断器状态。没有健康副本时退回到全部副本，由熔断器快速失败。
+配置读取自 cfg.yml 的 mcp_registry 段，未配置 servers 时使用 client.MCP_SERVER_ADDR_LIST，每个地址一个逻辑服务器:
+    mcp_registry:
+        lb_strategy: p2c              # p2c 或 least_outstanding
+        health_check_interval: 10     # 健康检查周期（秒），为 0 时不做主动健康检查
+        health_check_timeout: 3       # 健康检查请求超时（秒）
+        health_path: /health          # 健康检查路径，与副本地址的 scheme://host:port 拼接
+        unhealthy_threshold: 2        # 连续多少次健康检查失败后摘除副本，一次成功即恢复
+        servers:
+            - name: db_query
+              replicas:
+                - https://10.0.0.1:19001/mcp
+                - https://10.0.0.2:19001/mcp
+            - https://localhost:19002/mcp   # 只有一个副本时可以直接写地址
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import logging.config
+import os
+import random
+import time
+from pathlib import Path
+from typing import Callable
+from urllib.parse import urlparse
+
+import http_pool
+from circuit_breaker import CircuitBreaker
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+LB_P2C = "p2c"
+LB_LEAST_OUTSTANDING = "least_outstanding"
+
+DEFAULT_REGISTRY_CFG = {
+    "lb_strategy": LB_P2C,
+    "health_check_interval": 10,
+    "health_check_timeout": 3,
+    "health_path": "/health",
+    "unhealthy_threshold": 2,
+    "servers": [],
+}
+
+
+def get_registry_cfg() -> dict:
+    """读取 cfg.yml 中的 mcp_registry 配置，与默认值合并"""
+    registry_cfg = dict(DEFAULT_REGISTRY_CFG)
+    if os.path.exists(cfg_file_path):
+        registry_cfg.update(init_yml_cfg().get("mcp_registry") or {})
+    return registry_cfg
+
+
+def build_health_uri(addr: str, health_path: str) -> str:
+    parsed = urlparse(addr)
+    return f"{parsed.scheme}://{parsed.netloc}{health_path}"
+
+
+class Replica:
+    """逻辑服务器的一个副本"""
+
+    def __init__(self, addr: str, health_path: str = "/health"):
+        self.addr = addr
+        # 副本地址的短哈希，标记在只存在于该副本内存中的数据（例如 SQL 查询结果游标）上，后续请求据此路由回同一个副本
+        self.tag = hashlib.sha1(addr.encode("utf-8")).hexdigest()[:8]
+        self.health_uri = build_health_uri(addr, health_path)
+        self.outstanding = 0  # 进行中的请求数
+        self.requests = 0
+        self.healthy = True
+        self.consecutive_failures = 0  # 连续健康检查失败次数
+        self.last_check: float | None = None
+        self.last_error: str | None = None
+
+    @contextlib.contextmanager
+    def track(self):
+        """包裹一次对该副本的请求，统计进行中的请求数"""
+        self.outstanding += 1
+        self.requests += 1
+        try:
+            yield self
+        finally:
+            self.outstanding -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "last_error": self.last_error,
+        }
+
+
+class LogicalServer:
+    """逻辑服务器，包含一个或多个提供相同工具的副本"""
+
+    def __init__(self, name: str, replicas: list[Replica]):
+        self.name = name
+        self.replicas = replicas
+
+    def get_replica(self, addr: str) -> Replica | None:
+        return next((replica for replica in self.replicas if replica.addr == addr), None)
+
+    def get_replica_by_tag(self, tag: str) -> Replica | None:
+        return next((replica for replica in self.replicas if replica.tag == tag), None)
+
+
+class ServerRegistry:
+    """逻辑服务器注册表"""
+
+    def __init__(self,
+            servers: list[LogicalServer],
+            lb_strategy: str = LB_P2C,
+            health_check_interval: float = 10,
+            health_check_timeout: float = 3,
+            unhealthy_threshold: int = 2,
+            breaker_for: Callable[[str], CircuitBreaker] | None = None):
+        if lb_strategy not in (LB_P2C, LB_LEAST_OUTSTANDING):
+            raise ValueError(f"不支持的负载均衡策略: {lb_strategy}")
+        self.servers = servers
+        self.lb_strategy = lb_strategy
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.unhealthy_threshold = unhealthy_threshold
+        self.breaker_for = breaker_for  # 根据副本地址获取熔断器，熔断中的副本不参与负载均衡
+        self._by_name = {server.name: server for server in servers}
+
+    @classmethod
+    def from_cfg(cls, registry_cfg: dict, default_addrs: list[str],
+                 breaker_for: Callable[[str], CircuitBreaker] | None = None) -> "ServerRegistry":
+        health_path = registry_cfg["health_path"]
+        servers = []
+        for item in registry_cfg.get("servers") or default_addrs:
+            if isinstance(item, str):
+                item = {"name": item, "replicas": [item]}
+            replicas = [Replica(addr, item.get("health_path", health_path)) for addr in item["replicas"]]
+            if not replicas:
+                raise ValueError(f"MCP Server {item['name']} 没有配置 replicas")
+            servers.append(LogicalServer(item["name"], replicas))
+        return cls(servers,
+                   lb_strategy=registry_cfg["lb_strategy"],
+                   health_check_interval=registry_cfg["health_check_interval"],
+                   health_check_timeout=registry_cfg["health_check_timeout"],
+                   unhealthy_threshold=registry_cfg["unhealthy_threshold"],
+                   breaker_for=breaker_for)
+
+    def get(self, name: str) -> LogicalServer:
+        """
+        按名称获取逻辑服务器
+        名称不在注册表中时（例如直接传入了一个 MCP Server 地址），把它当作只有一个副本的临时服务器
+        """
+        server = self._by_name.get(name)
+        return server if server else LogicalServer(name, [Replica(name)])
+
+    def index_of(self, name: str) -> int:
+        return next(i for i, server in enumerate(self.servers) if server.name == name)
+
+    def server_of(self, addr: str) -> LogicalServer | None:
+        """根据副本地址找到所属的逻辑服务器"""
+        return next((server for server in self.servers if server.get_replica(addr)), None)
+
+    def is_available(self, replica: Replica) -> bool:
+        if not replica.healthy:
+            return False
+        return self.breaker_for is None or self.breaker_for(replica.addr).allows_request()
+
+    def pick(self, server: LogicalServer, exclude: set[str] | None = None) -> Replica:
+        """
+        按负载均衡策略为一次请求选择副本
+        :param exclude: 本次请求已经失败过的副本地址，重试时尽量换一个副本
+        """
+        replicas = [replica for replica in server.replicas if not exclude or replica.addr not in exclude] \
+            or server.replicas
+        candidates = [replica for replica in replicas if self.is_available(replica)]
+        if not candidates:
+            logger.warning(f"no_healthy_replica for {server.name}, try all {len(replicas)} replicas")
+            candidates = replicas
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.lb_strategy == LB_P2C:
+            candidates = random.sample(candidates, 2)
+        least = min(replica.outstanding for replica in candidates)
+        return random.choice([replica for replica in candidates if replica.outstanding == least])
+
+    async def check_replica(self, replica: Replica):
+        """请求副本的健康检查接口，连续 unhealthy_threshold 次失败后摘除，一次成功即恢复"""
+        replica.last_check = time.monotonic()
+        try:
+            client = http_pool.get_async_client(replica.health_uri, None)
+            response = await client.get(replica.health_uri, timeout=self.health_check_timeout)
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+        except Exception as e:
+            replica.consecutive_failures += 1
+            replica.last_error = f"{type(e).__name__}: {e}"
+            if replica.healthy and replica.consecutive_failures >= self.unhealthy_threshold:
+                replica.healthy = False
+                logger.warning(f"replica_unhealthy {replica.addr}, last_error={replica.last_error}")
+            return
+        if not replica.healthy:
+            logger.info(f"replica_healthy {replica.addr}")
+        replica.healthy = True
+        replica.consecutive_failures = 0
+        replica.last_error = None
+
+    async def check_all(self):
+        """只有多个副本的逻辑服务器才需要主动健康检查，单副本时由熔断器判断"""
+        await asyncio.gather(*(self.check_replica(replica) for server in self.servers
+                               if len(server.replicas) > 1 for replica in server.replicas))
+
+    async def health_checker(self):
+        """按 health_check_interval 定时对所有副本做健康检查"""
+        logger.info(f"replica_health_checker_started, interval={self.health_check_interval}s")
+        while True:
+            try:
+                await self.check_all()
+            except Exception:
+                logger.exception("replica_health_checker_error")
+            await asyncio.sleep(self.health_check_interval)
+
+    def status(self) -> dict:
+        """各逻辑服务器副本的状态，用于健康检查接口"""
+        return {server.name: {replica.addr: replica.snapshot() for replica in server.replicas}
+                for server in self.servers}
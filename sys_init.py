@@ -8,6 +8,8 @@ import yaml
 import os
 import logging.config
 
+import log_utils
+
 current_dir = Path(__file__).parent
 project_root = current_dir
 logging_conf_path = f"{project_root}/logging.conf"
@@ -24,7 +26,7 @@ def init_yml_cfg(cfg_file=cfg_file_path)-> dict[str, any]:
     """
     global __init_cfg__
     if __init_cfg__:
-        logger.info(f"cfg_already_inited_return_variable__init_cfg__, {__init_cfg__}")
+        logger.debug("cfg_already_inited_return_variable__init_cfg__")
         return __init_cfg__
     # 检查配置文件
     if not os.path.exists(cfg_file):
@@ -34,13 +36,14 @@ def init_yml_cfg(cfg_file=cfg_file_path)-> dict[str, any]:
     # 读取配置
     with open(cfg_file, 'r', encoding='utf-8') as f:
         __init_cfg__ = yaml.safe_load(f)
-    logger.info(f"init_cfg_from_cfg_file, {__init_cfg__}")
+    log_utils.configure(__init_cfg__.get("log"))
+    logger.info("init_cfg_from_cfg_file, %s", log_utils.Payload(__init_cfg__))
     return __init_cfg__
 
 
 if __name__ == "__main__":
     my_cfg = init_yml_cfg()
-    logger.info(f"cfg {my_cfg}")
+    logger.info("cfg %s", log_utils.Payload(my_cfg))
 
     my_cfg1 = init_yml_cfg()
-    logger.info(f"cfg {my_cfg1}")
\ No newline at end of file
+    logger.info("cfg %s", log_utils.Payload(my_cfg1))
\ No newline at end of file
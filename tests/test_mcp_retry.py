@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+MCP 工具调用的重试判断：只有确定请求没有发送到 MCP Server 时才重试，避免非幂等的工具（例如 execute_sql_query）被执行两次
+在 project 根目录下执行:
+    python -m pytest -q tests
+"""
+
+import asyncio
+
+import anyio
+import httpx
+import pytest
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, ErrorData
+
+from client import get_mcp_retry_policy, is_mcp_call_retryable
+from mcp_pool import SessionBrokenError
+
+
+def session_broken(cause: BaseException) -> SessionBrokenError:
+    """与会话池一样，把传输层的原始异常作为 __cause__ 包装为 SessionBrokenError"""
+    try:
+        raise SessionBrokenError("session broken") from cause
+    except SessionBrokenError as e:
+        return e
+
+
+@pytest.mark.parametrize("error", [
+    session_broken(httpx.ReadError("connection reset")),
+    session_broken(httpx.RemoteProtocolError("peer closed connection")),
+    session_broken(httpx.ReadTimeout("read timeout")),
+    McpError(ErrorData(code=CONNECTION_CLOSED, message="Connection closed")),
+    httpx.ReadError("connection reset"),
+    ExceptionGroup("tool call", [httpx.ConnectError("refused"), httpx.ReadError("connection reset")]),
+])
+def test_not_retried_when_request_may_have_been_sent(error):
+    assert not is_mcp_call_retryable(error)
+
+
+@pytest.mark.parametrize("error", [
+    session_broken(httpx.ConnectError("refused")),
+    session_broken(anyio.ClosedResourceError()),
+    httpx.ConnectTimeout("connect timeout"),
+    anyio.BrokenResourceError(),
+    ExceptionGroup("tool call", [httpx.ConnectError("refused")]),
+])
+def test_retried_when_request_was_never_sent(error):
+    assert is_mcp_call_retryable(error)
+
+
+def test_read_error_session_broken_runs_tool_once():
+    policy = get_mcp_retry_policy().copy(base_delay=0.0, deadline=5)
+    attempts = 0
+
+    async def call_tool(timeout):
+        nonlocal attempts
+        attempts += 1
+        raise session_broken(httpx.ReadError("connection reset"))
+
+    with pytest.raises(SessionBrokenError):
+        asyncio.run(policy.acall(call_tool, "execute_sql_query"))
+    assert attempts == 1
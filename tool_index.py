@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+工具检索：根据用户问题只把最相关的 top_k 个工具发送给 LLM
+
+对工具名称、标题、描述和参数说明建立本地 BM25 词法索引，不依赖外部服务：
+- 英文和数字按单词切分，工具名按下划线、驼峰拆开
+- 中文按单字 + 相邻两字（bigram）切分，不需要分词词典
+工具列表不变时索引只建立一次。在对话中已经调用过的工具和 always_include_tools 中的工具总是会发送给 LLM。
+配置读取自 cfg.yml 的 client 段:
+    client:
+        tool_top_k: 8                   # 每次最多发送多少个相关工具，为 0 时发送全部工具
+        always_include_tools: []        # 总是发送的工具名称（不含 server 前缀）
+"""
+
+import logging.config
+import math
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOOL_TOP_K = 8
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+_CJK_PATTERN = re.compile(r"[\u4e00-\u9fff]+")
+_CAMEL_PATTERN = re.compile(r"([a-z0-9])([A-Z])")
+# 出现频率高、没有区分度的中文单字
+_CJK_STOP_CHARS = frozenset("的了是在和与及或把被个一这那为对从等")
+# 工具名称在索引中的权重（重复次数）
+NAME_WEIGHT = 2
+
+
+def tokenize(txt: str) -> list[str]:
+    """切分文本：英文单词 + 中文单字和 bigram"""
+    txt = _CAMEL_PATTERN.sub(r"\1 \2", txt or "").lower()
+    tokens = _WORD_PATTERN.findall(txt)
+    for segment in _CJK_PATTERN.findall(txt):
+        tokens.extend(ch for ch in segment if ch not in _CJK_STOP_CHARS)
+        tokens.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return tokens
+
+
+def strip_server_prefix(unique_name: str) -> str:
+    """去掉 client.get_tool_unique_name 添加的 server 前缀"""
+    return re.sub(r"^server\d+_", "", unique_name)
+
+
+def tool_terms(tool: dict) -> list[str]:
+    """工具的索引词：名称（加权）、标题、描述、参数名称和参数说明"""
+    terms = tokenize(strip_server_prefix(tool["name"]).replace("_", " ")) * NAME_WEIGHT
+    terms += tokenize(tool.get("title") or "")
+    terms += tokenize(tool.get("description") or "")
+    for name, prop in ((tool.get("inputSchema") or {}).get("properties") or {}).items():
+        terms += tokenize(name.replace("_", " "))
+        if isinstance(prop, dict):
+            terms += tokenize(prop.get("description") or prop.get("title") or "")
+    return terms
+
+
+class ToolIndex:
+    """工具的 BM25 索引"""
+
+    def __init__(self, tools: list[dict], k1: float = 1.5, b: float = 0.75):
+        self.tools = tools
+        self.k1 = k1
+        self.b = b
+        self.doc_terms = [Counter(tool_terms(tool)) for tool in tools]
+        self.doc_len = [sum(terms.values()) for terms in self.doc_terms]
+        self.avg_len = sum(self.doc_len) / len(tools) if tools else 0
+        df = Counter()
+        for terms in self.doc_terms:
+            df.update(terms.keys())
+        n = len(tools)
+        self.idf = {term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()}
+
+    def score(self, query: str) -> list[float]:
+        query_terms = set(tokenize(query))
+        scores = []
+        for terms, doc_len in zip(self.doc_terms, self.doc_len):
+            score = 0.0
+            for term in query_terms:
+                tf = terms.get(term)
+                if not tf:
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * doc_len / (self.avg_len or 1))
+                score += self.idf[term] * tf * (self.k1 + 1) / norm
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, top_k: int) -> list[dict]:
+        """返回得分大于 0 的前 top_k 个工具，按得分从高到低排序"""
+        scores = self.score(query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: scores[i], reverse=True)
+        return [self.tools[i] for i in ranked[:top_k]]
+
+
+_lock = threading.Lock()
+_index: ToolIndex | None = None
+_index_key: tuple | None = None
+
+
+def get_tool_index(tools: list[dict]) -> ToolIndex:
+    """工具列表（名称和描述）不变时复用已经建立的索引"""
+    global _index, _index_key
+    key = tuple((tool["name"], tool.get("description")) for tool in tools)
+    with _lock:
+        if _index is None or _index_key != key:
+            _index = ToolIndex(tools)
+            _index_key = key
+            logger.info(f"tool_index_built, {len(tools)} tools, {len(_index.idf)} terms")
+        return _index
+
+
+def select_tools(tools: list[dict], query: str, top_k: int = DEFAULT_TOOL_TOP_K,
+                 used_tools: set[str] | None = None, always_include: list[str] | None = None) -> list[dict]:
+    """
+    选出与问题相关的工具
+    :param tools: 全部工具，格式同 client.TOOLS_CACHE["tools"]
+    :param top_k: 最多选出的相关工具数量，为 0 或工具总数不超过 top_k 时返回全部工具
+    :param used_tools: 对话中已经调用过的工具唯一名称，总是保留
+    :param always_include: 总是保留的工具名称（不含 server 前缀）
+    :return: 选中的工具，保持原来的顺序
+    """
+    if not top_k or len(tools) <= top_k:
+        return tools
+    matched = get_tool_index(tools).search(query, top_k)
+    if not matched:
+        logger.info(f"no_tool_matched, use all {len(tools)} tools, query: {query}")
+        return tools
+    selected = {tool["name"] for tool in matched}
+    selected.update(used_tools or ())
+    always_include = set(always_include or ())
+    selected.update(tool["name"] for tool in tools if strip_server_prefix(tool["name"]) in always_include)
+    result = [tool for tool in tools if tool["name"] in selected]
+    logger.info(f"tools_selected {len(result)}/{len(tools)}: {[tool['name'] for tool in result]}")
+    return result
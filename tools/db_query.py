@@ -2,11 +2,23 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
 # 如果在 project 根目录下运行，可以这样执行  python -m tools.db_query
+"""
+数据查询类 MCP 工具
+工具都是 async 函数，通过 utils 中的 async_*_with_retry 使用共享的 httpx.AsyncClient 连接池访问数据后端（tool_api_uri），
+等待后端响应时不占用线程，一个 server.py 进程可以同时处理大量工具调用，并发连接数上限见 cfg.yml 的 http 段
+"""
+import asyncio
+import re
 from pathlib import Path
+from typing import Literal
 
 from pydantic import BaseModel
 
-from utils import get_with_retry, post_with_retry
+from result_pager import CursorExpiredError, fetch_page, paginate
+from ttl_cache import cached
+from log_utils import Payload
+import tracing
+from utils import async_get_with_retry, async_post_with_retry
 from sys_init import init_yml_cfg
 
 import logging.config
@@ -21,9 +33,19 @@ db_cfg = init_yml_cfg()['api']
 
 MCP_TOOLS = {}
 
-def mcp_tool(title, description):
-    """装饰器标记函数为MCP工具"""
+# 批量工具一次最多处理的表或SQL数量，以及同时发往数据后端的请求数
+MAX_BATCH_SIZE = 20
+BATCH_CONCURRENCY = 8
+
+def mcp_tool(title, description, cache: dict | None = None):
+    """
+    装饰器标记函数为MCP工具
+    :param cache: 结果缓存参数，例如 {"ttl": 3600, "max_size": 256, "stale_ttl": 600, "single_flight": True}，为空时不缓存，
+        可以被 cfg.yml 中 tool_cache.<工具名> 的配置覆盖，参数含义见 ttl_cache.cached
+    """
     def decorator(func):
+        if cache is not None:
+            func = cached(func.__name__, **cache)(func)
         MCP_TOOLS[func.__name__] = {
             'func': func,
             'title': title,
@@ -57,40 +79,75 @@ class ChartJsData(BaseModel):
     config: dict
     options: dict
 
+# 查询结果的编码格式，调用方通过工具的 result_format 参数选择，含义见 utils.RESULT_FORMATS
+ResultFormat = Literal["rows", "columnar", "csv", "markdown"]
+
 class SqlExecResult(BaseModel):
     msg: str
-    data: list[dict]
+    data: list[dict]  # result_format 为 rows 时的逐行数据
+    total_rows: int = 0  # 查询结果的总行数，本次只返回其中一页
+    truncated: bool = False  # 是否还有后续数据
+    next_cursor: str | None = None  # 获取下一页的游标，传给 fetch_sql_result_page
+    result_format: str = "rows"
+    columns: list[str] | None = None  # result_format 为 columnar 时的列名
+    values: list[list] | None = None  # result_format 为 columnar 时按列存放的数据，与 columns 一一对应
+    text: str | None = None  # result_format 为 csv 或 markdown 时的文本表格
+
+class TableSchemaBatchResult(BaseModel):
+    msg: str
+    schemas: list[TableSchemaInfo]  # 成功获取的表结构，顺序与 table_names 一致
+    errors: dict[str, str] = {}  # 获取失败的表名和原因
+
+class SqlBatchResult(BaseModel):
+    msg: str
+    results: list[SqlExecResult]  # 与 sqls 一一对应，单条SQL失败时 msg 为失败原因
+
+async def gather_limited(coros: list) -> list:
+    """并发执行，同时最多 BATCH_CONCURRENCY 个，返回结果或异常，顺序与输入一致"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros), return_exceptions=True)
 
-@mcp_tool("获取可用数据源列表", "获取目前可用的数据源（数据库）列表")
-def list_available_db_source() -> list[DbInfo]:
+@mcp_tool("获取可用数据源列表", "获取目前可用的数据源（数据库）列表",
+          cache={"ttl": 600, "max_size": 1, "stale_ttl": 3600})
+async def list_available_db_source() -> list[DbInfo]:
     uri = f"{db_cfg['tool_api_uri']}/ds/list"
-    db_source = get_with_retry(uri=uri, headers={}, params={}, proxies=None)
-    logger.info(f"db_source_list {db_source}")
+    with tracing.span("backend", tracing.KIND_CLIENT, uri=uri):
+        db_source = await async_get_with_retry(uri=uri, headers=tracing.propagation_headers(), params={}, proxies=None)
+    logger.debug("db_source_list %s", Payload(db_source))
     db_list = []
     for item in db_source:
         db_info = DbInfo(name=item['name'], description=item['desc'], dialect=item['dialect'])
         db_list.append(db_info)
-    logger.info(f"return_db_source_list {db_list}")
+    logger.info("return_db_source_list %s", Payload(db_list))
     return db_list
 
-@mcp_tool("获取表清单", "获取某个数据源下的所有表的清单")
-def list_available_tables(db_source:str) -> list[TableInfo]:
+@mcp_tool("获取表清单", "获取某个数据源下的所有表的清单",
+          cache={"ttl": 600, "max_size": 64, "stale_ttl": 3600})
+async def list_available_tables(db_source:str) -> list[TableInfo]:
     """获取指定数据源中的所有表清单信息"""
     uri =f"{db_cfg['tool_api_uri']}/{db_source}/table/list"
-    tables = get_with_retry(uri=uri,headers={}, params={}, proxies=None)
-    logger.info(f"table_list {tables}")
+    with tracing.span("backend", tracing.KIND_CLIENT, uri=uri):
+        tables = await async_get_with_retry(uri=uri, headers=tracing.propagation_headers(), params={}, proxies=None)
+    logger.debug("table_list %s", Payload(tables))
     table_list = []
     for item in tables:
         table_info = TableInfo(name=item['name'], description=item['desc'])
         table_list.append(table_info)
     return table_list
 
-@mcp_tool("获取表结构", "获取某个数据源下某个表的结构")
-def get_table_schema(db_source: str, table_name: str) -> TableSchemaInfo:
+@mcp_tool("获取表结构", "获取某个数据源下某个表的结构",
+          cache={"ttl": 3600, "max_size": 512, "stale_ttl": 3600})
+async def get_table_schema(db_source: str, table_name: str) -> TableSchemaInfo:
     """获取目前 db_source 中表名称为  table_name 的 schema， 输出为 json 格式"""
     uri=f"{db_cfg['tool_api_uri']}/{db_source}/{table_name}/schema"
-    tb_json = get_with_retry(uri=uri, headers={}, params={}, proxies=None)
-    logger.info(f"get_table_schema {tb_json}")
+    with tracing.span("backend", tracing.KIND_CLIENT, uri=uri):
+        tb_json = await async_get_with_retry(uri=uri, headers=tracing.propagation_headers(), params={}, proxies=None)
+    logger.debug("get_table_schema %s", Payload(tb_json))
     tb_schema = TableSchemaInfo(
         db_name=tb_json['db_name'],
         table_name=tb_json['table_name'],
@@ -98,22 +155,88 @@ def get_table_schema(db_source: str, table_name: str) -> TableSchemaInfo:
     )
     return tb_schema
 
+@mcp_tool("批量获取表结构", f"一次获取某个数据源下多个表的结构（最多 {MAX_BATCH_SIZE} 个），需要了解多个表时优先使用，避免逐个调用 get_table_schema")
+async def get_table_schemas(db_source: str, table_names: list[str]) -> TableSchemaBatchResult:
+    """并发获取多个表的结构，每个表的结果复用 get_table_schema 的缓存，单个表失败不影响其他表"""
+    table_names = list(dict.fromkeys(table_names))
+    if len(table_names) > MAX_BATCH_SIZE:
+        return TableSchemaBatchResult(msg=f"一次最多获取 {MAX_BATCH_SIZE} 个表的结构，请分批获取", schemas=[])
+    results = await gather_limited([get_table_schema(db_source, table_name) for table_name in table_names])
+    schemas, errors = [], {}
+    for table_name, result in zip(table_names, results):
+        if isinstance(result, BaseException):
+            logger.warning(f"get_table_schemas_failed {db_source}.{table_name}: {result}")
+            errors[table_name] = str(result) or type(result).__name__
+        else:
+            schemas.append(result)
+    logger.info(f"get_table_schemas {db_source} tables={len(table_names)}, failed={len(errors)}")
+    msg = f"{len(errors)} 个表获取失败" if errors else ""
+    return TableSchemaBatchResult(msg=msg, schemas=schemas, errors=errors)
+
+def normalize_sql(sql: str) -> str:
+    """归一化SQL，用于查询结果缓存和并发去重的 key：合并空白字符，去掉结尾的分号，统一转为大写（与实际提交的SQL一致）"""
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip().upper()
+
+def sql_cache_key(arguments: dict) -> tuple[str, str]:
+    """查询结果按数据后端地址 + 归一化后的SQL缓存，缓存的是完整结果，与结果格式无关"""
+    return db_cfg['tool_api_uri'], normalize_sql(arguments['sql'])
+
+@cached("execute_sql_query", ttl=0, max_size=128, max_bytes=64 * 1024 * 1024, max_item_bytes=1024 * 1024,
+        single_flight=True, key_fn=sql_cache_key)
+async def query_sql_rows(sql: str) -> list[dict]:
+    """
+    向数据后端提交SQL，返回完整结果
+    缓存和并发去重的是完整结果而不是分页后的 SqlExecResult：游标存储按自己的策略淘汰，缓存中的 next_cursor 可能已经失效，
+    每个调用方在拿到结果后各自分页，得到的游标总是可用的。缓存参数可以被 cfg.yml 中 tool_cache.execute_sql_query 覆盖
+    """
+    data = {"sql":sql}
+    uri= f"{db_cfg['tool_api_uri']}/exec/task"
+    # 请求头带上 X-Request-ID、traceparent，数据后端可以据此把慢查询对应到用户的请求
+    with tracing.span("backend", tracing.KIND_CLIENT, uri=uri) as backend_span:
+        rows = await async_post_with_retry(uri=uri, headers=tracing.propagation_headers(), data=data, proxies=None)
+        if backend_span:
+            backend_span.set_attribute("rows", len(rows))
+    logger.info(f"exec_sql_query_rows {len(rows)}")
+    return rows
+
 @mcp_tool("执行查询SQL语句", "执行查询类SQL语句，不可提交修改数据的SQL语句")
-def execute_sql_query(sql: str) -> SqlExecResult:
-    """执行sql查询， 输出为json格式"""
+async def execute_sql_query(sql: str, result_format: ResultFormat = "rows") -> SqlExecResult:
+    """执行sql查询， 输出为json格式，result_format 为 columnar、csv、markdown 时使用更紧凑的表格编码"""
     sql = sql.upper()
     result = SqlExecResult(msg="", data=[])
     if "INSERT" in sql or "UPDATE" in sql or "DELETE" in sql:
         logger.error(f"仅支持查询类的SQL语句, {sql}")
         result.msg = "仅支持查询类的SQL语句"
         return result
-    data = {"sql":sql}
-    uri= f"{db_cfg['tool_api_uri']}/exec/task"
-    table_schema = post_with_retry(uri=uri, headers={}, data=data, proxies=None)
-    logger.info(f"table_schema {table_schema}")
-    result = SqlExecResult(msg="", data=table_schema)
+    rows = await query_sql_rows(sql)
+    # 只返回第一页，完整结果暂存在游标中，通过 fetch_sql_result_page 获取后续数据
+    result = SqlExecResult(**paginate(rows, result_format))
     return result
 
+@mcp_tool("批量执行查询SQL语句", f"一次执行多条查询类SQL语句（最多 {MAX_BATCH_SIZE} 条），结果与SQL一一对应，不可提交修改数据的SQL语句")
+async def execute_sql_queries(sqls: list[str], result_format: ResultFormat = "rows") -> SqlBatchResult:
+    """并发执行多条SQL，每条SQL的只读检查、缓存、并发去重和分页与 execute_sql_query 相同"""
+    if len(sqls) > MAX_BATCH_SIZE:
+        return SqlBatchResult(msg=f"一次最多执行 {MAX_BATCH_SIZE} 条SQL，请分批执行", results=[])
+    results = await gather_limited([execute_sql_query(sql, result_format) for sql in sqls])
+    failed = 0
+    for i, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.warning(f"execute_sql_queries_failed {sqls[i]}: {result}")
+            results[i] = SqlExecResult(msg=f"执行失败: {result}", data=[])
+            failed += 1
+    logger.info(f"execute_sql_queries count={len(sqls)}, failed={failed}")
+    return SqlBatchResult(msg=f"{failed} 条SQL执行失败" if failed else "", results=results)
+
+@mcp_tool("获取SQL查询结果的后续数据", "查询结果超过一页时，根据 execute_sql_query 返回的 next_cursor 获取下一页数据")
+async def fetch_sql_result_page(cursor: str, result_format: ResultFormat = "rows") -> SqlExecResult:
+    """根据游标获取查询结果的下一页，只读取进程内暂存的结果，不访问数据后端"""
+    try:
+        return SqlExecResult(**fetch_page(cursor, result_format))
+    except CursorExpiredError as e:
+        logger.warning(f"fetch_sql_result_page_failed {e}")
+        return SqlExecResult(msg=str(e), data=[])
+
 # @mcp_tool("将数据转换为chartjs格式的数据", "将数据库查询获取的二维表格数据，转换为chartjs格式的数据，可由chartjs渲染成图表")
 def render_chart(chart_data: dict, chart_type: str, title: str, x_axis: str, y_axis: str) -> dict:
     """
@@ -137,18 +260,22 @@ def render_chart(chart_data: dict, chart_type: str, title: str, x_axis: str, y_a
     return chart_js_dt
 
 
-if __name__ == "__main__":
+async def main():
     # 测试代码
     # 获取可用数据源列表
-    db_list = list_available_db_source()
+    db_list = await list_available_db_source()
     logger.info(f"db_list={db_list}")
     # 获取表清单
-    table_list = list_available_tables(db_list[0].name)
+    table_list = await list_available_tables(db_list[0].name)
     logger.info(f"table_list={table_list}")
     # 获取表结构
-    table_schema = get_table_schema(db_list[0].name, table_list[0].name)
+    table_schema = await get_table_schema(db_list[0].name, table_list[0].name)
     logger.info(f"table_schema={table_schema}")
     # 执行查询SQL语句
     sql = "select * from user"
-    exec_result = execute_sql_query(sql)
-    logger.info(f"exec_result={exec_result}")
\ No newline at end of file
+    exec_result = await execute_sql_query(sql)
+    logger.info(f"exec_result={exec_result}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+请求级链路追踪
+
+一次用户提问是一个 trace，request_id 即 trace_id，由 http_mcp.py / asgi_mcp.py 从请求头 X-Request-ID 读取或新生成。
+客户端记录的 span:
+    auto_call_mcp（根 span）
+      ├─ tool_discovery            获取 MCP 工具列表
+      └─ iteration                 每轮对话
+           ├─ llm                  调用 LLM
+           └─ mcp_tool             调用 MCP 工具（含重试、换副本）
+调用 MCP 工具时，request_id 和 W3C traceparent 放在 tools/call 请求的 _meta 中传给 MCP Server，
+server.py 以此为父 span 记录 tool 和 backend（访问 tool_api_uri）span，backend 请求同样带上 X-Request-ID、traceparent 头，
+两边导出的 span 使用同一个 trace_id，在日志或 OTLP 采集端可以按 request_id 拼成完整的调用链。
+对话结束时 Trace.summary() 给出各类 span 的耗时汇总，随 SSE 的 final 事件返回给前端。
+span 的导出配置读取自 cfg.yml 的 tracing 段:
+    tracing:
+        exporter: none                # none: 不导出（仍会生成耗时汇总，默认），file: 写入本地文件，otlp: 发送到 OTLP/HTTP 采集端
+        file_path: ./trace.log        # file 导出时每行一个 span（JSON）
+        otlp_endpoint: http://127.0.0.1:4318/v1/traces
+        service_name: my_mcp
+        export_batch_size: 256        # 后台线程每批导出的 span 数
+        export_interval: 2            # 后台线程最长导出间隔（秒）
+"""
+
+import abc
+import atexit
+import contextlib
+import contextvars
+import json
+import logging.config
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Iterator
+
+import httpx
+
+import metrics
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+EXPORTER_NONE = "none"
+EXPORTER_FILE = "file"
+EXPORTER_OTLP = "otlp"
+
+# 与 OTLP 的 SpanKind 取值一致
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+DEFAULT_TRACING_CFG = {
+    "exporter": EXPORTER_NONE,
+    "file_path": "./trace.log",
+    "otlp_endpoint": "http://127.0.0.1:4318/v1/traces",
+    "service_name": "my_mcp",
+    "export_batch_size": 256,
+    "export_interval": 2,
+}
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+_TRACE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+_TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# 当前协程或线程中正在进行的 span，MCP 工具调用、backend 调用从这里找到父 span
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("current_span", default=None)
+
+
+def get_tracing_cfg() -> dict:
+    """读取 cfg.yml 中的 tracing 配置，与默认值合并"""
+    tracing_cfg = dict(DEFAULT_TRACING_CFG)
+    if os.path.exists(cfg_file_path):
+        tracing_cfg.update(init_yml_cfg().get("tracing") or {})
+    return tracing_cfg
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+def parse_traceparent(traceparent: str | None) -> tuple[str | None, str | None]:
+    """解析 W3C traceparent，返回 (trace_id, parent_span_id)，格式不正确时返回 (None, None)"""
+    match = _TRACEPARENT_PATTERN.match(traceparent or "")
+    return (match.group(1), match.group(2)) if match else (None, None)
+
+
+class Span:
+    """一段有名称、耗时和属性的操作，用 with 包裹时自动结束并记录异常"""
+
+    def __init__(self, trace: "Trace", name: str, parent_id: str | None = None, kind: int = KIND_INTERNAL,
+                 attributes: dict | None = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.error: str | None = None
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self._start = time.perf_counter()
+        self.duration_ms: float | None = None
+
+    def child(self, name: str, kind: int = KIND_INTERNAL, **attributes) -> "Span":
+        return self.trace.new_span(name, self.span_id, kind, attributes)
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def record_error(self, e: BaseException):
+        if isinstance(e, (GeneratorExit, KeyboardInterrupt)) or type(e).__name__ == "CancelledError":
+            self.status = "cancelled"
+        else:
+            self.status = "error"
+        self.error = f"{type(e).__name__}: {e}"
+
+    def elapsed_ms(self) -> float:
+        if self.duration_ms is not None:
+            return self.duration_ms
+        return (time.perf_counter() - self._start) * 1000
+
+    def end(self):
+        if self.duration_ms is None:
+            self.duration_ms = (time.perf_counter() - self._start) * 1000
+            self.end_ns = self.start_ns + int(self.duration_ms * 1_000_000)
+            self.trace.on_span_end(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+    def __enter__(self) -> "Span":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_error(exc)
+        self.end()
+        return False
+
+
+class Trace:
+    """一次请求的全部 span"""
+
+    def __init__(self, name: str, request_id: str | None = None, traceparent: str | None = None,
+                 kind: int = KIND_INTERNAL, attributes: dict | None = None):
+        trace_id, parent_id = parse_traceparent(traceparent)
+        self.request_id = request_id or trace_id or new_request_id()
+        if trace_id is None:
+            trace_id = self.request_id if _TRACE_ID_PATTERN.match(self.request_id) else new_request_id()
+        self.trace_id = trace_id
+        self.finished: list[Span] = []
+        self._open: list[Span] = []
+        self.root = self.new_span(name, parent_id, kind, {"request_id": self.request_id, **(attributes or {})})
+
+    def new_span(self, name: str, parent_id: str | None, kind: int = KIND_INTERNAL,
+                 attributes: dict | None = None) -> Span:
+        span = Span(self, name, parent_id, kind, attributes)
+        self._open.append(span)
+        return span
+
+    def on_span_end(self, span: Span):
+        self._open.remove(span)
+        self.finished.append(span)
+        metrics.observe_span(span.name, span.duration_ms / 1000, span.status, span.attributes)
+        export_span(span)
+
+    def end(self):
+        """结束根 span 以及仍未结束的 span（例如对话被取消时），记录耗时汇总"""
+        for span in reversed(list(self._open)):
+            span.end()
+        logger.info("trace_end %s request_id=%s %s", self.root.name, self.request_id,
+                    json.dumps(self.summary(with_spans=False), ensure_ascii=False))
+
+    def summary(self, with_spans: bool = True) -> dict:
+        """
+        耗时汇总，breakdown_ms 为各类 span 的累计耗时（毫秒）
+        同一轮中的工具调用是并发执行的，mcp_tool 的累计耗时可能大于实际经过的时间
+        """
+        children = [span for span in self.finished if span is not self.root]
+        breakdown = {}
+        for span in children:
+            breakdown[span.name] = round(breakdown.get(span.name, 0) + span.duration_ms, 1)
+        summary = {
+            "request_id": self.request_id,
+            "total_ms": round(self.root.elapsed_ms(), 1),
+            "breakdown_ms": breakdown,
+        }
+        if with_spans:
+            summary["spans"] = [{"name": span.name, "ms": round(span.duration_ms, 1), "status": span.status,
+                                 **{k: v for k, v in span.attributes.items() if isinstance(v, (str, int, float))}}
+                                for span in sorted(children, key=lambda s: s.start_ns)]
+        return summary
+
+
+def start_trace(name: str, request_id: str | None = None, traceparent: str | None = None,
+                kind: int = KIND_INTERNAL, **attributes) -> Trace:
+    """
+    开始一个 trace，调用方负责在结束时调用 trace.end()
+    traceparent 不为空时（例如 MCP Server 收到的 _meta），根 span 作为调用方 span 的子 span，沿用调用方的 trace_id
+    """
+    return Trace(name, request_id, traceparent, kind, attributes)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def activate(span: Span | None) -> Iterator[Span | None]:
+    """在当前协程或线程中把 span 设为当前 span，其中的 tracing.span() 作为它的子 span"""
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, **attributes) -> Iterator[Span | None]:
+    """
+    创建当前 span 的子 span 并设为当前 span，没有当前 span 时（例如后台刷新工具列表）不做任何记录
+    不能跨越生成器的 yield 使用，生成器中请使用 Span.child()
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with parent.child(name, kind, **attributes) as child, activate(child):
+        yield child
+
+
+@contextlib.contextmanager
+def traced(name: str, request_id: str | None = None, traceparent: str | None = None,
+           kind: int = KIND_INTERNAL, **attributes) -> Iterator[Trace]:
+    """开始一个 trace 并把根 span 设为当前 span，退出时结束 trace"""
+    trace = start_trace(name, request_id, traceparent, kind, **attributes)
+    try:
+        with activate(trace.root):
+            yield trace
+    except BaseException as e:
+        trace.root.record_error(e)
+        raise
+    finally:
+        trace.end()
+
+
+def propagation_meta(span: Span | None = None) -> dict | None:
+    """放入 MCP 请求 _meta 的追踪信息"""
+    span = span or _current_span.get()
+    if span is None:
+        return None
+    return {"request_id": span.trace.request_id, "traceparent": span.traceparent}
+
+
+def propagation_headers(span: Span | None = None) -> dict:
+    """放入 HTTP 请求头的追踪信息"""
+    meta = propagation_meta(span)
+    if meta is None:
+        return {}
+    return {REQUEST_ID_HEADER: meta["request_id"], "traceparent": meta["traceparent"]}
+
+
+class SpanExporter(abc.ABC):
+    """在后台线程中批量导出已结束的 span，请求线程只把 span 放入队列，子类实现 export"""
+
+    def __init__(self, batch_size: int = 256, interval: float = 2):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def put(self, span_dict: dict):
+        self.queue.put(span_dict)
+
+    def _run(self):
+        while not self._stopped.is_set() or not self.queue.empty():
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0.01)))
+                except queue.Empty:
+                    break
+            if not batch:
+                continue
+            try:
+                self.export(batch)
+            except Exception as e:
+                logger.warning(f"span_export_fail {type(self).__name__}, dropped {len(batch)} spans: {e}")
+
+    @abc.abstractmethod
+    def export(self, batch: list[dict]):
+        """导出一批 span，在后台线程中调用，抛出异常时丢弃该批 span"""
+
+    def shutdown(self, timeout: float = 5):
+        self._stopped.set()
+        self._thread.join(timeout)
+
+
+class FileSpanExporter(SpanExporter):
+    """每行一个 span（JSON），追加写入本地文件"""
+
+    def __init__(self, file_path: str, service_name: str, **kwargs):
+        self.file_path = file_path
+        self.service_name = service_name
+        super().__init__(**kwargs)
+
+    def export(self, batch: list[dict]):
+        lines = "".join(json.dumps({"service": self.service_name, **item}, ensure_ascii=False, default=str) + "\n"
+                        for item in batch)
+        with open(self.file_path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+def to_otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)}
+
+
+class OtlpHttpSpanExporter(SpanExporter):
+    """以 OTLP/HTTP JSON 格式发送到采集端（OpenTelemetry Collector、Jaeger、Tempo 等）"""
+
+    def __init__(self, endpoint: str, service_name: str, **kwargs):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.client = httpx.Client(timeout=5)
+        super().__init__(**kwargs)
+
+    def export(self, batch: list[dict]):
+        spans = []
+        for item in batch:
+            otlp_span = {
+                "traceId": item["trace_id"],
+                "spanId": item["span_id"],
+                "name": item["name"],
+                "kind": item["kind"],
+                "startTimeUnixNano": str(item["start_time_unix_nano"]),
+                "endTimeUnixNano": str(item["end_time_unix_nano"]),
+                "attributes": [{"key": k, "value": to_otlp_value(v)} for k, v in item["attributes"].items()],
+                # OTLP 状态码 1: OK, 2: ERROR
+                "status": {"code": 1} if item["status"] == "ok" else {"code": 2, "message": item["error"] or ""},
+            }
+            if item["parent_span_id"]:
+                otlp_span["parentSpanId"] = item["parent_span_id"]
+            spans.append(otlp_span)
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "my_mcp.tracing"}, "spans": spans}],
+        }]}
+        response = self.client.post(self.endpoint, json=body)
+        response.raise_for_status()
+
+
+_exporter: SpanExporter | None = None
+_exporter_pid: int | None = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> SpanExporter | None:
+    """按配置创建导出器，每个进程一个（fork 出来的工作进程中重新创建）"""
+    global _exporter, _exporter_pid
+    if _exporter_pid == os.getpid():
+        return _exporter
+    with _exporter_lock:
+        if _exporter_pid != os.getpid():
+            tracing_cfg = get_tracing_cfg()
+            options = dict(batch_size=tracing_cfg["export_batch_size"], interval=tracing_cfg["export_interval"])
+            exporter_type = tracing_cfg["exporter"]
+            if exporter_type == EXPORTER_FILE:
+                _exporter = FileSpanExporter(tracing_cfg["file_path"], tracing_cfg["service_name"], **options)
+            elif exporter_type == EXPORTER_OTLP:
+                _exporter = OtlpHttpSpanExporter(tracing_cfg["otlp_endpoint"], tracing_cfg["service_name"], **options)
+            elif exporter_type == EXPORTER_NONE:
+                _exporter = None
+            else:
+                raise ValueError(f"不支持的 span 导出方式: {exporter_type}")
+            if _exporter is not None:
+                atexit.register(_exporter.shutdown)
+                logger.info(f"span_exporter_started {exporter_type}, pid={os.getpid()}")
+            _exporter_pid = os.getpid()
+    return _exporter
+
+
+def export_span(span: Span):
+    exporter = get_exporter()
+    if exporter is not None:
+        exporter.put(span.to_dict())
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
+
+"""
+TTL + LRU 结果缓存
+
+用于缓存变化很少的工具结果（数据源列表、表清单、表结构等），减少对数据后端的 HTTP 请求：
+- max_size: 最多缓存多少条结果，超出后淘汰最久未使用的
+- ttl: 结果的有效期（秒），过期后重新调用
+- stale_ttl: 过期后还可以继续返回旧结果的时间（秒），返回旧结果的同时在后台刷新（stale-while-revalidate）
+- max_bytes / max_item_bytes: 按 JSON 估算的缓存总字节数和单条结果字节数上限，避免大结果集占满内存
+- single_flight: 相同参数的并发调用只执行一次，共享结果
+- 支持按 key 或整体失效，统计命中、未命中次数
+- 多个工作进程时可以通过共享目录中的失效记录文件广播失效，见 broadcast_invalidate、sync_invalidations
+
+工具的缓存参数在 mcp_tool 装饰器中指定，可以被 cfg.yml 的 tool_cache 段按工具名覆盖:
+    tool_cache:
+        enabled: true
+        get_table_schema:
+            ttl: 3600
+            max_size: 512
+            stale_ttl: 600
+"""
+
+import asyncio
+import functools
+import inspect
+import json
+import logging.config
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Hashable
+
+from sys_init import cfg_file_path, init_yml_cfg
+
+current_dir = Path(__file__).parent
+project_root = current_dir
+logging_conf_path = f"{project_root}/logging.conf"
+logging.config.fileConfig(logging_conf_path, encoding="utf-8")
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_CFG = {
+    "max_size": 256,
+    "ttl": 300,
+    "stale_ttl": 0,
+    "max_bytes": 0,
+    "max_item_bytes": 0,
+    "single_flight": False,
+}
+
+# 所有已创建的缓存和并发去重，按名称（一般为工具名）索引
+CACHES: dict[str, "TTLCache"] = {}
+FLIGHTS: dict[str, "SingleFlight"] = {}
+
+_refresh_executor: ThreadPoolExecutor | None = None
+# 正在执行的异步后台刷新任务，保持引用避免任务被垃圾回收
+_refresh_tasks: set[asyncio.Task] = set()
+_lock = threading.Lock()
+
+# 多个工作进程之间广播失效：失效记录追加写入共享的日志文件，每个工作进程按偏移量读取新增的记录
+# 检查失效记录文件的最小间隔（秒），其他工作进程的失效最多延迟这么久生效
+INVALIDATION_SYNC_INTERVAL = 1.0
+_invalidation_lock = threading.Lock()
+_invalidation_log: str | None = None
+_invalidation_offset = 0
+_invalidation_checked = 0.0
+
+
+class TTLCache:
+    """线程安全的 TTL + LRU 缓存"""
+
+    def __init__(self, name: str, max_size: int = 256, ttl: float = 300, stale_ttl: float = 0,
+            max_bytes: int = 0, max_item_bytes: int = 0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes  # 缓存结果的总字节数上限，0 表示不限制
+        self.max_item_bytes = max_item_bytes  # 单条结果超过该字节数时不缓存，0 表示不限制
+        self.build_key: Callable[[tuple, dict], Hashable] | None = None  # 由 cached 装饰器设置，根据调用参数生成 key
+        self._data: OrderedDict[Hashable, tuple[Any, float, int]] = OrderedDict()
+        self._bytes = 0
+        self._refreshing: set[Hashable] = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.oversize = 0
+
+    def get(self, key: Hashable) -> tuple[bool, Any, bool]:
+        """
+        查询缓存
+        :return: (是否命中, 缓存值, 是否为过期但仍可用的旧值)
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at, size = item
+                if now < expires_at:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value, False
+                if now < expires_at + self.stale_ttl:
+                    self._data.move_to_end(key)
+                    self.stale_hits += 1
+                    return True, value, True
+                del self._data[key]
+                self._bytes -= size
+            self.misses += 1
+            return False, None, False
+
+    def set(self, key: Hashable, value: Any, size: int = 0) -> bool:
+        """写入缓存，size 为结果的字节数，超过 max_item_bytes 时不缓存，返回是否已缓存"""
+        with self._lock:
+            if self.max_item_bytes and size > self.max_item_bytes:
+                self.oversize += 1
+                return False
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, time.monotonic() + self.ttl, size)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_size or (self.max_bytes and self._bytes > self.max_bytes)):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+            return key in self._data
+
+    def invalidate(self, key: Hashable | None = None) -> int:
+        """使缓存失效，key 为空时清空整个缓存，返回删除的条数"""
+        with self._lock:
+            if key is None:
+                count = len(self._data)
+                self._data.clear()
+                self._bytes = 0
+                return count
+            item = self._data.pop(key, None)
+            if item is None:
+                return 0
+            self._bytes -= item[2]
+            return 1
+
+    def begin_refresh(self, key: Hashable) -> bool:
+        """同一个 key 同时只有一个后台刷新，返回 False 表示已经在刷新中"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key: Hashable):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "oversize": self.oversize,
+                "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+class _Call:
+    """SingleFlight 中一次正在执行的同步调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """
+    并发去重：相同 key 的并发调用只执行一次，其余调用等待并共享结果（包括异常）
+    同步调用在各自线程中等待；异步调用共享同一个 Task，某个调用方被取消不影响其他调用方
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, _Call] = {}
+        self._tasks: dict[tuple[int, Hashable], asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            logger.debug(f"single_flight_shared {self.name} {key}")
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        # Task 只能在创建它的事件循环中等待，因此 key 中包含事件循环
+        task_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = asyncio.ensure_future(fn())
+                self._tasks[task_key] = task
+                task.add_done_callback(lambda t: self._tasks.pop(task_key, None))
+                self.calls += 1
+            else:
+                self.shared += 1
+                logger.debug(f"single_flight_shared {self.name} {key}")
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls) + len(self._tasks)}
+
+
+def get_cache_cfg() -> dict:
+    """读取 cfg.yml 中的 tool_cache 配置"""
+    if os.path.exists(cfg_file_path):
+        return init_yml_cfg().get("tool_cache") or {}
+    return {}
+
+
+def make_key(arguments: dict) -> Hashable:
+    """默认的缓存 key：按参数名排序后的全部参数"""
+    return repr(sorted(arguments.items()))
+
+
+def _get_refresh_executor() -> ThreadPoolExecutor:
+    global _refresh_executor
+    if _refresh_executor is None:
+        with _lock:
+            if _refresh_executor is None:
+                _refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache_refresh")
+    return _refresh_executor
+
+
+def estimate_size(value: Any) -> int:
+    """估算结果序列化为 JSON 后的字节数，用于限制缓存占用的内存"""
+    if hasattr(value, "model_dump_json"):
+        return len(value.model_dump_json().encode("utf-8"))
+    return len(json.dumps(value, ensure_ascii=False,
+                          default=lambda o: o.model_dump() if hasattr(o, "model_dump") else str(o)).encode("utf-8"))
+
+
+def cached(name: str, max_size: int | None = None, ttl: float | None = None, stale_ttl: float | None = None,
+           max_bytes: int | None = None, max_item_bytes: int | None = None, single_flight: bool | None = None,
+           key_fn: Callable[[dict], Hashable] = make_key) -> Callable:
+    """
+    为函数增加 TTL + LRU 缓存和并发去重，同步函数和 async 函数都支持
+    使用 functools.wraps 保留原函数的签名和类型注解，FastMCP 依赖这些信息生成工具的 inputSchema
+    参数为空时依次使用 cfg.yml 中 tool_cache.<name> 的配置和默认值；ttl 为 0 或 tool_cache.enabled 为 false 时不缓存
+    max_bytes / max_item_bytes 限制缓存的总字节数和单条结果的字节数（按 JSON 估算），为 0 时不限制
+    single_flight 为 True 时，相同参数的并发调用只执行一次，其余调用等待并共享结果，不缓存时也生效
+    key_fn 的参数为按函数签名绑定（含默认值）后的参数字典，位置参数和关键字参数调用得到相同的 key
+    """
+    cache_cfg = get_cache_cfg()
+    opts = dict(DEFAULT_CACHE_CFG)
+    opts.update({k: v for k, v in {"max_size": max_size, "ttl": ttl, "stale_ttl": stale_ttl, "max_bytes": max_bytes,
+                                   "max_item_bytes": max_item_bytes, "single_flight": single_flight}.items()
+                 if v is not None})
+    opts.update(cache_cfg.get(name) or {})
+
+    def decorator(func):
+        use_cache = cache_cfg.get("enabled", True) and opts["ttl"]
+        if not use_cache and not opts["single_flight"]:
+            logger.info(f"cache_disabled_for {name}")
+            return func
+        signature = inspect.signature(func)
+
+        def build_key(args: tuple, kwargs: dict) -> Hashable:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return key_fn(dict(bound.arguments))
+
+        cache = None
+        if use_cache:
+            cache = TTLCache(name, max_size=opts["max_size"], ttl=opts["ttl"], stale_ttl=opts["stale_ttl"],
+                             max_bytes=opts["max_bytes"], max_item_bytes=opts["max_item_bytes"])
+            cache.build_key = build_key
+            CACHES[name] = cache
+        flight = None
+        if opts["single_flight"]:
+            flight = SingleFlight(name)
+            FLIGHTS[name] = flight
+        size_fn = estimate_size if opts["max_bytes"] or opts["max_item_bytes"] else None
+        logger.info(f"cache_enabled_for {name}, {opts}")
+
+        def store(key, value):
+            if cache is not None:
+                cache.set(key, value, size_fn(value) if size_fn else 0)
+
+        if inspect.iscoroutinefunction(func):
+            async def load_async(key, args, kwargs):
+                value = await func(*args, **kwargs)
+                store(key, value)
+                return value
+
+            async def refresh_async(key, args, kwargs):
+                try:
+                    await load_async(key, args, kwargs)
+                    logger.debug(f"cache_refreshed {name} {key}")
+                except Exception:
+                    logger.exception(f"cache_refresh_failed {name} {key}")
+                finally:
+                    cache.end_refresh(key)
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = build_key(args, kwargs)
+                if cache is not None:
+                    hit, value, stale = cache.get(key)
+                    if hit:
+                        if stale and cache.begin_refresh(key):
+                            task = asyncio.create_task(refresh_async(key, args, kwargs))
+                            _refresh_tasks.add(task)
+                            task.add_done_callback(_refresh_tasks.discard)
+                        return value
+                if flight is not None:
+                    return await flight.ado(key, lambda: load_async(key, args, kwargs))
+                return await load_async(key, args, kwargs)
+
+            async_wrapper.cache = cache
+            return async_wrapper
+
+        def load(key, args, kwargs):
+            value = func(*args, **kwargs)
+            store(key, value)
+            return value
+
+        def refresh(key, args, kwargs):
+            try:
+                load(key, args, kwargs)
+                logger.debug(f"cache_refreshed {name} {key}")
+            except Exception:
+                logger.exception(f"cache_refresh_failed {name} {key}")
+            finally:
+                cache.end_refresh(key)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = build_key(args, kwargs)
+            if cache is not None:
+                hit, value, stale = cache.get(key)
+                if hit:
+                    if stale and cache.begin_refresh(key):
+                        _get_refresh_executor().submit(refresh, key, args, kwargs)
+                    return value
+            if flight is not None:
+                return flight.do(key, lambda: load(key, args, kwargs))
+            return load(key, args, kwargs)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def invalidate(name: str | None = None, arguments: dict | None = None) -> int:
+    """
+    使缓存失效，返回删除的条数
+    :param name: 缓存名称（工具名），为空时清空全部缓存
+    :param arguments: 调用参数，例如 {"db_source": "a", "table_name": "b"}，为空时清空该工具的全部缓存
+    """
+    count = 0
+    for cache_name, cache in list(CACHES.items()):
+        if name is not None and cache_name != name:
+            continue
+        if arguments is None or cache.build_key is None:
+            count += cache.invalidate()
+        else:
+            count += cache.invalidate(cache.build_key((), arguments))
+    logger.info(f"cache_invalidated name={name}, arguments={arguments}, count={count}")
+    return count
+
+
+def use_shared_dir(log_path: str):
+    """多个工作进程时由 server.py 在创建应用时调用，只读取之后新增的失效记录"""
+    global _invalidation_log, _invalidation_offset
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    with _invalidation_lock:
+        _invalidation_log = log_path
+        _invalidation_offset = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    logger.info(f"cache_invalidation_log {log_path}, offset={_invalidation_offset}")
+
+
+def broadcast_invalidate(name: str | None = None, arguments: dict | None = None) -> int:
+    """使当前进程的缓存失效，并写入失效记录，其他工作进程在 sync_invalidations 时执行同样的失效"""
+    count = invalidate(name, arguments)
+    if _invalidation_log:
+        record = json.dumps({"pid": os.getpid(), "tool": name, "arguments": arguments}, ensure_ascii=False)
+        # 一次 write 追加一整行，多个进程同时追加时不会交错
+        with open(_invalidation_log, "a", encoding="utf-8") as f:
+            f.write(record + "\n")
+    return count
+
+
+def sync_invalidations():
+    """执行其他工作进程写入的失效记录，每次访问缓存的请求前调用，最多每 INVALIDATION_SYNC_INTERVAL 秒检查一次文件"""
+    global _invalidation_offset, _invalidation_checked
+    if not _invalidation_log or time.monotonic() - _invalidation_checked < INVALIDATION_SYNC_INTERVAL:
+        return
+    with _invalidation_lock:
+        _invalidation_checked = time.monotonic()
+        try:
+            if os.path.getsize(_invalidation_log) <= _invalidation_offset:
+                return
+            with open(_invalidation_log, "rb") as f:
+                f.seek(_invalidation_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # 只处理完整的行，写了一半的行留到下次读取
+        end = data.rfind(b"\n") + 1
+        _invalidation_offset += end
+        records = data[:end].splitlines()
+    for line in records:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            logger.warning(f"cache_invalidation_record_invalid {line[:200]!r}")
+            continue
+        if record.get("pid") != os.getpid():
+            invalidate(record.get("tool"), record.get("arguments"))
+
+
+def cache_stats() -> dict:
+    """所有缓存和并发去重的统计信息"""
+    stats = {name: cache.stats() for name, cache in list(CACHES.items())}
+    for name, flight in list(FLIGHTS.items()):
+        stats.setdefault(name, {})["single_flight"] = flight.stats()
+    return stats
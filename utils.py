@@ -2,15 +2,21 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) [2025] [liuyngchng@hotmail.com] - All rights reserved.
 
+import asyncio
+import csv
+import io
 import json
 import re
 import sys
-import time
 from pathlib import Path
 
-import requests
 import logging.config
 
+from circuit_breaker import CircuitBreaker, get_breaker, upstream_name
+from log_utils import Payload, redact
+from http_pool import async_request_extensions, get_async_client, get_async_timeout, get_session, get_timeout
+from retry_policy import RETRYABLE_EXCEPTIONS, HttpStatusError, get_retry_policy, parse_retry_after
+
 
 current_dir = Path(__file__).parent
 project_root = current_dir
@@ -56,6 +62,47 @@ def convert_list_to_html_table(my_list: list):
         html += f"\n<tr>{row}</tr>"
     return html + "\n</tbody>\n</table>"
 
+# 表格数据的编码格式
+# rows: 逐行的字典列表，每行都重复列名；columnar: 一次列名 + 按列存放的数组；csv / markdown: 文本表格
+RESULT_FORMATS = ("rows", "columnar", "csv", "markdown")
+
+def convert_list_to_columnar(my_list: list) -> dict:
+    """转换为列式结构 {"columns": [列名], "values": [[第一列的值], [第二列的值], ...]}，列名只出现一次"""
+    headers = list(my_list[0].keys()) if my_list else []
+    return {"columns": headers, "values": [[item.get(h) for item in my_list] for h in headers]}
+
+def convert_columnar_to_list(columnar: dict) -> list:
+    """convert_list_to_columnar 的逆变换"""
+    columns = columnar.get("columns") or []
+    return [dict(zip(columns, row)) for row in zip(*(columnar.get("values") or []))]
+
+def convert_list_to_csv(my_list: list):
+    headers = list(my_list[0].keys()) if my_list else []
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(headers)
+    for item in my_list:
+        writer.writerow(["" if item.get(h) is None else item.get(h) for h in headers])
+    return output.getvalue()
+
+def convert_list_to_format(my_list: list, result_format: str) -> dict:
+    """
+    按 result_format 编码表格数据，返回 SqlExecResult 中对应的字段
+    rows -> {"data": [...]}; columnar -> {"columns": [...], "values": [...]}; csv / markdown -> {"text": "..."}
+    """
+    if result_format == "columnar":
+        return convert_list_to_columnar(my_list)
+    if result_format == "csv":
+        return {"text": convert_list_to_csv(my_list)}
+    if result_format == "markdown":
+        return {"text": convert_list_to_md_table(my_list)}
+    return {"data": my_list}
+
+def estimate_tokens(txt: str) -> int:
+    """粗略估算文本的 token 数：中日韩字符约 1 个 token，其余字符约 4 个一个 token"""
+    cjk = len(re.findall(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]', txt))
+    return cjk + (len(txt) - cjk + 3) // 4
+
 def get_console_arg1() -> int:
     # 检查命令行参数
     default_port = 19000
@@ -74,68 +121,161 @@ def get_console_arg1() -> int:
     return default_port
 
 
-def post_with_retry(uri: str, headers: dict, data: dict, proxies: str | None, max_retries: int = 3) -> dict:
+def check_response(uri: str, response) -> None:
     """
-    带重试机制的LLM调用
+    检查响应状态码，非 2xx 时抛出 HttpStatusError，由重试策略判断是否需要重试
+    错误响应体不一定是 JSON，这里只截取文本，不调用 response.json()
     """
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"第 {attempt + 1} 次 post {uri}, proxies: {proxies}, data: {data}")
-            response = requests.post(uri, headers=headers, json=data, verify=False, proxies=proxies, timeout=30)
+    if 200 <= response.status_code < 300:
+        return
+    raise HttpStatusError(uri, response.status_code, response.text[:500],
+                          parse_retry_after(response.headers.get("Retry-After")))
+
+
+def is_upstream_failure(e: BaseException) -> bool:
+    """
+    熔断器使用的失败判断：只有 5xx、超时和连接错误说明上游不健康
+    4xx（含 429 限流）说明上游仍能正常响应，不计入熔断
+    """
+    if isinstance(e, HttpStatusError):
+        return e.status_code >= 500
+    return isinstance(e, RETRYABLE_EXCEPTIONS)
+
+
+def get_http_breaker(uri: str) -> CircuitBreaker:
+    """按 scheme://host:port 获取上游 HTTP 服务的熔断器"""
+    return get_breaker(upstream_name(uri), is_failure=is_upstream_failure)
+
+
+def post_with_retry(uri: str, headers: dict, data: dict, proxies: str | None, max_retries: int | None = None) -> dict:
+    """
+    带重试机制的LLM调用，重试策略见 retry_policy
+    """
+    breaker = get_http_breaker(uri)
+
+    def attempt(remaining: float | None) -> dict:
+        logger.info("post %s, proxies: %s", uri, proxies)
+        logger.debug("post_data %s", Payload(data))
+        with breaker.track():
+            response = get_session().post(uri, headers=headers, json=data, verify=False, proxies=proxies,
+                                          timeout=get_timeout(remaining))
             logger.info(f"llm_response_status {response.status_code}")
+            check_response(uri, response)
+        logger.debug("post_response %s", Payload(response.text))
+        return response.json()
 
-            if response.status_code == 200:
-                logger.debug(f"post_response {json.dumps(response.json())}")
-                return response.json()
-            else:
-                logger.warning(f"request API 返回非200状态码: {response.status_code}, {response.json()}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)  # 指数退避
-
-        except requests.exceptions.Timeout:
-            logger.warning(f"request_API_timeout，retry {attempt + 1}/{max_retries}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # 指数退避
-        except Exception as e:
-            logger.warning(f"request_API_fail: {str(e)}，retry {attempt + 1}/{max_retries}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # 指数退避
+    return get_retry_policy(max_retries).call(attempt, name=f"POST {uri}")
 
-    # 所有重试都失败
-    raise RuntimeError(f"LLM API 调用失败，已重试 {max_retries} 次")
 
-def get_with_retry(uri: str, headers: dict, params: dict, proxies: str | None, max_retries: int = 3) -> dict:
+async def async_post_with_retry(uri: str, headers: dict, data: dict, proxies: dict | None, max_retries: int | None = None) -> dict:
     """
-    带重试机制的GET请求
+    带重试机制的异步 POST 请求，等待期间不阻塞事件循环
     """
-    for attempt in range(max_retries):
+    client = get_async_client(uri, proxies)
+    breaker = get_http_breaker(uri)
+
+    async def attempt(remaining: float | None) -> dict:
+        logger.info("async post %s, proxies: %s", uri, proxies)
+        logger.debug("post_data %s", Payload(data))
+        with breaker.track():
+            response = await client.post(uri, headers=headers, json=data, timeout=get_async_timeout(remaining),
+                                         extensions=async_request_extensions())
+            logger.info(f"llm_response_status {response.status_code}")
+            check_response(uri, response)
+        logger.debug("post_response %s", Payload(response.text))
+        return response.json()
+
+    return await get_retry_policy(max_retries).acall(attempt, name=f"POST {uri}")
+
+
+async def async_post_stream(uri: str, headers: dict, data: dict, proxies: dict | None, max_retries: int | None = None):
+    """
+    异步 POST 请求，按 SSE 格式（data: {...}）逐条返回服务端推送的 JSON 数据，直到 [DONE]
+    只在收到任何数据之前失败时按重试策略重试，已经开始输出之后的失败直接抛出
+    """
+    client = get_async_client(uri, proxies)
+    breaker = get_http_breaker(uri)
+    state = get_retry_policy(max_retries).start(f"POST stream {uri}")
+    while True:
+        received = False
+        response = None
         try:
-            logger.info(f"第 {attempt + 1} 次尝试调用GET API {uri}, proxies: {proxies}, params: {params}")
-            response = requests.get(uri, headers=headers, params=params, verify=False, proxies=proxies, timeout=30)
+            logger.info("async post stream %s, proxies: %s", uri, proxies)
+            logger.debug("post_data %s", Payload(data))
+            # 熔断器只统计建立连接和响应状态，流式输出过程中的错误不计入
+            with breaker.track():
+                request = client.build_request("POST", uri, headers=headers, json=data,
+                                               timeout=get_async_timeout(None),
+                                               extensions=async_request_extensions())
+                response = await client.send(request, stream=True)
+                logger.info(f"llm_stream_response_status {response.status_code}")
+                if response.status_code != 200:
+                    await response.aread()
+                    check_response(uri, response)
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    return
+                received = True
+                yield json.loads(payload)
+            return
+        except Exception as e:
+            if received:
+                raise
+            delay = state.next_delay(e)
+            if delay is None:
+                raise state.give_up() from e
+        finally:
+            if response is not None:
+                await response.aclose()
+        await asyncio.sleep(delay)
+
+def get_with_retry(uri: str, headers: dict, params: dict, proxies: str | None, max_retries: int | None = None) -> dict:
+    """
+    带重试机制的GET请求，重试策略见 retry_policy
+    """
+    breaker = get_http_breaker(uri)
+
+    def attempt(remaining: float | None) -> dict:
+        logger.info("get %s, proxies: %s, params: %s", uri, proxies, Payload(params))
+        with breaker.track():
+            response = get_session().get(uri, headers=headers, params=params, verify=False, proxies=proxies,
+                                         timeout=get_timeout(remaining))
             logger.info(f"get_response_status {response.status_code}")
+            check_response(uri, response)
+        logger.debug("get_response %s", Payload(response.text))
+        return response.json()
 
-            if response.status_code == 200:
-                logger.debug(f"get_response {json.dumps(response.json(), ensure_ascii=False)}")
-                return response.json()
-            else:
-                logger.warning(f"GET API 返回非200状态码: {response.status_code}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-
-        except requests.exceptions.Timeout:
-            logger.warning(f"GET API 调用超时，尝试 {attempt + 1}/{max_retries}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
-        except Exception as e:
-            logger.warning(f"GET API 调用失败: {str(e)}，尝试 {attempt + 1}/{max_retries}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
+    return get_retry_policy(max_retries).call(attempt, name=f"GET {uri}")
 
-    raise RuntimeError(f"GET API 调用失败，已重试 {max_retries} 次")
+async def async_get_with_retry(uri: str, headers: dict, params: dict, proxies: dict | None, max_retries: int | None = None) -> dict:
+    """
+    带重试机制的异步 GET 请求，使用当前事件循环中共享的 httpx.AsyncClient，等待期间不阻塞事件循环
+    """
+    client = get_async_client(uri, proxies)
+    breaker = get_http_breaker(uri)
+
+    async def attempt(remaining: float | None) -> dict:
+        logger.info("async get %s, proxies: %s, params: %s", uri, proxies, Payload(params))
+        with breaker.track():
+            response = await client.get(uri, headers=headers, params=params, timeout=get_async_timeout(remaining),
+                                        extensions=async_request_extensions())
+            logger.info(f"get_response_status {response.status_code}")
+            check_response(uri, response)
+        logger.debug("get_response %s", Payload(response.text))
+        return response.json()
+
+    return await get_retry_policy(max_retries).acall(attempt, name=f"GET {uri}")
 
 def build_curl_cmd(api, data, headers, proxies: dict | None):
+    """
+    生成可以复现请求的 curl 命令，用于调试日志
+    请求头和请求体中的密钥会被隐藏，请求体超过 log_utils 中配置的长度时截断，只在日志级别开启时调用
+    """
     header_str = ""
-    for k, v in headers.items():
+    for k, v in redact(headers).items():
         header_str += f' -H "{k}: {v}" '
 
     if proxies:
@@ -146,5 +286,5 @@ def build_curl_cmd(api, data, headers, proxies: dict | None):
         https_option = '-k --tlsv1'
     else:
         https_option = ''
-    curl_log = f"curl -s {curl_proxy} -w'\\n' {https_option} -X POST {header_str} -d '{json.dumps(data, ensure_ascii=False)}' '{api}' | jq"
+    curl_log = f"curl -s {curl_proxy} -w'\\n' {https_option} -X POST {header_str} -d '{Payload(data)}' '{api}' | jq"
     return curl_log
\ No newline at end of file